@@ -27,9 +27,17 @@ Flask Secure File Portal
 
 # 导入所需的Python标准库和第三方库
 import os                           # 用于操作系统相关功能，如创建目录
+import contextlib                   # 清理临时文件时忽略不存在的文件
+import hashlib                      # 上传时计算明文SHA-256，下载时校验
+import base64                       # Digest响应头中的摘要为base64编码
+import mmap                         # 大文件下载时映射密文文件，不读入内存
+import time                         # 流式解密的耗时统计
+import threading                    # 线程锁，保护按进程创建的加密线程池
+from concurrent.futures import ThreadPoolExecutor  # 批量上传的并行加密线程池
+import tempfile                     # 后台加密任务先写同目录临时文件
 import secrets                      # 用于生成加密安全的随机数
 from pathlib import Path           # 用于面向对象的文件系统路径操作
-from flask import Flask, request, jsonify, send_file  # Flask web框架核心模块
+from flask import Flask, request, jsonify, send_file, Response  # Flask web框架核心模块
 from flask_cors import CORS        # 处理跨域资源共享(CORS)的Flask扩展
 from flask_login import LoginManager, UserMixin, current_user  # Flask用户会话管理扩展
 from werkzeug.security import generate_password_hash, check_password_hash  # Werkzeug安全工具函数
@@ -39,6 +47,30 @@ from Crypto.Util.Padding import pad, unpad  # AES加密需要的填充功能
 from Crypto.Random import get_random_bytes  # 生成加密安全的随机字节
 import jwt                         # JSON Web Token处理库
 import datetime                    # 日期时间处理模块
+from storage import atomic_write_many, file_lock, fsync_directory, publish, TEMP_PREFIX  # 原子写入共享的加密文件目录（批量/流式）
+import chunked_upload              # 可续传的分块上传（逐块加密落盘）
+import zip_stream                  # 边解密边输出的ZIP打包下载
+import jobs                        # SQLite持久化的后台任务队列（异步上传的加密和写入）
+import plaintext_cache             # 热点文件的解密结果缓存（LRU，按字节数限制）
+import crypto_stream               # 存储格式（原始密文下载在响应头中说明格式）
+import metadata                    # 存储对象的元数据索引（明文/密文摘要、巡检结果）
+import startup                     # 启动步骤计时与懒加载初始化
+import metrics                     # 请求/加解密指标，暴露在/metrics
+import logging                     # 标准库日志
+import portal_logging              # 结构化JSON日志，后台线程写出，不阻塞请求
+import timing                      # 每个请求的分阶段耗时（Server-Timing响应头）
+import compression                 # 按Accept-Encoding压缩JSON/文本响应（gzip/br）
+import json_provider               # orjson编码的jsonify（未安装时回退到标准库）
+import tracing                     # 请求追踪：trace ID跨实例传递，span写入本地NDJSON文件
+import sampler                     # 采样分析器，供管理员在线上进程中抓取调用栈
+import ratelimit                   # 令牌桶限流（多进程/多实例共享的SQLite状态）与准入控制
+import quota                       # 每个用户的存储配额（PORTAL_QUOTA、PORTAL_QUOTAS）与用量对账
+import packstore                   # 小文件打包存储：追加写入大的段文件，按索引中的偏移读取
+from io import BytesIO             # 打包存储的对象从内存发送
+
+# 日志记录交给队列，由后台线程以JSON格式写出（级别、采样见portal_logging.py）
+portal_logging.setup()
+logger = logging.getLogger(__name__)
 
 # 初始化Flask应用程序
 # Flask是一个轻量级的Python web框架，用于快速构建web应用
@@ -46,39 +78,107 @@ app = Flask(__name__)
 # 使用持久化的密钥文件而不是每次生成新密钥
 # 这样可以确保应用重启后JWT token仍然有效
 
-# 检查是否存在JWT密钥文件，如果不存在则创建
-jwt_secret_file = Path('keys/jwt_secret.key')
-if jwt_secret_file.exists():
-    with open(jwt_secret_file, 'r') as f:
-        app.config['JWT_SECRET_KEY'] = f.read()
-else:
-    # 生成新的JWT密钥并保存到文件
-    jwt_secret = secrets.token_hex(32)
-    with open(jwt_secret_file, 'w') as f:
-        f.write(jwt_secret)
-    app.config['JWT_SECRET_KEY'] = jwt_secret
-
-# 检查是否存在应用密钥文件，如果不存在则创建
-secret_key_file = Path('keys/secret.key')
-if secret_key_file.exists():
-    with open(secret_key_file, 'r') as f:
-        app.config['SECRET_KEY'] = f.read()
-else:
-    # 生成新的应用密钥并保存到文件
-    secret_key = secrets.token_hex(32)
-    with open(secret_key_file, 'w') as f:
-        f.write(secret_key)
-    app.config['SECRET_KEY'] = secret_key
-
-# 设置文件上传的存储目录
-app.config['UPLOAD_FOLDER'] = 'protected_files'
+# 读取或生成持久化的密钥，写入app.config
+# 启动时执行；设置PORTAL_LAZY_INIT=1时推迟到第一个请求（见文件后部的startup.deferred调用）
+def load_app_keys():
+    # 密钥文件读写之前必须先确保keys目录存在
+    os.makedirs('keys', exist_ok=True)
+
+    # 检查是否存在JWT密钥文件，如果不存在则创建
+    jwt_secret_file = Path('keys/jwt_secret.key')
+    if jwt_secret_file.exists():
+        with open(jwt_secret_file, 'r') as f:
+            app.config['JWT_SECRET_KEY'] = f.read()
+    else:
+        # 生成新的JWT密钥并保存到文件
+        jwt_secret = secrets.token_hex(32)
+        with open(jwt_secret_file, 'w') as f:
+            f.write(jwt_secret)
+        app.config['JWT_SECRET_KEY'] = jwt_secret
+
+    # 检查是否存在应用密钥文件，如果不存在则创建
+    secret_key_file = Path('keys/secret.key')
+    if secret_key_file.exists():
+        with open(secret_key_file, 'r') as f:
+            app.config['SECRET_KEY'] = f.read()
+    else:
+        # 生成新的应用密钥并保存到文件
+        secret_key = secrets.token_hex(32)
+        with open(secret_key_file, 'w') as f:
+            f.write(secret_key)
+        app.config['SECRET_KEY'] = secret_key
+
+# 设置文件上传的存储目录；PORTAL_UPLOAD_FOLDER可以改用其他目录（如bench_upload.py的临时目录）
+# 必须在导入之前设置：元数据索引、段文件、上传会话、任务队列和限流状态在导入时就绑定到这个目录
+app.config['UPLOAD_FOLDER'] = os.environ.get('PORTAL_UPLOAD_FOLDER') or 'protected_files'
 # 设置最大文件上传大小为16MB，防止大文件上传导致服务器资源耗尽
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
+# 原始密文下载默认由本进程发送（serve.py下走sendfile）；放在前端服务器后面时可交给它发送文件：
+# PORTAL_SENDFILE_OFFLOAD=x-sendfile（Apache/lighttpd）或 x-accel-redirect（nginx）
+app.config['SENDFILE_OFFLOAD'] = os.environ.get('PORTAL_SENDFILE_OFFLOAD', '').lower()
+app.config['USE_X_SENDFILE'] = app.config['SENDFILE_OFFLOAD'] == 'x-sendfile'
+# x-accel-redirect时nginx中指向UPLOAD_FOLDER的internal location
+app.config['ACCEL_REDIRECT_PREFIX'] = os.environ.get('PORTAL_ACCEL_REDIRECT_PREFIX', '/protected_files/')
 
 # 启用CORS（跨域资源共享），允许来自任何源(*)对/api/*路径的访问
 # 这在开发阶段非常有用，但在生产环境中应该更严格地限制来源
 CORS(app, resources={r"/api/*": {"origins": "*"}})
 
+# 请求计数、延迟直方图和加解密字节数，通过 /metrics 暴露（Prometheus文本格式）
+metrics.init_app(app, __name__)
+# 每个响应带Server-Timing头：auth、lookup、io_read、decrypt等阶段的耗时
+timing.init_app(app, __name__)
+# 每个请求记录一条trace（设置PORTAL_TRACE_DIR时），各阶段作为span写入NDJSON文件
+tracing.init_app(app, __name__)
+# jsonify使用orjson编码（未安装时回退到标准库json），输出与Flask默认一致
+json_provider.init_app(app)
+
+# 限流与准入控制（ratelimit.py），在视图做任何耗时工作（scrypt密码校验、加密）之前检查：
+# - 每个进程同时处理的请求超过 PORTAL_MAX_IN_FLIGHT（默认64，0为不限制）时立即返回503和Retry-After
+# - 令牌桶按IP、用户或登录用户名计数，状态保存在 UPLOAD_FOLDER/.ratelimit 下的SQLite（WAL）中，
+#   所有工作进程和共享该目录的实例共用同一组桶；超过限制返回429和Retry-After
+# PORTAL_RATE_LIMIT=0 关闭限流（压测时使用）；在balancer.py等代理后面时设置 PORTAL_TRUSTED_PROXIES=代理层数
+MAX_IN_FLIGHT = int(os.environ.get('PORTAL_MAX_IN_FLIGHT') or 64)
+RATE_LIMIT = os.environ.get('PORTAL_RATE_LIMIT', '1').lower() not in ('0', 'false', 'no', 'off')
+UPLOAD_ENDPOINTS = {'api_upload_file', 'api_upload_batch', 'api_upload_async', 'api_create_upload', 'api_upload_chunk'}
+
+def rate_limit_user():
+    # 已验证的JWT中的用户ID；没有或无效的token不按用户计数（仍受按IP的规则限制，之后由token_required拒绝）
+    token = request.headers.get('Authorization', '')
+    if token.startswith('Bearer '):
+        token = token[7:]
+    if not token:
+        return None
+    try:
+        return str(jwt.decode(token, app.config['JWT_SECRET_KEY'], algorithms=['HS256'])['id'])
+    except (jwt.InvalidTokenError, KeyError):
+        return None
+
+def rate_limit_username():
+    # 登录请求中提交的用户名加客户端IP（请求体很小，get_json结果会被视图复用）：令牌在校验密码之前扣减，
+    # 只按用户名计数时任何人都能从别的地址用错误密码把该用户锁在登录之外；按IP分开后只限制同一来源对同一账户的猜测
+    data = request.get_json(silent=True)
+    username = data.get('username') if isinstance(data, dict) else None
+    if not isinstance(username, str) or not username:
+        return None
+    return f'{username[:64]}@{ratelimit.client_ip()}'
+
+limiter = ratelimit.RateLimiter(Path(app.config['UPLOAD_FOLDER']) / ratelimit.DB_DIR / ratelimit.DB_NAME,
+                                __name__, MAX_IN_FLIGHT)
+if RATE_LIMIT:
+    # 规则：名称、每秒补充的令牌数、桶容量（允许的突发）
+    limiter.rule('login_ip', 2, 20, endpoints={'api_login'})
+    limiter.rule('login_user', 0.2, 10, key=rate_limit_username, endpoints={'api_login'})
+    limiter.rule('upload', 10, 50, key=rate_limit_user, endpoints=UPLOAD_ENDPOINTS)
+    # 按字节计：每个用户每秒64 MB的上传量（加密耗时与字节数成正比）
+    limiter.rule('upload_bytes', 64 * 1024 * 1024, 512 * 1024 * 1024, key=rate_limit_user,
+                 endpoints=UPLOAD_ENDPOINTS, cost=lambda: request.content_length or 0)
+    limiter.rule('ip', 200, 400)
+limiter.init_app(app)
+# 客户端接受时对JSON/文本响应做gzip/br压缩（1 KB以上），大响应边压缩边发送；放在timing之后注册，压缩耗时计入Server-Timing；
+# 放在限流之后注册，压缩先于限流的after_request执行，边压缩边发送的响应发送完之前一直占用并发名额
+compression.init_app(app, __name__)
+
 # 初始化Flask-Login扩展，用于管理用户登录状态
 # Flask-Login提供了用户会话管理功能，可以轻松处理用户登录、登出等操作
 login_manager = LoginManager()
@@ -96,18 +196,29 @@ os.makedirs('keys', exist_ok=True)                       # 存储加密密钥的
 # 简单的用户存储字典（在生产环境中应使用数据库）
 # 这里为了演示方便，将用户信息存储在内存字典中
 # 实际项目中应该使用数据库存储用户信息
-users = {
-    # admin用户，密码经过hash处理存储，ID为1
-    'admin': {
-        'password': generate_password_hash('admin123'),  # 使用Werkzeug生成密码hash值
-        'id': 1
-    },
-    # user1用户，密码经过hash处理存储，ID为2
-    'user1': {
-        'password': generate_password_hash('password123'),  # 使用Werkzeug生成密码hash值
-        'id': 2
-    }
-}
+users = {}
+
+# 填充用户字典。每次密码哈希约需100ms，是启动耗时的大头，
+# 因此与密钥加载一样可以通过PORTAL_LAZY_INIT=1推迟到第一个请求
+def init_users():
+    users.update({
+        # admin用户，密码经过hash处理存储，ID为1，拥有管理员权限
+        'admin': {
+            'password': generate_password_hash('admin123'),  # 使用Werkzeug生成密码hash值
+            'id': 1,
+            'is_admin': True
+        },
+        # user1用户，密码经过hash处理存储，ID为2，普通用户
+        'user1': {
+            'password': generate_password_hash('password123'),  # 使用Werkzeug生成密码hash值
+            'id': 2,
+            'is_admin': False
+        }
+    })
+
+# 执行（或在懒加载模式下推迟）启动初始化步骤，每一步的耗时由startup模块记录
+startup.deferred(app, __name__, 'load keys', load_app_keys)
+startup.deferred(app, __name__, 'hash users', init_users)
 
 # 定义User类，继承自UserMixin
 # UserMixin提供了默认的用户身份验证和会话管理方法实现
@@ -143,30 +254,36 @@ def get_encryption_key():
                 key = f.read()
                 # 验证密钥长度是否正确（32字节用于AES-256）
                 if len(key) == 32:
-                    print(f"Loaded existing encryption key from {key_file}")
+                    metrics.KEY_LOADS.labels(__name__, 'file').inc()
+                    logger.debug('loaded encryption key', extra={'key_file': str(key_file)})
                     return key
                 else:
                     # 如果密钥长度不正确，生成新的密钥
-                    print(f"Warning: Encryption key file corrupted or incomplete (length: {len(key)}), generating new key")
+                    logger.warning('encryption key file corrupted or incomplete, generating new key', extra={'key_file': str(key_file), 'length': len(key)})
         except Exception as e:
-            print(f"Warning: Failed to read encryption key file: {e}, generating new key")
+            logger.warning('failed to read encryption key file, generating new key', extra={'key_file': str(key_file), 'error': str(e)})
     
     # 如果密钥文件不存在或密钥无效，则生成新的AES-256密钥（32字节）
-    print("Generating new encryption key...")
     key = get_random_bytes(32)  # AES-256 requires 32 bytes
     # 确保keys目录存在
     os.makedirs('keys', exist_ok=True)
     # 将新生成的密钥写入文件保存
     with open(key_file, 'wb') as f:
         f.write(key)
-    print(f"New encryption key saved to {key_file}")
+    logger.info('generated new encryption key', extra={'key_file': str(key_file)})
+    metrics.KEY_LOADS.labels(__name__, 'generated').inc()
     # 返回新生成的密钥
     return key
 
 # 文件加密函数，使用AES-256 CBC模式加密文件数据
-def encrypt_file(file_data):
+@metrics.crypto_op(__name__, 'encrypt')
+@timing.timed('encrypt')
+def encrypt_file(file_data, key=None):
     """
     Encrypt file data using AES-256 in CBC mode.
+
+    ``key`` may be passed in when many files are encrypted in a row, so the
+    key file is read once instead of once per file.
     
     Process:
     1. Get encryption key (32 bytes for AES-256)
@@ -177,8 +294,9 @@ def encrypt_file(file_data):
     """
     # ✅ 模式分析（唯一的IVs）
     """加密文件 - 每次使用随机IV"""
-    # 获取加密密钥
-    key = get_encryption_key()
+    # 获取加密密钥（批量上传时由调用方传入，只读取一次密钥文件）
+    if key is None:
+        key = get_encryption_key()
     # 创建AES加密器对象，使用CBC模式（自动产生随机IV）
     cipher = AES.new(key, AES.MODE_CBC)# 自动生成随机IV
     # 获取初始化向量(IV)，长度为16字节
@@ -193,6 +311,8 @@ def encrypt_file(file_data):
     return iv + encrypted_data  # Format: [IV][Encrypted Data]# IV前置存储
 
 # 文件解密函数，使用AES-256 CBC模式解密文件数据
+@metrics.crypto_op(__name__, 'decrypt')
+@timing.timed('decrypt')
 def decrypt_file(encrypted_data):
     """
     Decrypt file data using AES-256 in CBC mode.
@@ -275,6 +395,7 @@ def token_required(f):
         # 检查是否提供了token
         if not token:
             # 如果没有提供token，返回401未授权错误
+            metrics.JWT_FAILURES.labels(__name__, 'missing').inc()
             return jsonify({'message': 'Token is missing'}), 401
         
         try:
@@ -283,14 +404,17 @@ def token_required(f):
                 token = token[7:]
                 
             # 使用JWT库解码和验证token
-            data = jwt.decode(token, app.config['JWT_SECRET_KEY'], algorithms=['HS256'])
+            with timing.phase('auth'):
+                data = jwt.decode(token, app.config['JWT_SECRET_KEY'], algorithms=['HS256'])
             # 根据token中的数据创建当前用户对象
             current_user = User(data['username'], data['id'])
         except jwt.ExpiredSignatureError:
             # 如果token过期，返回401错误
+            metrics.JWT_FAILURES.labels(__name__, 'expired').inc()
             return jsonify({'message': 'Token has expired'}), 401
         except jwt.InvalidTokenError:
             # 如果token无效，返回401错误
+            metrics.JWT_FAILURES.labels(__name__, 'invalid').inc()
             return jsonify({'message': 'Token is invalid'}), 401
             
         # 如果token有效，调用被装饰的函数，并传入current_user等参数
@@ -356,33 +480,136 @@ def api_list_files(current_user):
         # 获取文件存储目录的Path对象
         files_dir = Path(app.config['UPLOAD_FOLDER'])
         # 检查目录是否存在
-        if files_dir.exists():
-            # 遍历目录中所有.enc扩展名的文件（加密文件）
-            for file_path in files_dir.glob('*.enc'):
-                try:
-                    # 尝试获取文件信息
-                    stat = file_path.stat()
-                    # 将文件信息添加到列表中
-                    files.append({
-                        'name': file_path.stem,  # 不带.enc扩展名的文件名
-                        'size': stat.st_size,    # 文件大小（字节）
-                        'encrypted_name': file_path.name   # 加密后的文件名
-                    })
-                except OSError as e:
-                    # 如果无法获取文件信息，记录日志并跳过该文件
-                    print(f"Warning: Could not access file {file_path}: {e}")
-                    continue
+        with timing.phase('lookup'):
+            # 打包存储的小文件只在索引中，同名的.enc文件是被取代的旧版本
+            packed = file_index.packed_objects()
+            if files_dir.exists():
+                # 遍历目录中所有.enc扩展名的文件（加密文件）
+                for file_path in files_dir.glob('*.enc'):
+                    if file_path.stem in packed:
+                        continue
+                    try:
+                        # 尝试获取文件信息
+                        stat = file_path.stat()
+                        # 将文件信息添加到列表中
+                        files.append({
+                            'name': file_path.stem,  # 不带.enc扩展名的文件名
+                            'size': stat.st_size,    # 文件大小（字节）
+                            'encrypted_name': file_path.name   # 加密后的文件名
+                        })
+                    except OSError as e:
+                        # 如果无法获取文件信息，记录日志并跳过该文件
+                        logger.warning('could not access file', extra={'file': str(file_path), 'error': str(e)})
+                        continue
+            for name, row in packed.items():
+                files.append({'name': name, 'size': row['segment_length'], 'encrypted_name': name + '.enc'})
         
         # 返回JSON格式的文件列表
-        return jsonify({'files': files})
+        with timing.phase('serialize'):
+            return jsonify({'files': files})
     except Exception as e:
         # 记录详细的错误信息
-        print(f"Error in api_list_files: {type(e).__name__}: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.exception('error in api_list_files')
         # 返回错误信息
         return jsonify({'message': f'Internal server error: {str(e)}'}), 500
 
+# 元数据索引：上传时在加密的同一遍读取中计算明文SHA-256并记录，下载时作为ETag/Digest返回并边解密边校验
+# 摘要与写入时的文件身份（大小、修改时间、inode）绑定，文件被其他途径替换后不再使用旧摘要
+file_index = metadata.MetadataIndex(app.config['UPLOAD_FOLDER'])
+UPLOAD_READ_SIZE = 256 * 1024
+
+# 小文件打包存储（packstore.py）：明文不超过 PORTAL_PACK_MAX_BYTES（默认0，即关闭；如65536）的文件不单独占用一个
+# .enc文件（inode、目录项和至少一个磁盘块），而是作为记录追加到 UPLOAD_FOLDER/.segments 下的段文件中，
+# 一批只写一次、fsync一次；索引行记录段号、偏移和长度，读取时一次查询加一次定位读取。大文件仍是单独的.enc文件
+# 索引行决定哪个版本是当前版本：打包写入取代同名的.enc文件，单独写入的文件也取代打包的版本
+# secure_app.py和vuln_*.py只认识.enc文件（看不到打包的对象，它们写入的同名.enc也会被索引行挡住），
+# 因此只在只有app.py写入的UPLOAD_FOLDER上开启
+pack_store = packstore.PackStore(app.config['UPLOAD_FOLDER'], file_index, __name__)
+
+def packable(size):
+    return packstore.PACK_MAX_BYTES and size is not None and size <= packstore.PACK_MAX_BYTES
+
+# 覆盖和删除在段文件中留下死数据；写入或删除之后检查（每个进程最多每分钟一次），
+# 有死数据超过一半的段时提交后台压缩任务，把仍有效的记录复制到最新的段中再删除旧段
+COMPACT_CHECK_INTERVAL = 60
+_compact_checked = 0.0
+
+def maybe_compact():
+    global _compact_checked
+    now = time.monotonic()
+    if now - _compact_checked < COMPACT_CHECK_INTERVAL:
+        return
+    _compact_checked = now
+    try:
+        if pack_store.needs_compaction():
+            job_queue.submit('compact_segments', 'system', {})
+    except Exception:
+        # 压缩只是回收空间，检查失败不影响刚完成的写入
+        logger.exception('could not queue segment compaction')
+
+# 存储配额：每个文件记在上传者名下，按磁盘上的字节数（IV+密文）计入用量
+# 用量计数器与元数据索引在同一个SQLite事务中由触发器更新，检查配额只需按主键查一行，不必遍历UPLOAD_FOLDER
+# 上传前先预留将要写入的字节数，超出配额返回413，数据不会写入；quota.py 定期对账，纠正文件在索引之外被改动造成的偏差
+@app.errorhandler(metadata.QuotaExceeded)
+def handle_quota_exceeded(e):
+    metrics.REQUESTS_REJECTED.labels(__name__, 'quota').inc()
+    return jsonify({'message': 'Storage quota exceeded', 'quota': e.limit, 'used': e.used,
+                    'reserved': e.reserved, 'requested': e.requested}), 413
+
+def reserve_storage(current_user, amount, replaces=(), hold=True):
+    """Reserve ``amount`` stored bytes for ``current_user``; raises QuotaExceeded if they do not fit."""
+    # 覆盖自己已有的同名文件时，旧版本占用的空间会被释放，预留时扣除
+    with timing.phase('lookup'):
+        return file_index.reserve(current_user.id, amount, quota.limit_for(current_user.username), replaces, hold)
+
+def encrypt_stream_into(source, file_path, progress=None, owner=None):
+    """Encrypt ``source`` into ``file_path`` in one pass; returns ``(size, sha256)``.
+
+    The plaintext SHA-256 is computed on the same pieces that are encrypted
+    and recorded in the metadata index with the identity of the new file
+    and its ``owner``. ``progress(bytes_done)`` is called after every piece.
+    """
+    encryptor = crypto_stream.CBCEncryptor(get_encryption_key())
+    digest = hashlib.sha256()
+    crypto_seconds = 0.0
+    done = 0
+    # 先写同目录临时文件，完成后原子重命名：重复执行只会再覆盖一次，不会留下半个文件
+    fd, tmp_name = tempfile.mkstemp(prefix=TEMP_PREFIX, dir=file_path.parent)
+    try:
+        with os.fdopen(fd, 'wb') as out:
+            with timing.phase('encrypt'):
+                out.write(encryptor.iv)
+                while True:
+                    piece = source.read(UPLOAD_READ_SIZE)
+                    if not piece:
+                        break
+                    started = time.perf_counter()
+                    digest.update(piece)
+                    data = encryptor.update(piece)
+                    crypto_seconds += time.perf_counter() - started
+                    out.write(data)
+                    done += len(piece)
+                    if progress is not None:
+                        progress(done)
+                out.write(encryptor.finalize())
+            with timing.phase('io_write'):
+                out.flush()
+                os.fsync(out.fileno())
+                # 重命名不改变inode和修改时间，这就是发布后文件的身份
+                stat = os.fstat(out.fileno())
+        with timing.phase('io_write'):
+            publish(tmp_name, file_path)
+    except BaseException:
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(tmp_name)
+        raise
+    metrics.CRYPTO_BYTES.labels(__name__, 'encrypt').inc(done)
+    metrics.CRYPTO_SECONDS.labels(__name__, 'encrypt').inc(crypto_seconds)
+    sha256 = digest.hexdigest()
+    with timing.phase('io_write'):
+        file_index.record_plaintext(file_path.name[:-len('.enc')], stat, sha256, done, owner)
+    return done, sha256
+
 # 文件上传API端点，处理文件上传和加密
 @app.route('/api/upload', methods=['POST'])
 @token_required  # 使用token_required装饰器保护此端点
@@ -406,32 +633,439 @@ def api_upload_file(current_user):
         # 如果文件名无效，返回400错误
         return jsonify({'message': 'Invalid filename'}), 400
     
-    # 读取文件数据
-    file_data = file.read()
-    
-    # 加密文件数据
-    encrypted_data = encrypt_file(file_data)
-    
     # 构造加密文件的文件名（原文件名+.enc扩展名）
     encrypted_filename = filename + '.enc'
     # 构造文件存储路径
     file_path = Path(app.config['UPLOAD_FOLDER']) / encrypted_filename
     
     # 验证文件路径安全性，防止目录遍历攻击
-    if not is_safe_path(app.config['UPLOAD_FOLDER'], encrypted_filename):
+    with timing.phase('lookup'):
+        path_ok = is_safe_path(app.config['UPLOAD_FOLDER'], encrypted_filename)
+    if not path_ok:
         # 如果路径不安全，返回400错误
         return jsonify({'message': 'Invalid file path'}), 400
     
-    # 将加密后的数据写入文件
-    with open(file_path, 'wb') as f:
-        f.write(encrypted_data)
+    # 按请求体长度预留配额：multipart的表单开销大于IV和填充，请求体长度不会小于存储后的文件
+    limit = quota.limit_for(current_user.username)
+    if request.content_length is None and limit is not None:
+        return jsonify({'message': 'Content-Length required'}), 411
+    reservation = reserve_storage(current_user, request.content_length or 0, [filename])
+
+    # 分块读取、计算明文SHA-256、加密并写入同目录临时文件，一遍完成；fsync后持锁重命名
+    # 多个实例共享同一个UPLOAD_FOLDER，这样并发上传不会交错写入，下载也不会读到半个文件
+    # 请求体不超过打包上限的小文件整个读入内存加密，追加到段文件中
+    try:
+        if packable(request.content_length):
+            with timing.phase('io_read'):
+                data = file.read()
+            encrypted, sha256 = encrypt_with_digest(data, get_encryption_key())
+            with timing.phase('io_write'):
+                pack_store.put_many([(filename, encrypted, sha256, len(data))], current_user.id)
+            size = len(data)
+        else:
+            size, sha256 = encrypt_stream_into(file.stream, file_path, owner=current_user.id)
+    finally:
+        file_index.release(reservation)
+    maybe_compact()
     
-    # 返回成功响应
+    # 返回成功响应，附带明文的大小和SHA-256，客户端可以与本地文件比对
+    return jsonify({
+        'message': f'File {filename} uploaded and encrypted successfully!',
+        'success': True,
+        'size': size,
+        'sha256': sha256,
+    })
+
+# 批量上传：一次请求携带多个文件，只验证一次JWT，加密在线程池中并行，写入时合并fsync
+# pycryptodome在AES的C调用期间释放GIL，因此多核机器上线程池可以真正并行加密
+MAX_BATCH_FILES = 1000
+# 总数据量小于此值时直接在请求线程中加密，线程池的调度开销比加密本身还大
+PARALLEL_MIN_BYTES = 256 * 1024
+CRYPTO_WORKERS = int(os.environ.get('PORTAL_CRYPTO_WORKERS') or os.cpu_count() or 1)
+
+# 线程不会随fork进入子进程，线程池按进程懒创建（serve.py的每个worker各有一个）
+_crypto_pool = None
+_crypto_pool_pid = None
+_crypto_pool_lock = threading.Lock()
+
+def get_crypto_pool():
+    global _crypto_pool, _crypto_pool_pid
+    if _crypto_pool_pid != os.getpid():
+        with _crypto_pool_lock:
+            if _crypto_pool_pid != os.getpid():
+                _crypto_pool = ThreadPoolExecutor(max_workers=CRYPTO_WORKERS, thread_name_prefix='crypto')
+                _crypto_pool_pid = os.getpid()
+    return _crypto_pool
+
+def encrypt_with_digest(data, key):
+    # 明文刚读入内存、还在CPU缓存中时紧接着计算摘要，不再单独遍历一次
+    return encrypt_file(data, key), hashlib.sha256(data).hexdigest()
+
+def encrypt_many(datas, key):
+    """``(encrypted, plaintext sha256)`` for each item of ``datas``; on the crypto pool when it pays off."""
+    if CRYPTO_WORKERS < 2 or len(datas) < 2 or sum(map(len, datas)) < PARALLEL_MIN_BYTES:
+        return [encrypt_with_digest(data, key) for data in datas]
+    # 每个线程处理连续的一段文件，减少任务调度次数
+    # 线程池中的调用不在请求上下文里，不会各自计入Server-Timing，这里整体计时
+    step = -(-len(datas) // CRYPTO_WORKERS)
+    with timing.phase('encrypt'):
+        futures = [get_crypto_pool().submit(lambda part: [encrypt_with_digest(data, key) for data in part],
+                                            datas[i:i + step])
+                   for i in range(0, len(datas), step)]
+        return [encrypted for future in futures for encrypted in future.result()]
+
+# 批量上传API端点：multipart表单中的每个 files 字段是一个文件，返回每个文件的结果
+@app.route('/api/upload/batch', methods=['POST'])
+@token_required
+def api_upload_batch(current_user):
+    files = request.files.getlist('files')
+    if not files:
+        return jsonify({'message': 'No file selected'}), 400
+    if len(files) > MAX_BATCH_FILES:
+        return jsonify({'message': f'At most {MAX_BATCH_FILES} files per batch'}), 400
+
+    # 逐个清理、校验文件名；有问题的文件记录失败原因，不影响其他文件
+    results = []
+    accepted = []  # (结果, 清理后的文件名, 文件对象)
+    seen = set()
+    with timing.phase('lookup'):
+        for file in files:
+            result = {'filename': file.filename, 'success': False}
+            results.append(result)
+            filename = secure_filename(file.filename or '')
+            if not filename or not is_safe_path(app.config['UPLOAD_FOLDER'], filename + '.enc'):
+                result['message'] = 'Invalid filename'
+                continue
+            if filename in seen:
+                result['message'] = 'Duplicate filename in batch'
+                continue
+            seen.add(filename)
+            result['stored_as'] = filename
+            accepted.append((result, filename, file))
+
+    with timing.phase('io_read'):
+        datas = [file.read() for _, _, file in accepted]
+    # 整批一次预留，大小已知；超出配额时整批拒绝
+    reservation = reserve_storage(current_user, sum(crypto_stream.stored_size(len(data)) for data in datas),
+                                  [filename for _, filename, _ in accepted])
+    try:
+        # 整批只读取一次密钥
+        encrypted = encrypt_many(datas, get_encryption_key())
+
+        # 小文件整批追加到段文件（一次写入、一次fsync）；其余的先写完所有临时文件，再统一fsync、重命名，目录只fsync一次
+        # written中打包存储的文件为None，单独存储的为最终路径，失败的为异常
+        upload_folder = Path(app.config['UPLOAD_FOLDER'])
+        small = [i for i, data in enumerate(datas) if packable(len(data))]
+        large = [i for i, data in enumerate(datas) if not packable(len(data))]
+        written = [None] * len(datas)
+        with timing.phase('io_write'):
+            if small:
+                try:
+                    pack_store.put_many([(accepted[i][1], encrypted[i][0], encrypted[i][1], len(datas[i]))
+                                         for i in small], current_user.id)
+                except OSError as e:
+                    for i in small:
+                        written[i] = e
+            outcomes = atomic_write_many([(upload_folder / (accepted[i][1] + '.enc'), encrypted[i][0]) for i in large])
+            for i, outcome in zip(large, outcomes):
+                written[i] = outcome
+        for (result, filename, _), data, (_, sha256), outcome in zip(accepted, datas, encrypted, written):
+            if isinstance(outcome, Exception):
+                logger.warning('batch upload write failed', extra={'file': filename, 'error': str(outcome)})
+                result['message'] = 'Failed to store file'
+            else:
+                if outcome is not None:
+                    with timing.phase('io_write'):
+                        file_index.record_plaintext(filename, os.stat(outcome), sha256, len(data), current_user.id)
+                result['success'] = True
+                result['message'] = 'Uploaded and encrypted'
+                result['size'] = len(data)
+                result['sha256'] = sha256
+    finally:
+        file_index.release(reservation)
+    maybe_compact()
+
+    uploaded = sum(1 for result in results if result['success'])
+    # 全部成功200，部分成功207，全部失败400
+    status = 200 if uploaded == len(results) else 207 if uploaded else 400
+    return jsonify({
+        'success': uploaded == len(results),
+        'uploaded': uploaded,
+        'failed': len(results) - uploaded,
+        'results': results,
+    }), status
+
+# 可续传分块上传：大文件按编号分块PUT，每块到达时即加密并追加写入，断线后可从已接收的偏移继续
+# 会话保存在 UPLOAD_FOLDER/.uploads 下，共享该目录的实例都可以继续同一个上传
+uploads = chunked_upload.ChunkedUploads(app.config['UPLOAD_FOLDER'], get_encryption_key, __name__)
+
+# 分块上传协议错误统一返回JSON（状态码由错误本身给出，如404、409）
+@app.errorhandler(chunked_upload.UploadError)
+def handle_upload_error(e):
+    return jsonify({'message': e.message, **e.info}), e.status
+
+# 创建上传会话：请求体 {"filename": ..., "size": 总字节数, "chunk_size": 可选}
+@app.route('/api/uploads', methods=['POST'])
+@token_required
+def api_create_upload(current_user):
+    data = request.get_json(silent=True) or {}
+    # 清理文件名，与普通上传相同
+    filename = secure_filename(data.get('filename') or '')
+    if not filename:
+        return jsonify({'message': 'Invalid filename'}), 400
+    with timing.phase('lookup'):
+        path_ok = is_safe_path(app.config['UPLOAD_FOLDER'], filename + '.enc')
+    if not path_ok:
+        return jsonify({'message': 'Invalid file path'}), 400
+    # 声明的大小超出配额时不创建会话，免得传完才被拒绝；完成时按实际大小再检查一次
+    size = data.get('size')
+    if isinstance(size, int) and size >= 0:
+        reserve_storage(current_user, crypto_stream.stored_size(size), [filename], hold=False)
+    state = uploads.create(current_user.id, filename, size, data.get('chunk_size'))
+    return jsonify(state), 201
+
+# 查询上传进度：返回已接收的偏移offset和下一个要发送的块next_chunk
+@app.route('/api/uploads/<upload_id>', methods=['GET'])
+@token_required
+def api_upload_status(current_user, upload_id):
+    return jsonify(uploads.status(current_user.id, upload_id))
+
+# 上传第index块：请求体为原始字节，长度必须正好是该块的大小（最后一块可以更短）
+@app.route('/api/uploads/<upload_id>/chunks/<int:index>', methods=['PUT'])
+@token_required
+def api_upload_chunk(current_user, upload_id, index):
+    if request.content_length is None:
+        return jsonify({'message': 'Content-Length required'}), 411
+    state = uploads.write_chunk(current_user.id, upload_id, index, request.stream, request.content_length)
+    return jsonify(state)
+
+# 完成上传：所有块都已加密落盘，直接重命名为 <filename>.enc，不再读取整个文件
+@app.route('/api/uploads/<upload_id>/complete', methods=['POST'])
+@token_required
+def api_complete_upload(current_user, upload_id):
+    # 先查会话拿到文件名，再构造目标路径
+    session = uploads.status(current_user.id, upload_id)
+    filename = session['filename']
+    file_path = Path(app.config['UPLOAD_FOLDER']) / (filename + '.enc')
+    # 超出配额时返回413，会话保留，释放空间后可以再次完成
+    reservation = reserve_storage(current_user, crypto_stream.stored_size(session['size']), [filename])
+    try:
+        state = uploads.complete(current_user.id, upload_id, file_path)
+        # 分块上传无法保存哈希状态，明文摘要在第一次完整下载时记录
+        with timing.phase('io_write'):
+            file_index.record_plaintext(filename, file_path.stat(), None, state['size'], current_user.id)
+    finally:
+        file_index.release(reservation)
+    # 分块上传的数据已经加密落盘为单独的文件，不再打包；取代打包的旧版本时留下的死数据由压缩回收
+    maybe_compact()
+    logger.info('chunked upload completed', extra={'file': filename, 'bytes': state['size'],
+                                                   'chunks': state['chunks']})
     return jsonify({
         'message': f'File {filename} uploaded and encrypted successfully!',
-        'success': True
+        'success': True,
+        'filename': filename,
+        'size': state['size'],
     })
 
+# 放弃上传，删除已接收的数据
+@app.route('/api/uploads/<upload_id>', methods=['DELETE'])
+@token_required
+def api_abort_upload(current_user, upload_id):
+    uploads.abort(current_user.id, upload_id)
+    return jsonify({'message': 'Upload aborted', 'success': True})
+
+# 异步上传：请求只把文件写入磁盘暂存区，立即返回202和任务ID，加密和写入由后台任务线程完成
+# 任务保存在 UPLOAD_FOLDER/.jobs 下的SQLite数据库中，进程重启或崩溃后未完成的任务会被重新执行，失败的任务最多执行3次
+# PORTAL_JOB_WORKERS 设置每个进程的任务线程数（默认2）
+JOB_WORKERS = int(os.environ.get('PORTAL_JOB_WORKERS') or jobs.DEFAULT_WORKERS)
+
+def run_encrypt_job(job):
+    """Encrypt a spooled upload into place; safe to run again after a crash."""
+    file_path = Path(app.config['UPLOAD_FOLDER']) / (job.params['filename'] + '.enc')
+    try:
+        source = open(job.spool_path, 'rb')
+    except FileNotFoundError:
+        raise jobs.JobError('spooled upload is missing') from None
+    # 与 /api/upload 相同的单遍加密：临时文件写完后原子重命名，重复执行只会再覆盖一次，不会留下半个文件
+    # 提交时预留的配额在任务结束时释放，无论成功与否（重试时不再持有预留）
+    # 暂存的小文件与 /api/upload 一样追加到段文件；重复执行只会多追加一份，旧记录成为死数据
+    try:
+        with source:
+            if packable(os.fstat(source.fileno()).st_size):
+                data = source.read()
+                encrypted, sha256 = encrypt_with_digest(data, get_encryption_key())
+                pack_store.put_many([(job.params['filename'], encrypted, sha256, len(data))], int(job.owner))
+                size = len(data)
+                job.progress(size)
+            else:
+                size, sha256 = encrypt_stream_into(source, file_path, job.progress, int(job.owner))
+    finally:
+        file_index.release(job.params.get('reservation'))
+    maybe_compact()
+    logger.info('async upload stored', extra={'job': job.id, 'file': job.params['filename'], 'bytes': size})
+    return {'filename': job.params['filename'], 'size': size, 'sha256': sha256}
+
+def run_compact_job(job):
+    """Compact the segments worth compacting; see packstore.PackStore.compact."""
+    report = pack_store.compact()
+    logger.info('segments compacted', extra={'job': job.id, **report})
+    return report
+
+job_queue = jobs.JobQueue(Path(app.config['UPLOAD_FOLDER']) / '.jobs',
+                          {'encrypt_upload': run_encrypt_job, 'compact_segments': run_compact_job},
+                          JOB_WORKERS, __name__).init_app(app)
+
+# 异步上传API端点：与 /api/upload 相同的multipart表单（file字段），返回202、任务ID和查询地址
+@app.route('/api/upload/async', methods=['POST'])
+@token_required
+def api_upload_async(current_user):
+    file = request.files.get('file')
+    if file is None or file.filename == '':
+        return jsonify({'message': 'No file selected'}), 400
+    filename = secure_filename(file.filename)
+    if not filename:
+        return jsonify({'message': 'Invalid filename'}), 400
+    with timing.phase('lookup'):
+        path_ok = is_safe_path(app.config['UPLOAD_FOLDER'], filename + '.enc')
+    if not path_ok:
+        return jsonify({'message': 'Invalid file path'}), 400
+
+    # 提交时按请求体长度预留配额，由任务在写入后释放
+    limit = quota.limit_for(current_user.username)
+    if request.content_length is None and limit is not None:
+        return jsonify({'message': 'Content-Length required'}), 411
+    reservation = reserve_storage(current_user, request.content_length or 0, [filename])
+
+    # 写入暂存文件并fsync后任务才入队，之后即使进程退出任务也不会丢失
+    try:
+        with timing.phase('io_write'):
+            job = job_queue.submit('encrypt_upload', current_user.id,
+                                   {'filename': filename, 'reservation': reservation}, source=file.stream)
+    except BaseException:
+        file_index.release(reservation)
+        raise
+    status_url = f"/api/jobs/{job['job_id']}"
+    response = jsonify(dict(job, status_url=status_url))
+    response.status_code = 202
+    response.headers['Location'] = status_url
+    return response
+
+# 任务状态查询：state 为 queued/running/done/failed，progress/total 为已处理/总字节数
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+@token_required
+def api_job_status(current_user, job_id):
+    job = job_queue.get(current_user.id, job_id)
+    if job is None:
+        return jsonify({'message': 'Job not found'}), 404
+    return jsonify(job)
+
+# 热点文件的解密结果缓存：同一文件被反复下载时不必每次重新读取和解密
+# 默认关闭；PORTAL_PLAINTEXT_CACHE_MB 设置每个进程的缓存上限，超过上限的1/4的文件不缓存
+# 按文件的设备号、inode、大小和修改时间区分版本，覆盖上传后旧的缓存自动失效；淘汰时明文内存清零
+PLAINTEXT_CACHE_BYTES = int(os.environ.get('PORTAL_PLAINTEXT_CACHE_MB') or 0) * 1024 * 1024
+download_cache = plaintext_cache.PlaintextCache(PLAINTEXT_CACHE_BYTES, app_name=__name__) if PLAINTEXT_CACHE_BYTES else None
+
+# 大文件下载不把密文和明文整个读入内存：mmap映射.enc文件，按块解密到一个复用的缓冲区后发送
+# Content-Length由最后一个密文块的填充算出，密钥错误或文件损坏在发送第一个字节之前就能发现
+MMAP_DOWNLOAD_MIN_BYTES = 1024 * 1024
+MMAP_CHUNK_SIZE = 256 * 1024
+
+def mapped_download(mapped, download_name, stat, known):
+    view = memoryview(mapped)
+    try:
+        key = get_encryption_key()
+        with timing.phase('decrypt'):
+            length = crypto_stream.plaintext_length(key, view)
+    except BaseException:
+        view.release()
+        mapped.close()
+        raise
+    headers = {
+        'Content-Length': str(length),
+        'Content-Disposition': f'attachment; filename="{download_name}"',
+    }
+    if known is not None:
+        headers.update(digest_headers(known[0]))
+    return Response(_stream_mapped(mapped, view, key, download_name, stat, known),
+                    mimetype='application/octet-stream', headers=headers)
+
+def _stream_mapped(mapped, view, key, name, stat, known):
+    size = len(view)
+    pieces = crypto_stream.decrypt_view(key, view, MMAP_CHUNK_SIZE)
+    digest = hashlib.sha256()
+    done = 0
+    seconds = 0.0
+    # 最后一块留到摘要校验通过后才发送：校验失败时客户端收到的数据比Content-Length短，能发现下载不完整
+    pending = None
+    try:
+        while True:
+            started = time.perf_counter()
+            piece = next(pieces, None)
+            seconds += time.perf_counter() - started
+            if piece is None:
+                break
+            digest.update(piece)
+            done += len(piece)
+            # WSGI只接受bytes，每块复制一次（块大小而不是文件大小）
+            data = bytes(piece)
+            if pending is not None:
+                yield pending
+            pending = data
+        if not check_plaintext(name, stat, known, digest.hexdigest(), done):
+            raise ValueError(f'plaintext checksum mismatch for {name}')
+        if pending is not None:
+            yield pending
+    finally:
+        # 先结束解密生成器，释放它持有的切片，映射才能关闭
+        pieces.close()
+        view.release()
+        mapped.close()
+        metrics.CRYPTO_BYTES.labels(__name__, 'decrypt').inc(size)
+        metrics.CRYPTO_SECONDS.labels(__name__, 'decrypt').inc(seconds)
+
+# 下载响应中的明文摘要：ETag为十六进制SHA-256，Digest为RFC 3230格式（base64）
+def digest_headers(sha256):
+    return {
+        'ETag': f'"{sha256}"',
+        'Digest': 'sha-256=' + base64.b64encode(bytes.fromhex(sha256)).decode('ascii'),
+    }
+
+def check_plaintext(name, stat, known, sha256, size):
+    """Compare a download's plaintext digest with the recorded one, or record it if there is none.
+
+    Returns False on a mismatch, after marking the file corrupt in the index.
+    """
+    if known is None:
+        # 分块上传等没有记录摘要的文件，第一次完整下载时补记，之后的下载就能带上ETag/Digest
+        # 不取代期间写入的打包版本（supersede=False）
+        file_index.record_plaintext(name, stat, sha256, size, supersede=False)
+        metrics.DOWNLOAD_CHECKSUMS.labels(__name__, 'recorded').inc()
+        return True
+    if known == (sha256, size):
+        metrics.DOWNLOAD_CHECKSUMS.labels(__name__, 'verified').inc()
+        return True
+    metrics.DOWNLOAD_CHECKSUMS.labels(__name__, 'mismatch').inc()
+    logger.error('download checksum mismatch', extra={'file': name, 'expected': known[0], 'actual': sha256,
+                                                      'expected_size': known[1], 'size': size})
+    file_index.update(name, status='corrupt', error='plaintext checksum mismatch on download', checked=time.time())
+    return False
+
+# 打包存储的小文件：记录整个读入内存，解密并校验上传时记录的明文摘要
+def packed_download(name, row, stored):
+    known = (row['plain_sha256'], row['plain_size']) if row['plain_sha256'] is not None else None
+    if known is not None and request.if_none_match.contains(known[0]):
+        return Response(status=304, headers={'ETag': f'"{known[0]}"'})
+    decrypted_data = decrypt_file(stored)
+    with timing.phase('verify'):
+        sha256 = hashlib.sha256(decrypted_data).hexdigest()
+    if known is not None and not check_plaintext(name, None, known, sha256, len(decrypted_data)):
+        return jsonify({'message': '文件校验失败：解密结果与上传时的SHA-256不一致'}), 500
+    with timing.phase('serialize'):
+        response = send_file(BytesIO(decrypted_data), as_attachment=True, download_name=name,
+                             mimetype='application/octet-stream')
+        response.headers.update(digest_headers(sha256))
+    return response
+
 # 文件下载API端点，处理文件下载和解密
 @app.route('/api/download/<filename>', methods=['GET'])
 @token_required
@@ -448,36 +1082,76 @@ def api_download_file(current_user, filename):
     # 构造文件路径
     file_path = Path(app.config['UPLOAD_FOLDER']) / encrypted_filename
     
-    # 验证文件路径安全性，防止目录遍历攻击
-    if not is_safe_path(app.config['UPLOAD_FOLDER'], encrypted_filename):
+    # 验证文件路径安全性，防止目录遍历攻击，并检查文件是否存在
+    with timing.phase('lookup'):
+        path_ok = is_safe_path(app.config['UPLOAD_FOLDER'], encrypted_filename)
+        exists = path_ok and file_path.exists()
+    if not path_ok:
         # 如果路径不安全，返回400错误
         return jsonify({'message': 'Invalid file path'}), 400
     
-    # 检查文件是否存在
-    if not file_path.exists():
-        # 如果文件不存在，返回404错误
-        return jsonify({'message': 'File not found'}), 404
-    
     try:
-        # 读取加密文件
+        # 打包存储的小文件（packstore.py）：索引中记录的位置优先于同名的.enc文件
+        with timing.phase('io_read'):
+            packed = pack_store.read(safe_filename)
+        if packed is not None:
+            return packed_download(safe_filename, *packed)
+
+        # 检查文件是否存在
+        if not exists:
+            # 如果文件不存在，返回404错误
+            return jsonify({'message': 'File not found'}), 404
+
         with open(file_path, 'rb') as f:
-            encrypted_data = f.read()
-        
-        # 解密文件数据
-        decrypted_data = decrypt_file(encrypted_data)
+            # 缓存命中时直接使用明文；版本取自已打开的文件，与读到的密文一致
+            stat = os.fstat(f.fileno())
+            # 上传时记录的明文摘要（只在文件没有被替换时有效），客户端已有同一版本时不必再解密
+            with timing.phase('lookup'):
+                known = file_index.plaintext_digest(safe_filename, stat)
+            if known is not None and request.if_none_match.contains(known[0]):
+                return Response(status=304, headers={'ETag': f'"{known[0]}"'})
+            decrypted_data = None
+            if download_cache is not None:
+                version = plaintext_cache.version_of(stat)
+                with timing.phase('cache'):
+                    decrypted_data = download_cache.get(str(file_path), version)
+            # 不会进入缓存的大文件走mmap流式解密（关闭f不影响已建立的映射）
+            if (decrypted_data is None and stat.st_size >= MMAP_DOWNLOAD_MIN_BYTES
+                    and (download_cache is None or stat.st_size > download_cache.max_entry_bytes)):
+                with timing.phase('io_read'):
+                    mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                return mapped_download(mapped, safe_filename, stat, known)
+            if decrypted_data is None:
+                # 读取加密文件
+                with timing.phase('io_read'):
+                    encrypted_data = f.read()
+                # 解密文件数据
+                decrypted_data = decrypt_file(encrypted_data)
+                # 校验明文摘要；不一致时不发送数据，也不放入缓存
+                with timing.phase('verify'):
+                    sha256 = hashlib.sha256(decrypted_data).hexdigest()
+                if not check_plaintext(safe_filename, stat, known, sha256, len(decrypted_data)):
+                    return jsonify({'message': '文件校验失败：解密结果与上传时的SHA-256不一致'}), 500
+                known = (sha256, len(decrypted_data))
+                if download_cache is not None:
+                    download_cache.put(str(file_path), version, decrypted_data)
         
         # 创建BytesIO对象作为临时文件对象
-        from io import BytesIO
         file_obj = BytesIO(decrypted_data)
         file_obj.seek(0)  # 将文件指针移到开始位置
         
         # 发送文件给客户端下载
-        return send_file(
-            file_obj,
-            as_attachment=True,           # 作为附件下载
-            download_name=safe_filename,  # 下载时使用的文件名
-            mimetype='application/octet-stream'  # 通用二进制流MIME类型
-        )
+        with timing.phase('serialize'):
+            response = send_file(
+                file_obj,
+                as_attachment=True,           # 作为附件下载
+                download_name=safe_filename,  # 下载时使用的文件名
+                mimetype='application/octet-stream'  # 通用二进制流MIME类型
+            )
+            # 明文摘要作为ETag/Digest返回（缓存中的明文在放入时已校验过）
+            if known is not None:
+                response.headers.update(digest_headers(known[0]))
+            return response
     except ValueError as ve:
         # 处理解密相关的ValueError（如密钥错误）
         return jsonify({'message': f'解密失败: {str(ve)}'}), 400
@@ -491,18 +1165,223 @@ def api_download_file(current_user, filename):
         # 如果解密过程中发生其他错误，返回500服务器内部错误
         return jsonify({'message': f'服务器内部错误: {str(e)}'}), 500
 
+# 原始密文下载API端点：自己持有密钥的客户端（如备份代理）直接取回磁盘上的 [IV][密文]，在本地解密（见portal_client.py）
+# 服务器不解密、也不把文件读入用户态：serve.py下由内核sendfile直接从页缓存发送到socket，
+# 或按SENDFILE_OFFLOAD交给前端服务器；支持Range和If-None-Match，中断后可只取剩余字节
+@app.route('/api/download/<filename>/raw', methods=['GET'])
+@token_required
+def api_download_raw(current_user, filename):
+    safe_filename = secure_filename(filename)
+    if not safe_filename or safe_filename != filename:
+        return jsonify({'message': 'Invalid filename'}), 400
+
+    encrypted_filename = safe_filename + '.enc'
+    file_path = Path(app.config['UPLOAD_FOLDER']) / encrypted_filename
+    with timing.phase('lookup'):
+        path_ok = is_safe_path(app.config['UPLOAD_FOLDER'], encrypted_filename)
+        exists = path_ok and file_path.is_file()
+    if not path_ok:
+        return jsonify({'message': 'Invalid file path'}), 400
+    try:
+        with timing.phase('io_read'):
+            packed = pack_store.read(safe_filename)
+    except ValueError as e:
+        return jsonify({'message': f'Cannot read file: {e}'}), 500
+    if packed is None and not exists:
+        return jsonify({'message': 'File not found'}), 404
+
+    with timing.phase('serialize'):
+        if packed is not None:
+            # 打包存储的记录不是单独的文件，无法交给sendfile或前端服务器，从内存发送；ETag为密文的SHA-256
+            row, stored = packed
+            response = send_file(BytesIO(stored), mimetype='application/octet-stream', as_attachment=True,
+                                 download_name=encrypted_filename, conditional=True, etag=row['cipher_sha256'],
+                                 last_modified=row['mtime_ns'] / 1e9)
+        elif app.config['SENDFILE_OFFLOAD'] == 'x-accel-redirect':
+            # nginx丢弃这个空响应体，改为从internal location发送文件（Range也由nginx处理）
+            response = Response(mimetype='application/octet-stream')
+            response.headers['X-Accel-Redirect'] = (app.config['ACCEL_REDIRECT_PREFIX'].rstrip('/')
+                                                    + '/' + encrypted_filename)
+            response.headers['Content-Disposition'] = f'attachment; filename="{encrypted_filename}"'
+        else:
+            # 绝对路径：send_file会把相对路径拼到app.root_path上，X-Sendfile头也需要绝对路径
+            response = send_file(file_path.resolve(), mimetype='application/octet-stream',
+                                 as_attachment=True, download_name=encrypted_filename, conditional=True)
+    response.headers[crypto_stream.FORMAT_HEADER] = crypto_stream.FORMAT
+    return response
+
+# 删除文件API端点：只有文件的上传者和管理员可以删除；配额之前上传、没有记录上传者的文件只有管理员可以删除
+# 持有与写入相同的文件锁删除文件和索引行，用量计数器在同一个事务中减少
+@app.route('/api/files/<filename>', methods=['DELETE'])
+@token_required
+def api_delete_file(current_user, filename):
+    safe_filename = secure_filename(filename)
+    if not safe_filename or safe_filename != filename:
+        return jsonify({'message': 'Invalid filename'}), 400
+    encrypted_filename = safe_filename + '.enc'
+    file_path = Path(app.config['UPLOAD_FOLDER']) / encrypted_filename
+    with timing.phase('lookup'):
+        path_ok = is_safe_path(app.config['UPLOAD_FOLDER'], encrypted_filename)
+        row = file_index.get(safe_filename) if path_ok else None
+    if not path_ok:
+        return jsonify({'message': 'Invalid file path'}), 400
+
+    is_admin = users.get(current_user.username, {}).get('is_admin')
+    if not is_admin and (row is None or row['owner'] != current_user.id):
+        # 不区分文件不存在和无权删除，不泄露其他用户的文件名
+        return jsonify({'message': 'File not found'}), 404
+    with timing.phase('io_write'):
+        with file_lock(file_path):
+            current = file_index.get(safe_filename)
+            try:
+                freed = file_path.stat().st_size
+                os.unlink(file_path)
+            except FileNotFoundError:
+                freed = None
+            # 打包存储的对象只删除索引行（同名的.enc文件是被取代的旧版本，一并删除），段中的记录由压缩回收
+            if current is not None and current['segment'] is not None:
+                freed = current['segment_length']
+            file_index.remove(safe_filename)
+        fsync_directory(file_path.parent)
+    if download_cache is not None:
+        download_cache.discard(str(file_path))
+    maybe_compact()
+    if freed is None:
+        return jsonify({'message': 'File not found'}), 404
+    logger.info('file deleted', extra={'file': safe_filename, 'user': current_user.username, 'bytes': freed})
+    return jsonify({'message': f'File {safe_filename} deleted', 'success': True, 'freed': freed})
+
+# 配额查询API端点：当前用户的用量、预留、上限和剩余空间（字节，quota为null表示不限制）
+@app.route('/api/quota', methods=['GET'])
+@token_required
+def api_quota(current_user):
+    with timing.phase('lookup'):
+        used, files, reserved = file_index.usage(current_user.id)
+    limit = quota.limit_for(current_user.username)
+    return jsonify({
+        'user': current_user.username,
+        'used': used,
+        'files': files,
+        'reserved': reserved,
+        'quota': limit,
+        'remaining': max(0, limit - used - reserved) if limit is not None else None,
+    })
+
+# 打包下载API端点：按文件名列表或前缀选择文件，以ZIP流式返回
+# 每个文件按块解密后直接写入压缩包输出流，不写临时文件、不缓存整个文件，多GB的打包也只占用固定内存
+# GET  /api/archive?name=a.txt&name=b.txt 或 /api/archive?prefix=report-
+# POST /api/archive  {"names": [...]} 或 {"prefix": "..."}；可选 compression=stored|deflate
+MAX_ARCHIVE_FILES = 10000
+
+@app.route('/api/archive', methods=['GET', 'POST'])
+@token_required
+def api_download_archive(current_user):
+    if request.method == 'POST':
+        data = request.get_json(silent=True) or {}
+        names = data.get('names') or []
+        prefix = data.get('prefix')
+        compression = data.get('compression', 'stored')
+    else:
+        names = request.args.getlist('name')
+        prefix = request.args.get('prefix')
+        compression = request.args.get('compression', 'stored')
+    if compression not in zip_stream.COMPRESSION:
+        return jsonify({'message': 'compression must be stored or deflate'}), 400
+    if not isinstance(names, list) or bool(names) == (prefix is not None):
+        return jsonify({'message': 'Give either a list of names or a prefix'}), 400
+
+    upload_folder = Path(app.config['UPLOAD_FOLDER'])
+    entries = []
+    with timing.phase('lookup'):
+        if names:
+            # 显式列出的文件必须全部存在且合法，开始输出之前就返回错误
+            invalid = [n for n in names if not isinstance(n, str) or secure_filename(n) != n
+                       or not is_safe_path(app.config['UPLOAD_FOLDER'], n + '.enc')]
+            if invalid:
+                return jsonify({'message': 'Invalid filename', 'files': invalid}), 400
+            # 打包存储的对象从段文件中读取（packstore.PackedObject），其余的读取.enc文件
+            sources = {}
+            for n in dict.fromkeys(names):
+                row = file_index.packed(n)
+                sources[n] = packstore.PackedObject(pack_store, n, row) if row is not None else upload_folder / (n + '.enc')
+            missing = [n for n, source in sources.items() if isinstance(source, Path) and not source.is_file()]
+            if missing:
+                return jsonify({'message': 'File not found', 'files': missing}), 404
+            entries = list(sources.items())
+        else:
+            # 前缀匹配：与文件列表接口一样，看 *.enc 文件和打包存储的对象
+            packed = {n: row for n, row in file_index.packed_objects().items() if n.startswith(prefix)}
+            entries = sorted([(p.name[:-len('.enc')], p) for p in upload_folder.glob('*.enc')
+                              if p.name.startswith(prefix) and p.name[:-len('.enc')] not in packed and p.is_file()]
+                             + [(n, packstore.PackedObject(pack_store, n, row)) for n, row in packed.items()],
+                             key=lambda entry: entry[0])
+            if not entries:
+                return jsonify({'message': 'No files match the prefix'}), 404
+        if len(entries) > MAX_ARCHIVE_FILES:
+            return jsonify({'message': f'At most {MAX_ARCHIVE_FILES} files per archive'}), 400
+        # 长度不合法的密文文件在开始输出之前就报错，输出开始后只能中断连接
+        try:
+            for _, source in entries:
+                zip_stream.check_stored(source)
+        except (OSError, ValueError) as e:
+            return jsonify({'message': f'Cannot read file: {e}'}), 500
+
+    logger.info('archive download', extra={'files': len(entries), 'compression': compression})
+    stream = zip_stream.stream_zip(entries, get_encryption_key(), compression, __name__, logger)
+    return Response(stream, mimetype='application/zip', headers={
+        'Content-Disposition': 'attachment; filename="files.zip"',
+    })
+
+# 管理员采样分析API端点：在当前进程中按固定频率采样所有线程的调用栈，持续seconds秒
+# 返回collapsed格式（可直接交给flamegraph.pl/speedscope），format=json时返回热点函数汇总
+# 多进程（serve.py）部署时只分析处理本次请求的那个worker进程
+@app.route('/api/admin/profile', methods=['GET'])
+@token_required
+def api_admin_profile(current_user):
+    # 只有管理员可以使用，采样期间会额外占用CPU
+    if not users.get(current_user.username, {}).get('is_admin'):
+        return jsonify({'message': 'Admin privileges required'}), 403
+
+    try:
+        seconds = float(request.args.get('seconds', 5))
+        interval = float(request.args.get('interval', sampler.DEFAULT_INTERVAL))
+    except ValueError:
+        return jsonify({'message': 'seconds and interval must be numbers'}), 400
+    if not 0 < seconds <= sampler.MAX_SECONDS or not 0.001 <= interval <= 1:
+        return jsonify({'message': f'seconds must be in (0, {sampler.MAX_SECONDS:g}], '
+                                   'interval in [0.001, 1]'}), 400
+    output = request.args.get('format', 'collapsed')
+    if output not in ('collapsed', 'json'):
+        return jsonify({'message': 'format must be collapsed or json'}), 400
+
+    # 同一进程同时只允许一个采样任务
+    try:
+        stacks = sampler.profile(seconds, interval=interval)
+    except sampler.ProfilerBusy as e:
+        return jsonify({'message': str(e)}), 409
+    logger.info('profile taken', extra={'user': current_user.username, 'seconds': seconds,
+                                        'samples': stacks.samples})
+
+    if output == 'json':
+        return jsonify(sampler.summary(stacks))
+    return app.response_class(sampler.collapsed(stacks), mimetype='text/plain')
+
 # 应用程序入口点
 if __name__ == '__main__':
     # 解析命令行参数，允许自定义主机和端口
+    # 默认值来自FLASK_RUN_HOST/FLASK_RUN_PORT环境变量（start_multiple_servers.py通过它们分配端口），
+    # 与serve.py使用同一套配置来源
     import argparse
     parser = argparse.ArgumentParser()
     # 添加--host参数，默认为127.0.0.1（本地回环地址）
-    parser.add_argument('--host', default='127.0.0.1', help='Host to run the server on')
+    parser.add_argument('--host', default=os.environ.get('FLASK_RUN_HOST', '127.0.0.1'),
+                        help='Host to run the server on')
     # 添加--port参数，默认为5000
-    parser.add_argument('--port', type=int, default=5000, help='Port to run the server on')
+    parser.add_argument('--port', type=int, default=int(os.environ.get('FLASK_RUN_PORT', 5000)),
+                        help='Port to run the server on')
     # 解析命令行参数
     args = parser.parse_args()
     
     # 警告：生产环境中debug应设为False
-    # 生产部署应使用专业的WSGI服务器（如Gunicorn、uWSGI）
+    # 生产部署请使用 python serve.py app --workers N（预派生多进程模式）
     app.run(debug=True, host=args.host, port=args.port)
\ No newline at end of file
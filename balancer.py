@@ -0,0 +1,513 @@
+"""
+Least-connections reverse proxy for duplicate portal instances.
+
+start_multiple_servers.py launches app.py twice (ports 5000 and 5004), but
+nothing spreads traffic across the copies. This is a small asyncio HTTP/1.1
+proxy that does:
+
+- least-connections balancing over the healthy backends of one variant
+- active health checks (GET /) plus passive ejection on connect errors
+- pooled keep-alive connections to the upstreams
+- streaming pass-through of request and response bodies (Content-Length,
+  chunked and read-until-close), nothing is buffered in full
+- per-backend latency stats at /__balancer/stats
+- request tracing: with --trace-dir (or PORTAL_TRACE_DIR) every request gets
+  a ``proxy`` span with connect/upstream/relay children, and the trace ID is
+  passed upstream in X-Trace-Id / X-Parent-Span-Id (see tracing.py)
+
+Usage:
+    python balancer.py --variant app --port 8000
+    python balancer.py --backend 127.0.0.1:5000 --backend 127.0.0.1:5004
+"""
+
+import argparse
+import asyncio
+import json
+import time
+from collections import deque
+from pathlib import Path
+
+import tracing
+from start_multiple_servers import SERVERS
+
+STATS_PATH = '/__balancer/stats'
+MAX_HEADER_BYTES = 64 * 1024
+COPY_CHUNK = 64 * 1024
+# Pooled upstream connections idle for longer than this are not reused
+POOL_IDLE_TIMEOUT = 30.0
+POOL_MAX_IDLE = 32
+HEALTH_INTERVAL = 2.0
+HEALTH_TIMEOUT = 1.0
+UPSTREAM_CONNECT_TIMEOUT = 2.0
+# Hop-by-hop headers are never forwarded (RFC 7230, section 6.1)
+HOP_BY_HOP = {'connection', 'keep-alive', 'proxy-connection', 'te', 'trailer', 'upgrade', 'expect'}
+# Replaced by the IDs of the proxy's own spans before forwarding, when tracing
+TRACE_HEADERS = {tracing.TRACE_HEADER.lower(), tracing.PARENT_HEADER.lower()}
+
+
+class BadRequest(Exception):
+    pass
+
+
+class UpstreamError(Exception):
+    pass
+
+
+class LatencyStats:
+    """Rolling latency figures for one backend."""
+
+    def __init__(self, window=1024):
+        self.samples = deque(maxlen=window)
+        self.count = 0
+        self.total = 0.0
+        self.ewma = None
+
+    def add(self, seconds):
+        self.samples.append(seconds)
+        self.count += 1
+        self.total += seconds
+        self.ewma = seconds if self.ewma is None else 0.8 * self.ewma + 0.2 * seconds
+
+    def percentile(self, q):
+        if not self.samples:
+            return None
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+    def as_dict(self):
+        def ms(value):
+            return None if value is None else round(value * 1000, 3)
+        return {
+            'count': self.count,
+            'mean_ms': ms(self.total / self.count) if self.count else None,
+            'ewma_ms': ms(self.ewma),
+            'p50_ms': ms(self.percentile(0.50)),
+            'p95_ms': ms(self.percentile(0.95)),
+            'p99_ms': ms(self.percentile(0.99)),
+        }
+
+
+class Backend:
+    """One upstream instance with its connection pool and counters."""
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.active = 0
+        self.healthy = True
+        self.errors = 0
+        self.idle = deque()  # (reader, writer, idle_since)
+        self.latency = LatencyStats()       # time to response head
+        self.total_latency = LatencyStats()  # time to last response byte
+
+    @property
+    def name(self):
+        return f'{self.host}:{self.port}'
+
+    async def acquire(self):
+        """Return a (reader, writer, reused) upstream connection."""
+        now = time.monotonic()
+        while self.idle:
+            reader, writer, since = self.idle.pop()
+            if now - since < POOL_IDLE_TIMEOUT and not reader.at_eof() and not writer.is_closing():
+                return reader, writer, True
+            writer.close()
+        try:
+            reader, writer = await asyncio.wait_for(
+                asyncio.open_connection(self.host, self.port), UPSTREAM_CONNECT_TIMEOUT)
+        except (OSError, asyncio.TimeoutError) as e:
+            self.errors += 1
+            self.healthy = False
+            error = UpstreamError(f'cannot connect to {self.name}: {e}')
+            error.connect_failed = True
+            raise error from e
+        return reader, writer, False
+
+    def release(self, reader, writer, reusable):
+        if reusable and len(self.idle) < POOL_MAX_IDLE and not writer.is_closing():
+            self.idle.append((reader, writer, time.monotonic()))
+        else:
+            writer.close()
+
+    def as_dict(self):
+        return {
+            'backend': self.name,
+            'healthy': self.healthy,
+            'active': self.active,
+            'idle_connections': len(self.idle),
+            'errors': self.errors,
+            'latency': self.latency.as_dict(),
+            'total_latency': self.total_latency.as_dict(),
+        }
+
+
+class LeastConnectionsPool:
+    """Picks the healthy backend with the fewest in-flight requests."""
+
+    def __init__(self, backends):
+        self.backends = backends
+        self._next = 0
+
+    def choose(self, exclude=()):
+        candidates = [b for b in self.backends if b.healthy and b not in exclude]
+        if not candidates:
+            return None
+        fewest = min(b.active for b in candidates)
+        tied = [b for b in candidates if b.active == fewest]
+        # Rotate among ties so an idle fleet still spreads load
+        self._next = (self._next + 1) % len(tied)
+        return tied[self._next]
+
+    async def health_check(self, backend):
+        try:
+            reader, writer = await asyncio.wait_for(
+                asyncio.open_connection(backend.host, backend.port), HEALTH_TIMEOUT)
+            writer.write(f'GET / HTTP/1.1\r\nHost: {backend.name}\r\nConnection: close\r\n\r\n'.encode())
+            await writer.drain()
+            status_line = await asyncio.wait_for(reader.readline(), HEALTH_TIMEOUT)
+            writer.close()
+            parts = status_line.split()
+            backend.healthy = len(parts) >= 2 and parts[1].isdigit() and int(parts[1]) < 500
+        except (OSError, asyncio.TimeoutError):
+            backend.healthy = False
+
+    async def health_loop(self):
+        while True:
+            await asyncio.gather(*(self.health_check(b) for b in self.backends))
+            await asyncio.sleep(HEALTH_INTERVAL)
+
+
+async def read_head(reader):
+    """Read an HTTP message head; returns (start_line, [(name, value)]) or None at EOF."""
+    try:
+        raw = await reader.readuntil(b'\r\n\r\n')
+    except asyncio.IncompleteReadError as e:
+        if not e.partial.strip():
+            return None
+        raise BadRequest('truncated message head')
+    except asyncio.LimitOverrunError:
+        raise BadRequest('message head too large')
+    lines = raw[:-4].decode('latin-1').split('\r\n')
+    headers = []
+    for line in lines[1:]:
+        name, sep, value = line.partition(':')
+        if not sep:
+            raise BadRequest(f'malformed header line: {line!r}')
+        headers.append((name.strip(), value.strip()))
+    return lines[0], headers
+
+
+def header(headers, name, default=None):
+    name = name.lower()
+    for key, value in headers:
+        if key.lower() == name:
+            return value
+    return default
+
+
+def body_framing(headers):
+    """Return ('chunked', None), ('length', n) or ('none', None)."""
+    te = header(headers, 'Transfer-Encoding')
+    if te is not None and 'chunked' in te.lower():
+        return 'chunked', None
+    length = header(headers, 'Content-Length')
+    if length is not None:
+        if not length.isdigit():
+            raise BadRequest('invalid Content-Length')
+        return 'length', int(length)
+    return 'none', None
+
+
+def serialize_head(start_line, headers):
+    lines = [start_line] + [f'{k}: {v}' for k, v in headers]
+    return ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1')
+
+
+async def copy_exact(reader, writer, remaining):
+    while remaining:
+        chunk = await reader.read(min(COPY_CHUNK, remaining))
+        if not chunk:
+            raise UpstreamError('connection closed mid-body')
+        writer.write(chunk)
+        await writer.drain()
+        remaining -= len(chunk)
+
+
+async def copy_chunked(reader, writer):
+    """Relay a chunked body as-is, stopping after the terminating chunk."""
+    while True:
+        size_line = await reader.readline()
+        if not size_line:
+            raise UpstreamError('connection closed mid-chunk')
+        writer.write(size_line)
+        size = int(size_line.split(b';', 1)[0].strip() or b'0', 16)
+        if size == 0:
+            # Trailer section ends with an empty line
+            while True:
+                line = await reader.readline()
+                writer.write(line)
+                if line in (b'\r\n', b'\n', b''):
+                    break
+            await writer.drain()
+            return
+        await copy_exact(reader, writer, size + 2)  # data + CRLF
+
+
+async def copy_until_eof(reader, writer):
+    while True:
+        chunk = await reader.read(COPY_CHUNK)
+        if not chunk:
+            return
+        writer.write(chunk)
+        await writer.drain()
+
+
+class Balancer:
+    """The proxy itself: one instance per listening port."""
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.started = time.time()
+        self.requests = 0
+        self.failures = 0
+
+    def stats(self):
+        return {
+            'uptime_seconds': round(time.time() - self.started, 1),
+            'requests': self.requests,
+            'failures': self.failures,
+            'backends': [b.as_dict() for b in self.pool.backends],
+        }
+
+    async def send_simple(self, writer, status, payload, keep_alive=True):
+        body = json.dumps(payload).encode()
+        head = serialize_head(f'HTTP/1.1 {status}', [
+            ('Content-Type', 'application/json'),
+            ('Content-Length', str(len(body))),
+            ('Connection', 'keep-alive' if keep_alive else 'close'),
+        ])
+        writer.write(head + body)
+        await writer.drain()
+
+    async def handle_client(self, reader, writer):
+        peer = writer.get_extra_info('peername')
+        client_ip = peer[0] if peer else 'unknown'
+        try:
+            while True:
+                try:
+                    head = await read_head(reader)
+                except BadRequest as e:
+                    await self.send_simple(writer, '400 Bad Request', {'message': str(e)}, keep_alive=False)
+                    break
+                if head is None:
+                    break
+                keep_alive = await self.proxy_one(head, reader, writer, client_ip)
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def proxy_one(self, head, client_reader, client_writer, client_ip):
+        """Forward one request; returns whether the client connection stays open."""
+        start_line, headers = head
+        try:
+            method, target, version = start_line.split(' ', 2)
+        except ValueError:
+            await self.send_simple(client_writer, '400 Bad Request', {'message': 'bad request line'}, False)
+            return False
+
+        connection = (header(headers, 'Connection') or '').lower()
+        client_keep_alive = 'close' not in connection and (version == 'HTTP/1.1' or 'keep-alive' in connection)
+
+        if target == STATS_PATH:
+            await self.send_simple(client_writer, '200 OK', self.stats(), client_keep_alive)
+            return client_keep_alive
+
+        self.requests += 1
+        # Continue the client's trace if it sent one; the app's request span
+        # becomes a child of this one through the headers added below
+        trace = tracing.start_trace('proxy', header(headers, tracing.TRACE_HEADER),
+                                    header(headers, tracing.PARENT_HEADER), method=method, target=target)
+        with trace:
+            return await self.forward(method, target, headers, client_reader, client_writer,
+                                      client_ip, client_keep_alive)
+
+    async def forward(self, method, target, headers, client_reader, client_writer,
+                      client_ip, client_keep_alive):
+        try:
+            framing, length = body_framing(headers)
+        except BadRequest as e:
+            await self.send_simple(client_writer, '400 Bad Request', {'message': str(e)}, False)
+            return False
+        has_body = framing == 'chunked' or (framing == 'length' and length > 0)
+
+        if 'continue' in (header(headers, 'Expect') or '').lower():
+            # Answer 100-continue ourselves, the body is streamed straight through
+            client_writer.write(b'HTTP/1.1 100 Continue\r\n\r\n')
+            await client_writer.drain()
+
+        # When tracing, each attempt adds its own span's IDs (see exchange)
+        dropped = HOP_BY_HOP | TRACE_HEADERS if tracing.current().trace_id else HOP_BY_HOP
+        upstream_headers = [(k, v) for k, v in headers if k.lower() not in dropped]
+        forwarded = header(headers, 'X-Forwarded-For')
+        upstream_headers.append(('X-Forwarded-For', f'{forwarded}, {client_ip}' if forwarded else client_ip))
+        upstream_headers.append(('Connection', 'keep-alive'))
+
+        tried = []
+        while True:
+            backend = self.pool.choose(exclude=tried)
+            if backend is None:
+                self.failures += 1
+                tracing.current().set(status=503)
+                await self.send_simple(client_writer, '503 Service Unavailable',
+                                       {'message': 'No healthy backend available'}, client_keep_alive)
+                return client_keep_alive
+            tried.append(backend)
+            backend.active += 1
+            try:
+                return await self.exchange(backend, method, target, upstream_headers, framing, length,
+                                           client_reader, client_writer, client_keep_alive, has_body)
+            except UpstreamError as e:
+                # Retrying is only safe while nothing of the body has been consumed
+                if getattr(e, 'connect_failed', False):
+                    continue
+                if getattr(e, 'stale', False) and not has_body:
+                    # A pooled connection the backend had already closed says
+                    # nothing about its health: try it again on a fresh one
+                    tried.remove(backend)
+                    continue
+                if has_body or getattr(e, 'response_started', False):
+                    self.failures += 1
+                    tracing.current().set(status=502, error=str(e))
+                    if not getattr(e, 'response_started', False):
+                        await self.send_simple(client_writer, '502 Bad Gateway',
+                                               {'message': str(e)}, False)
+                    return False
+            finally:
+                backend.active -= 1
+
+    async def exchange(self, backend, method, target, upstream_headers, framing, length,
+                       client_reader, client_writer, client_keep_alive, has_body):
+        started = time.perf_counter()
+        with tracing.span('connect', backend=backend.name) as connect:
+            up_reader, up_writer, reused = await backend.acquire()
+            connect.set(reused=reused)
+        try:
+            # Sending the request and waiting for the response head
+            with tracing.span('upstream', backend=backend.name) as upstream:
+                up_writer.write(serialize_head(f'{method} {target} HTTP/1.1',
+                                               upstream_headers + upstream.headers()))
+                if framing == 'length' and length:
+                    await copy_exact(client_reader, up_writer, length)
+                elif framing == 'chunked':
+                    await copy_chunked(client_reader, up_writer)
+                await up_writer.drain()
+
+                response = await read_head(up_reader)
+            if response is None:
+                error = UpstreamError(f'{backend.name} closed the connection')
+                error.stale = reused
+                raise error
+        except (ConnectionError, BadRequest, asyncio.IncompleteReadError) as e:
+            up_writer.close()
+            error = UpstreamError(f'{backend.name}: {e}')
+            error.stale = reused and isinstance(e, ConnectionError)
+            if not error.stale:
+                backend.errors += 1
+            raise error from e
+        except UpstreamError:
+            up_writer.close()
+            raise
+        backend.latency.add(time.perf_counter() - started)
+
+        status_line, resp_headers = response
+        parts = status_line.split(' ', 2)
+        status = int(parts[1]) if len(parts) > 1 and parts[1].isdigit() else 502
+        upstream_close = 'close' in (header(resp_headers, 'Connection') or '').lower() \
+            or parts[0] == 'HTTP/1.0'
+
+        no_body = method == 'HEAD' or status in (204, 304) or 100 <= status < 200
+        framing_out, length_out = ('length', 0) if no_body else body_framing(resp_headers)
+        # A body delimited by EOF cannot be followed by another response
+        keep_client = client_keep_alive and framing_out != 'none'
+
+        trace = tracing.current()
+        trace.set(backend=backend.name, status=status)
+        out_headers = [(k, v) for k, v in resp_headers if k.lower() not in HOP_BY_HOP]
+        if trace.trace_id and header(resp_headers, tracing.TRACE_HEADER) is None:
+            out_headers.append((tracing.TRACE_HEADER, trace.trace_id))
+        out_headers.append(('Connection', 'keep-alive' if keep_client else 'close'))
+        client_writer.write(serialize_head(status_line, out_headers))
+
+        try:
+            with tracing.span('relay', backend=backend.name):
+                if framing_out == 'length':
+                    await copy_exact(up_reader, client_writer, length_out)
+                elif framing_out == 'chunked':
+                    await copy_chunked(up_reader, client_writer)
+                else:
+                    await copy_until_eof(up_reader, client_writer)
+                    upstream_close = True
+                await client_writer.drain()
+        except (ConnectionError, UpstreamError) as e:
+            up_writer.close()
+            error = UpstreamError(f'{backend.name}: {e}')
+            error.response_started = True
+            raise error from e
+
+        backend.total_latency.add(time.perf_counter() - started)
+        backend.release(up_reader, up_writer, reusable=not upstream_close)
+        return keep_client
+
+
+def backends_for_variant(variant):
+    """Backends of one variant, from the start_multiple_servers.py table."""
+    return [Backend('127.0.0.1', port) for script, port in SERVERS if Path(script).stem == variant]
+
+
+def parse_backend(value):
+    host, sep, port = value.rpartition(':')
+    if not sep or not port.isdigit():
+        raise argparse.ArgumentTypeError(f'expected HOST:PORT, got {value!r}')
+    return Backend(host or '127.0.0.1', int(port))
+
+
+async def serve(balancer, host, port):
+    server = await asyncio.start_server(balancer.handle_client, host, port, limit=MAX_HEADER_BYTES)
+    names = ', '.join(b.name for b in balancer.pool.backends)
+    print(f"Balancing http://{host}:{port} across {names} (stats at {STATS_PATH})")
+    health = asyncio.create_task(balancer.pool.health_loop())
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        health.cancel()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Least-connections reverse proxy for portal instances')
+    parser.add_argument('--variant', default='app',
+                        help='Module whose instances from start_multiple_servers.py are balanced (default: app)')
+    parser.add_argument('--backend', action='append', type=parse_backend, default=None,
+                        help='Explicit HOST:PORT backend, may be repeated (overrides --variant)')
+    parser.add_argument('--host', default='127.0.0.1', help='Address to listen on')
+    parser.add_argument('--port', type=int, default=8000, help='Port to listen on')
+    parser.add_argument('--trace-dir', default=tracing.TRACE_DIR,
+                        help='Write request spans to this directory (default: $PORTAL_TRACE_DIR, off)')
+    args = parser.parse_args(argv)
+    tracing.configure(args.trace_dir, service='balancer')
+
+    backends = args.backend or backends_for_variant(args.variant)
+    if not backends:
+        parser.error(f'no instances of {args.variant!r} in start_multiple_servers.SERVERS')
+
+    try:
+        asyncio.run(serve(Balancer(LeastConnectionsPool(backends)), args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,227 @@
+"""
+Throughput benchmark for the encrypt_file/decrypt_file copies of each module.
+
+Every portal module carries its own encrypt_file/decrypt_file pair (AES-256,
+CBC with an IV prefix, or ECB in vuln_ecb_mode.py), and each of them reads
+the key file on every call. This script imports each module, calls its
+functions on random payloads from 16 B to 16 MB and reports:
+
+- MB/s and median per-call latency (wall clock, repeated until --min-time),
+- peak memory allocated during one call (tracemalloc), also as a multiple of
+  the payload size.
+
+Two reference rows, ``raw-cbc`` and ``raw-ecb``, call pycryptodome directly
+with a key held in memory, so the cost of the key file and of the extra
+copies in each variant is visible.
+
+Results can be written as JSON with ``--json`` and compared against an
+earlier run with ``--compare``, which exits with status 1 when throughput
+drops by more than ``--threshold``.
+
+Usage:
+    python bench_crypto.py
+    python bench_crypto.py --modules app vuln_ecb_mode --sizes 1K 1M
+    python bench_crypto.py --json bench.json
+    python bench_crypto.py --compare bench.json --threshold 0.2
+"""
+
+import argparse
+import contextlib
+import importlib
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+import tracemalloc
+
+from Crypto.Cipher import AES
+from Crypto.Random import get_random_bytes
+from Crypto.Util.Padding import pad, unpad
+
+import startup
+from sizes import UNITS, format_size, parse_size
+
+# Module name -> cipher mode of its encrypt_file/decrypt_file
+VARIANTS = {
+    'app': 'CBC',
+    'secure_app': 'CBC',
+    'vuln_unauth': 'CBC',
+    'vuln_dir_traversal': 'CBC',
+    'vuln_ecb_mode': 'ECB',
+}
+
+DEFAULT_SIZES = ['16', '256', '4K', '64K', '1M', '16M']
+
+def raw_functions(mode):
+    """encrypt/decrypt pair with the key in memory, for reference."""
+    key = get_random_bytes(32)
+    if mode == 'CBC':
+        def encrypt(data):
+            cipher = AES.new(key, AES.MODE_CBC)
+            return cipher.iv + cipher.encrypt(pad(data, AES.block_size))
+
+        def decrypt(data):
+            cipher = AES.new(key, AES.MODE_CBC, iv=data[:16])
+            return unpad(cipher.decrypt(data[16:]), AES.block_size)
+    else:
+        def encrypt(data):
+            return AES.new(key, AES.MODE_ECB).encrypt(pad(data, AES.block_size))
+
+        def decrypt(data):
+            return unpad(AES.new(key, AES.MODE_ECB).decrypt(data), AES.block_size)
+    return encrypt, decrypt
+
+
+def load_variants(names):
+    """[(label, mode, encrypt, decrypt)] for the requested modules plus raw references."""
+    variants = []
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        for name in names:
+            module = importlib.import_module(name)
+            variants.append((name, VARIANTS[name], module.encrypt_file, module.decrypt_file))
+        startup.initialize_all()
+    for mode in ('CBC', 'ECB'):
+        variants.append((f'raw-{mode.lower()}', mode, *raw_functions(mode)))
+    return variants
+
+
+def time_calls(func, arg, min_time, min_calls=3):
+    """Per-call wall-clock seconds, calling until both minimums are met."""
+    samples = []
+    deadline = time.perf_counter() + min_time
+    while len(samples) < min_calls or time.perf_counter() < deadline:
+        started = time.perf_counter()
+        func(arg)
+        samples.append(time.perf_counter() - started)
+    return samples
+
+
+def peak_allocation(func, arg):
+    """Peak bytes allocated by Python while making one call."""
+    tracemalloc.start()
+    try:
+        tracemalloc.reset_peak()
+        baseline = tracemalloc.get_traced_memory()[0]
+        func(arg)
+        return tracemalloc.get_traced_memory()[1] - baseline
+    finally:
+        tracemalloc.stop()
+
+
+def bench_one(label, mode, encrypt, decrypt, size, min_time):
+    payload = os.urandom(size)
+    ciphertext = encrypt(payload)
+    if decrypt(ciphertext) != payload:
+        raise AssertionError(f'{label}: round trip failed at {size} bytes')
+
+    results = []
+    for op, func, arg in (('encrypt', encrypt, payload), ('decrypt', decrypt, ciphertext)):
+        samples = time_calls(func, arg, min_time)
+        median = statistics.median(samples)
+        ordered = sorted(samples)
+        peak = peak_allocation(func, arg)
+        results.append({
+            'variant': label,
+            'mode': mode,
+            'op': op,
+            'size': size,
+            'calls': len(samples),
+            'median_seconds': median,
+            'p95_seconds': ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))],
+            'mb_per_second': size / median / 1e6,
+            'peak_alloc_bytes': peak,
+            'alloc_ratio': peak / size,
+        })
+    return results
+
+
+def run(names, sizes, min_time):
+    rows = []
+    with open(os.devnull, 'w') as devnull:
+        for label, mode, encrypt, decrypt in load_variants(names):
+            for size in sizes:
+                # The module copies print on every key load; keep that off the table
+                with contextlib.redirect_stdout(devnull):
+                    rows.extend(bench_one(label, mode, encrypt, decrypt, size, min_time))
+            print(f'  measured {label}', file=sys.stderr)
+    return rows
+
+
+def format_bytes(count):
+    if count >= UNITS['M']:
+        return f"{count / UNITS['M']:.1f}M"
+    if count >= UNITS['K']:
+        return f"{count / UNITS['K']:.1f}K"
+    return str(count)
+
+
+def format_latency(seconds):
+    if seconds < 1e-3:
+        return f'{seconds * 1e6:8.1f} us'
+    return f'{seconds * 1e3:8.2f} ms'
+
+
+def print_table(rows):
+    print(f"{'variant':<20} {'mode':<4} {'op':<8} {'size':>6} {'MB/s':>9} {'latency':>11} "
+          f"{'peak alloc':>11} {'x size':>7}")
+    for row in rows:
+        print(f"{row['variant']:<20} {row['mode']:<4} {row['op']:<8} {format_size(row['size']):>6} "
+              f"{row['mb_per_second']:>9.1f} {format_latency(row['median_seconds']):>11} "
+              f"{format_bytes(row['peak_alloc_bytes']):>11} "
+              f"{row['alloc_ratio']:>7.1f}")
+
+
+def compare(rows, baseline_path, threshold):
+    """Rows whose MB/s fell more than ``threshold`` below the baseline file."""
+    with open(baseline_path) as f:
+        baseline = {(r['variant'], r['op'], r['size']): r for r in json.load(f)['results']}
+    regressions = []
+    for row in rows:
+        old = baseline.get((row['variant'], row['op'], row['size']))
+        if old and row['mb_per_second'] < old['mb_per_second'] * (1 - threshold):
+            regressions.append((row, old))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark encrypt_file/decrypt_file of each module')
+    parser.add_argument('--modules', nargs='+', choices=list(VARIANTS), default=list(VARIANTS))
+    parser.add_argument('--sizes', nargs='+', default=DEFAULT_SIZES,
+                        help='Payload sizes, e.g. 16 4K 1M (default: 16 B to 16 MB)')
+    parser.add_argument('--min-time', type=float, default=0.2,
+                        help='Seconds to keep calling each function per size')
+    parser.add_argument('--json', metavar='PATH', help='Also write the results to PATH as JSON')
+    parser.add_argument('--compare', metavar='PATH', help='Baseline JSON from an earlier --json run')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='Allowed MB/s drop against --compare before failing (fraction)')
+    args = parser.parse_args(argv)
+
+    sizes = [parse_size(s) for s in args.sizes]
+    rows = run(args.modules, sizes, args.min_time)
+    print_table(rows)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({
+                'python': platform.python_version(),
+                'machine': platform.machine(),
+                'cpus': os.cpu_count(),
+                'results': rows,
+            }, f, indent=2)
+        print(f'\nWrote {len(rows)} results to {args.json}')
+
+    if args.compare:
+        regressions = compare(rows, args.compare, args.threshold)
+        for row, old in regressions:
+            print(f"REGRESSION {row['variant']} {row['op']} {format_size(row['size'])}: "
+                  f"{row['mb_per_second']:.1f} MB/s, baseline {old['mb_per_second']:.1f} MB/s")
+        if regressions:
+            return 1
+        print(f'OK: no throughput drop above {args.threshold:.0%} against {args.compare}')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
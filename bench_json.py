@@ -0,0 +1,203 @@
+"""
+Serialization and transfer time of a large ``/api/files`` listing.
+
+Builds a listing of ``--entries`` files shaped like the one api_list_files
+returns and measures, for the stdlib and the orjson JSON provider
+(json_provider.py):
+
+- serialize: ``jsonify`` of the listing, best of ``--repeat`` runs;
+- compress: gzip (and br when the brotli package is installed) of the
+  body at the levels compression.py uses;
+- transfer: body bytes over each ``--link`` speed (Mbit/s), computed, plus
+  the sum of all three as the time until the client has the listing.
+
+With ``--port`` it also requests ``/api/files`` from a running instance
+(e.g. ``python serve.py app``) once per Accept-Encoding and reports the
+measured wall time, bytes received and the server's Server-Timing
+phases. ``--populate DIR`` first creates ``--entries`` empty ``.enc`` files in
+that instance's UPLOAD_FOLDER and removes them afterwards.
+
+Usage:
+    python bench_json.py
+    python bench_json.py --entries 100000 --link 10 100 1000
+    python bench_json.py --port 5000 --populate protected_files --json listing.json
+"""
+
+import argparse
+import gzip
+import http.client
+import json
+import os
+import platform
+import random
+import sys
+import time
+from pathlib import Path
+
+from flask import Flask
+
+import compression
+import json_provider
+
+
+def make_listing(count, seed=0):
+    """``{'files': [...]}`` with ``count`` entries shaped like /api/files."""
+    rng = random.Random(seed)
+    files = []
+    for i in range(count):
+        name = f'report-{i:06d}-{rng.choice(["q1", "q2", "draft", "final"])}.pdf'
+        files.append({'name': name, 'size': rng.randint(32, 64 * 1024 * 1024), 'encrypted_name': name + '.enc'})
+    return {'files': files}
+
+
+def best_of(repeat, func):
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None or elapsed < best else best
+    return best, result
+
+
+def bench_serialize(listing, repeat):
+    rows = []
+    encoders = ['stdlib'] + (['orjson'] if json_provider.orjson is not None else [])
+    for encoder in encoders:
+        app = Flask(__name__)
+        json_provider.init_app(app)
+        app.json.encoder = encoder
+        with app.app_context():
+            seconds, response = best_of(repeat, lambda: app.json.response(listing))
+        rows.append({'encoder': encoder, 'seconds': seconds, 'bytes': len(response.get_data())})
+        body = response.get_data()
+    return rows, body
+
+
+def bench_compress(body, repeat):
+    rows = [{'encoding': 'identity', 'seconds': 0.0, 'bytes': len(body)}]
+    for encoding in compression.supported_encodings():
+        seconds, data = best_of(repeat, lambda: compression.compress(body, encoding))
+        rows.append({'encoding': encoding, 'seconds': seconds, 'bytes': len(data)})
+    return rows
+
+
+def bench_http(host, port, username, password, encodings):
+    connection = http.client.HTTPConnection(host, port, timeout=300)
+
+    def request(method, path, body=None, headers=None):
+        connection.request(method, path, body=body, headers=headers or {})
+        response = connection.getresponse()
+        payload = response.read()
+        if response.getheader('Connection', '').lower() == 'close':
+            connection.close()
+        return response, payload
+
+    response, payload = request('POST', '/api/login', json.dumps({'username': username, 'password': password}),
+                                {'Content-Type': 'application/json'})
+    if response.status != 200:
+        raise SystemExit(f'login failed with status {response.status}: {payload[:200]!r}')
+    auth = {'Authorization': f"Bearer {json.loads(payload)['token']}"}
+
+    rows = []
+    for encoding in encodings:
+        started = time.perf_counter()
+        response, payload = request('GET', '/api/files', headers=dict(auth, **{'Accept-Encoding': encoding}))
+        elapsed = time.perf_counter() - started
+        if response.status != 200:
+            raise SystemExit(f'/api/files failed with status {response.status}')
+        used = response.getheader('Content-Encoding') or 'identity'
+        if used == 'gzip':
+            entries = len(json.loads(gzip.decompress(payload))['files'])
+        elif used == 'br':
+            entries = len(json.loads(compression.brotli.decompress(payload))['files'])
+        else:
+            entries = len(json.loads(payload)['files'])
+        rows.append({'accept_encoding': encoding, 'content_encoding': used, 'seconds': elapsed,
+                     'bytes': len(payload), 'entries': entries,
+                     'server_timing': response.getheader('Server-Timing', '')})
+    return rows
+
+
+def populate(directory, count):
+    directory = Path(directory)
+    paths = [directory / f'bench-json-{i:06d}.bin.enc' for i in range(count)]
+    for path in paths:
+        path.touch()
+    return paths
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark JSON serialization, compression and transfer '
+                                                 'of a large file listing')
+    parser.add_argument('--entries', type=int, default=100000, help='Listing entries (default: 100000)')
+    parser.add_argument('--repeat', type=int, default=5, help='Runs per measurement, best is kept (default: 5)')
+    parser.add_argument('--link', type=float, nargs='+', default=[10, 100, 1000],
+                        help='Link speeds in Mbit/s for the transfer estimate (default: 10 100 1000)')
+    parser.add_argument('--port', type=int, default=None, help='Also request /api/files from an instance on this port')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--username', default='admin')
+    parser.add_argument('--password', default='admin123')
+    parser.add_argument('--populate', metavar='DIR', help='With --port: create --entries files in DIR first')
+    parser.add_argument('--json', metavar='PATH', help='Also write the results to PATH as JSON')
+    args = parser.parse_args(argv)
+
+    listing = make_listing(args.entries)
+    serialize, body = bench_serialize(listing, args.repeat)
+    compress = bench_compress(body, args.repeat)
+
+    print(f'/api/files listing with {args.entries} entries ({len(body) / 1e6:.1f} MB of JSON)')
+    print(f"{'encoder':<10} {'serialize ms':>13}")
+    for row in serialize:
+        print(f"{row['encoder']:<10} {row['seconds'] * 1000:>13.1f}")
+    fastest = min(row['seconds'] for row in serialize)
+
+    print()
+    header = f"{'encoding':<10} {'compress ms':>12} {'bytes':>10} {'ratio':>6}"
+    header += ''.join(f" {f'@{speed:g} Mbit/s':>13}" for speed in args.link)
+    print(header + '   (serialize + compress + transfer, ms)')
+    totals = []
+    for row in compress:
+        line = (f"{row['encoding']:<10} {row['seconds'] * 1000:>12.1f} {row['bytes']:>10} "
+                f"{len(body) / row['bytes']:>5.1f}x")
+        for speed in args.link:
+            transfer = row['bytes'] * 8 / (speed * 1e6)
+            total = fastest + row['seconds'] + transfer
+            totals.append({'encoding': row['encoding'], 'link_mbit': speed, 'transfer_seconds': transfer,
+                           'total_seconds': total})
+            line += f" {total * 1000:>13.0f}"
+        print(line)
+
+    http_rows = None
+    if args.port is not None:
+        created = populate(args.populate, args.entries) if args.populate else []
+        try:
+            http_rows = bench_http(args.host, args.port, args.username, args.password,
+                                   ['identity'] + list(compression.supported_encodings()))
+        finally:
+            for path in created:
+                path.unlink(missing_ok=True)
+        print()
+        print(f'GET /api/files from http://{args.host}:{args.port}')
+        print(f"{'encoding':<10} {'entries':>8} {'bytes':>10} {'wall ms':>9}   server timing")
+        for row in http_rows:
+            print(f"{row['content_encoding']:<10} {row['entries']:>8} {row['bytes']:>10} "
+                  f"{row['seconds'] * 1000:>9.1f}   {row['server_timing']}")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({
+                'python': platform.python_version(),
+                'cpus': os.cpu_count(),
+                'entries': args.entries,
+                'json_bytes': len(body),
+                'serialize': serialize,
+                'compress': compress,
+                'totals': totals,
+                'http': http_rows,
+            }, f, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,158 @@
+"""
+Storage benchmark: small objects as standalone ``.enc`` files vs packed into segments.
+
+Stores ``--count`` objects of ``--size`` bytes of plaintext both ways, in
+batches of ``--batch`` like /api/upload/batch does, and reports for each:
+
+- write time (standalone: atomic_write_many plus recording every file in
+  the metadata index; packed: PackStore.put_many, one append and fsync per
+  batch);
+- files (inodes) and disk blocks used under the folder, index included;
+- time to list every object the way /api/files does (glob and stat, or
+  one index query);
+- time to read ``--reads`` random objects back.
+
+It then overwrites half of the packed objects and times a compaction pass.
+The stored bytes are random data of the encrypted size: this measures the
+storage layer, not the cipher.
+
+Usage:
+    python bench_packstore.py
+    python bench_packstore.py --count 100000 --size 2K --dir /var/tmp --json pack.json
+"""
+
+import argparse
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import crypto_stream
+import metadata
+import packstore
+from sizes import format_size, parse_size
+from storage import atomic_write_many
+
+
+def disk_usage(folder):
+    """``(files, bytes of disk blocks)`` of everything under ``folder``."""
+    files = blocks = 0
+    for root, dirs, names in os.walk(folder):
+        for name in names + dirs:
+            stat = os.lstat(os.path.join(root, name))
+            files += 1
+            blocks += stat.st_blocks
+    return files, blocks * 512
+
+
+def objects(count, size, prefix='obj'):
+    stored = crypto_stream.stored_size(size)
+    return [(f'{prefix}-{i:07d}', os.urandom(stored), '0' * 64, size) for i in range(count)]
+
+
+def bench_standalone(folder, items, batch, names):
+    index = metadata.MetadataIndex(folder)
+    started = time.perf_counter()
+    for start in range(0, len(items), batch):
+        part = items[start:start + batch]
+        written = atomic_write_many([(folder / (name + '.enc'), data) for name, data, _, _ in part])
+        for (name, _, sha256, size), path in zip(part, written):
+            index.record_plaintext(name, os.stat(path), sha256, size, owner=1)
+    write = time.perf_counter() - started
+
+    started = time.perf_counter()
+    listed = [(path.stem, path.stat().st_size) for path in folder.glob('*.enc')]
+    list_seconds = time.perf_counter() - started
+
+    started = time.perf_counter()
+    for name in names:
+        with open(folder / (name + '.enc'), 'rb') as f:
+            f.read()
+    read = time.perf_counter() - started
+    return {'write_seconds': write, 'list_seconds': list_seconds, 'listed': len(listed), 'read_seconds': read}
+
+
+def bench_packed(folder, items, batch, names):
+    store = packstore.PackStore(folder)
+    started = time.perf_counter()
+    for start in range(0, len(items), batch):
+        store.put_many(items[start:start + batch], owner=1)
+    write = time.perf_counter() - started
+
+    started = time.perf_counter()
+    listed = [(name, row['segment_length']) for name, row in store.index.packed_objects().items()]
+    list_seconds = time.perf_counter() - started
+
+    started = time.perf_counter()
+    for name in names:
+        store.read(name)
+    read = time.perf_counter() - started
+    return {'write_seconds': write, 'list_seconds': list_seconds, 'listed': len(listed), 'read_seconds': read}
+
+
+def bench_compaction(folder, items, batch):
+    store = packstore.PackStore(folder)
+    # Overwrite every other object: the segments written first end up half dead
+    store_items = [(name, os.urandom(len(data)), sha256, size) for name, data, sha256, size in items[::2]]
+    for start in range(0, len(store_items), batch):
+        store.put_many(store_items[start:start + batch], owner=1)
+    before = store.stats()
+    started = time.perf_counter()
+    report = store.compact()
+    seconds = time.perf_counter() - started
+    return dict(report, seconds=seconds, bytes_before=before['bytes'], bytes_after=store.stats()['bytes'])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Compare standalone and packed storage of small objects')
+    parser.add_argument('--count', type=int, default=20000, help='Objects to store (default: 20000)')
+    parser.add_argument('--size', default='4K', help='Plaintext bytes per object (default: 4K)')
+    parser.add_argument('--batch', type=int, default=100, help='Objects per write batch (default: 100)')
+    parser.add_argument('--reads', type=int, default=2000, help='Random objects to read back (default: 2000)')
+    parser.add_argument('--dir', help='Where to create the test folders (default: the system temp directory)')
+    parser.add_argument('--json', metavar='PATH', help='Also write the results to PATH as JSON')
+    args = parser.parse_args(argv)
+
+    size = parse_size(args.size)
+    if size > packstore.PACK_MAX_BYTES:
+        print(f'note: app.py would not pack {format_size(size)} objects with '
+              f'PORTAL_PACK_MAX_BYTES={packstore.PACK_MAX_BYTES}', file=sys.stderr)
+    items = objects(args.count, size)
+    names = random.sample([name for name, _, _, _ in items], min(args.reads, len(items)))
+    base = Path(tempfile.mkdtemp(prefix='bench_packstore-', dir=args.dir))
+    results = {'count': args.count, 'size': size}
+    try:
+        for layout, bench in (('standalone', bench_standalone), ('packed', bench_packed)):
+            folder = base / layout
+            folder.mkdir()
+            result = bench(folder, items, args.batch, names)
+            result['files'], result['disk_bytes'] = disk_usage(folder)
+            results[layout] = result
+        results['compaction'] = bench_compaction(base / 'packed', items, args.batch)
+    finally:
+        shutil.rmtree(base, ignore_errors=True)
+
+    print(f"{args.count} objects of {format_size(size)}, batches of {args.batch}")
+    print(f"{'layout':<12}{'write s':>10}{'obj/s':>10}{'files':>10}{'disk MB':>10}{'list ms':>10}{'read us':>10}")
+    for layout in ('standalone', 'packed'):
+        result = results[layout]
+        print(f"{layout:<12}{result['write_seconds']:>10.2f}{args.count / result['write_seconds']:>10.0f}"
+              f"{result['files']:>10}{result['disk_bytes'] / 1e6:>10.1f}{result['list_seconds'] * 1e3:>10.1f}"
+              f"{result['read_seconds'] / max(1, len(names)) * 1e6:>10.1f}")
+    compaction = results['compaction']
+    print(f"compaction after overwriting half: {compaction['segments']} segments, {compaction['moved']} records "
+          f"moved, {compaction['bytes_before'] / 1e6:.1f} -> {compaction['bytes_after'] / 1e6:.1f} MB "
+          f"in {compaction['seconds']:.2f}s")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
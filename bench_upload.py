@@ -0,0 +1,210 @@
+"""
+Files per second: single uploads against the batch upload endpoint of app.py.
+
+Uploads ``--files`` random files of ``--size`` bytes once through
+``/api/upload`` (one request, one JWT check, one encrypt and one
+fsync'd write per file) and once through ``/api/upload/batch`` for each
+``--batch`` size (one request per batch, encryption on the crypto pool,
+grouped fsyncs), and reports files/s, MB/s and the speedup over single
+uploads.
+
+By default the app runs in-process through Flask's test client, which
+measures the server side alone. It gets a temporary UPLOAD_FOLDER through
+PORTAL_UPLOAD_FOLDER, set before app.py is imported, so nothing is
+written to the configured store. With ``--port`` the same requests go
+over HTTP to a running instance (e.g. ``python serve.py app``), which
+adds the per-request network round trip that batching saves as well.
+
+Usage:
+    python bench_upload.py
+    python bench_upload.py --files 2000 --size 1K --batch 10 100 500
+    python bench_upload.py --port 5000 --json upload.json
+"""
+
+import argparse
+import http.client
+import json
+import os
+import platform
+import secrets
+import shutil
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from sizes import format_size, parse_size
+
+MAX_REQUEST_BYTES = 16 * 1024 * 1024  # app.py MAX_CONTENT_LENGTH
+
+
+def encode_multipart(field, files):
+    """multipart/form-data body with one ``field`` part per ``(filename, data)``."""
+    boundary = secrets.token_hex(16)
+    parts = []
+    for filename, data in files:
+        parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{field}"; '
+                     f'filename="{filename}"\r\nContent-Type: application/octet-stream\r\n\r\n'.encode())
+        parts.append(data)
+        parts.append(b'\r\n')
+    parts.append(f'--{boundary}--\r\n'.encode())
+    return b''.join(parts), f'multipart/form-data; boundary={boundary}'
+
+
+class TestClientTransport:
+    """Requests straight into the app object, no sockets."""
+
+    def __init__(self, upload_folder):
+        # app.py binds its index, segments, sessions, jobs and rate limiter to the folder at import
+        if 'app' in sys.modules:
+            raise RuntimeError('app.py is already imported and bound to its own UPLOAD_FOLDER')
+        os.environ['PORTAL_UPLOAD_FOLDER'] = upload_folder
+        # The benchmark uploads far faster, and more, than the per-user limits allow
+        os.environ.setdefault('PORTAL_RATE_LIMIT', '0')
+        os.environ.setdefault('PORTAL_QUOTA', '0')
+        import app as portal
+        folder = Path(upload_folder).resolve()
+        stores = {
+            'UPLOAD_FOLDER': Path(portal.app.config['UPLOAD_FOLDER']),
+            'file_index': portal.file_index.directory.parent,
+            'pack_store': portal.pack_store.folder,
+            'uploads': portal.uploads.upload_folder,
+            'job_queue': portal.job_queue.directory.parent,
+            'limiter': portal.limiter.path.parent.parent,
+        }
+        stray = [name for name, path in stores.items() if path.resolve() != folder]
+        if stray:
+            raise RuntimeError(f'in-process benchmark would write outside {folder}: {", ".join(stray)}')
+        self.client = portal.app.test_client()
+        self.label = 'in-process'
+
+    def request(self, method, path, body=None, headers=None):
+        response = self.client.open(path, method=method, data=body, headers=headers or {})
+        return response.status_code, response.get_json(silent=True)
+
+
+class HTTPTransport:
+    """Requests to a running instance over one (re-opened as needed) connection."""
+
+    def __init__(self, host, port):
+        self.connection = http.client.HTTPConnection(host, port, timeout=60)
+        self.label = f'http://{host}:{port}'
+
+    def request(self, method, path, body=None, headers=None):
+        self.connection.request(method, path, body=body, headers=headers or {})
+        response = self.connection.getresponse()
+        payload = response.read()
+        if response.getheader('Connection', '').lower() == 'close':
+            self.connection.close()
+        try:
+            return response.status, json.loads(payload)
+        except ValueError:
+            return response.status, None
+
+
+def login(transport, username, password):
+    status, payload = transport.request('POST', '/api/login', json.dumps(
+        {'username': username, 'password': password}).encode(), {'Content-Type': 'application/json'})
+    if status != 200:
+        raise SystemExit(f'login failed with status {status}: {payload}')
+    return {'Authorization': f"Bearer {payload['token']}"}
+
+
+def run_single(transport, auth, files):
+    started = time.perf_counter()
+    for filename, data in files:
+        body, content_type = encode_multipart('file', [(filename, data)])
+        status, payload = transport.request('POST', '/api/upload', body, dict(auth, **{'Content-Type': content_type}))
+        if status != 200:
+            raise SystemExit(f'single upload of {filename} failed with status {status}: {payload}')
+    return time.perf_counter() - started
+
+
+def run_batch(transport, auth, files, batch_size):
+    started = time.perf_counter()
+    for start in range(0, len(files), batch_size):
+        body, content_type = encode_multipart('files', files[start:start + batch_size])
+        status, payload = transport.request('POST', '/api/upload/batch', body,
+                                            dict(auth, **{'Content-Type': content_type}))
+        if status != 200:
+            raise SystemExit(f'batch upload failed with status {status}: {payload}')
+    return time.perf_counter() - started
+
+
+def run(transport, count, size, batch_sizes, username, password):
+    auth = login(transport, username, password)
+    # Distinct names per mode, so every mode creates new files
+    def files_for(mode):
+        return [(f'bench-{mode}-{i}.bin', os.urandom(size)) for i in range(count)]
+
+    rows = []
+    elapsed = run_single(transport, auth, files_for('single'))
+    rows.append({'mode': 'single', 'batch': 1, 'seconds': elapsed})
+    for batch_size in batch_sizes:
+        if batch_size * size > MAX_REQUEST_BYTES * 0.95:
+            print(f'skipping batch {batch_size}: {format_size(batch_size * size)} per request '
+                  f'exceeds MAX_CONTENT_LENGTH', file=sys.stderr)
+            continue
+        elapsed = run_batch(transport, auth, files_for(f'batch{batch_size}'), batch_size)
+        rows.append({'mode': 'batch', 'batch': batch_size, 'seconds': elapsed})
+
+    single = rows[0]['seconds']
+    for row in rows:
+        row['files_per_second'] = count / row['seconds']
+        row['mb_per_second'] = count * size / row['seconds'] / 1e6
+        row['speedup'] = single / row['seconds']
+    return rows
+
+
+def print_table(rows, count, size, label):
+    print(f'{count} files of {format_size(size)} via {label}')
+    print(f"{'mode':<12} {'files/s':>10} {'MB/s':>9} {'seconds':>9} {'speedup':>8}")
+    for row in rows:
+        mode = 'single' if row['mode'] == 'single' else f"batch {row['batch']}"
+        print(f"{mode:<12} {row['files_per_second']:>10.0f} {row['mb_per_second']:>9.1f} "
+              f"{row['seconds']:>9.2f} {row['speedup']:>7.1f}x")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Compare single and batch upload throughput')
+    parser.add_argument('--files', type=int, default=500, help='Files per mode (default: 500)')
+    parser.add_argument('--size', default='4K', help='Size of each file, e.g. 512, 4K, 1M (default: 4K)')
+    parser.add_argument('--batch', type=int, nargs='+', default=[10, 100, 500],
+                        help='Batch sizes to try (default: 10 100 500)')
+    parser.add_argument('--port', type=int, default=None,
+                        help='Benchmark a running instance on this port instead of in-process')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--username', default='admin')
+    parser.add_argument('--password', default='admin123')
+    parser.add_argument('--json', metavar='PATH', help='Also write the results to PATH as JSON')
+    args = parser.parse_args(argv)
+
+    size = parse_size(args.size)
+    upload_folder = None
+    if args.port is None:
+        upload_folder = tempfile.mkdtemp(prefix='bench-upload-')
+        transport = TestClientTransport(upload_folder)
+    else:
+        transport = HTTPTransport(args.host, args.port)
+    try:
+        rows = run(transport, args.files, size, args.batch, args.username, args.password)
+    finally:
+        if upload_folder:
+            shutil.rmtree(upload_folder, ignore_errors=True)
+
+    print_table(rows, args.files, size, transport.label)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({
+                'python': platform.python_version(),
+                'cpus': os.cpu_count(),
+                'target': transport.label,
+                'files': args.files,
+                'size': size,
+                'results': rows,
+            }, f, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
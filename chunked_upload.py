@@ -0,0 +1,271 @@
+"""
+Resumable chunked uploads into the encrypted file store.
+
+``/api/upload`` takes the whole file in one multipart POST, capped by
+MAX_CONTENT_LENGTH, and a dropped connection means starting over. Here a
+file is sent as numbered chunks instead:
+
+1. ``create``: the client announces file name and total size and gets an
+   upload ID and the chunk size (a multiple of the AES block size).
+2. ``write_chunk``: chunk ``n`` covers plaintext bytes
+   ``[n * chunk_size, (n + 1) * chunk_size)``. It is encrypted while it is
+   read from the request, appended to the session's ``.part`` file and
+   fsynced before the received offset advances.
+3. ``status``: after a failure the client asks for the offset and resumes at
+   ``next_chunk``. Re-sending a chunk that already arrived is a no-op.
+4. ``complete``: the ``.part`` file already is the finished
+   ``[IV][ciphertext]`` file (the last chunk was padded as it arrived), so
+   it is renamed into place with storage.publish. Nothing is read again.
+
+Resuming works because CBC chains each block to the previous ciphertext
+block: a new chunk is encrypted with the last 16 bytes already on disk as
+its IV (crypto_stream.CBCEncryptor), so the result is the same as
+encrypting the whole file in one go. Memory use is one READ_SIZE piece per
+request, whatever the file size.
+
+The session state (JSON) is the source of truth. If a request dies half
+way through a chunk, the ``.part`` file may hold bytes past the recorded
+offset; the next write cuts them off first. Sessions live in
+``<UPLOAD_FOLDER>/.uploads`` so that every instance sharing the folder can
+continue them and the final rename stays on one filesystem. Sessions idle
+for longer than the TTL are removed.
+"""
+
+import contextlib
+import json
+import os
+import re
+import secrets
+import time
+from pathlib import Path
+
+import metrics
+import timing
+from crypto_stream import BLOCK, IV_SIZE, CBCEncryptor, stored_size
+from storage import atomic_write, file_lock, lock_path_for, publish
+
+SESSION_DIR = '.uploads'
+DEFAULT_CHUNK_SIZE = 4 * 1024 * 1024
+MAX_CHUNK_SIZE = 8 * 1024 * 1024  # stays below the apps' MAX_CONTENT_LENGTH
+MAX_FILE_SIZE = 64 * 1024 ** 3
+SESSION_TTL = 24 * 3600
+# Request bodies are read, encrypted and written in pieces of this size
+READ_SIZE = 256 * 1024
+
+_UPLOAD_ID = re.compile(r'^[0-9a-f]{32}$')
+
+
+class UploadError(Exception):
+    """A request the upload protocol refuses; ``status`` is the HTTP status to answer with."""
+
+    def __init__(self, message, status=400, **info):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+        self.info = info
+
+
+def _checked(upload_id):
+    # IDs end up in file names: anything but our own hex IDs is unknown
+    if not isinstance(upload_id, str) or not _UPLOAD_ID.match(upload_id):
+        raise UploadError('Upload not found', 404)
+    return upload_id
+
+
+def _chunk_count(size, chunk_size):
+    return -(-size // chunk_size)
+
+
+def public_state(state):
+    """What the client gets to see of a session."""
+    size, chunk_size, received = state['size'], state['chunk_size'], state['received']
+    chunks = _chunk_count(size, chunk_size)
+    done = received == size
+    return {
+        'upload_id': state['upload_id'],
+        'filename': state['filename'],
+        'size': size,
+        'chunk_size': chunk_size,
+        'chunks': chunks,
+        'offset': received,
+        'next_chunk': chunks if done else received // chunk_size,
+        'complete': done,
+        'expires': state['updated'] + SESSION_TTL,
+    }
+
+
+class ChunkedUploads:
+    """Upload sessions of one portal app, stored under ``upload_folder``."""
+
+    def __init__(self, upload_folder, key_func, app_name='portal'):
+        self.upload_folder = Path(upload_folder)
+        self.directory = self.upload_folder / SESSION_DIR
+        self.key_func = key_func
+        self.crypto_bytes = metrics.CRYPTO_BYTES.labels(app_name, 'encrypt')
+        self.crypto_seconds = metrics.CRYPTO_SECONDS.labels(app_name, 'encrypt')
+
+    # -- files --------------------------------------------------------------
+
+    def _state_path(self, upload_id):
+        return self.directory / f'{_checked(upload_id)}.json'
+
+    def _part_path(self, upload_id):
+        return self.directory / f'{_checked(upload_id)}.part'
+
+    def _load(self, owner, upload_id):
+        try:
+            with open(self._state_path(upload_id), encoding='utf-8') as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            raise UploadError('Upload not found', 404) from None
+        # Other users' sessions do not exist as far as the caller can tell
+        if state['owner'] != owner:
+            raise UploadError('Upload not found', 404)
+        return state
+
+    def _save(self, state):
+        atomic_write(self._state_path(state['upload_id']),
+                     json.dumps(state, ensure_ascii=False).encode('utf-8'))
+
+    def _remove(self, upload_id):
+        for path in (self._state_path(upload_id), lock_path_for(self._state_path(upload_id)),
+                     self._part_path(upload_id), lock_path_for(self._part_path(upload_id))):
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(path)
+
+    # -- protocol -----------------------------------------------------------
+
+    def create(self, owner, filename, size, chunk_size=None):
+        """Start a session for ``size`` bytes that will be stored as ``filename``."""
+        if not isinstance(size, int) or isinstance(size, bool) or not 0 <= size <= MAX_FILE_SIZE:
+            raise UploadError(f'size must be an integer between 0 and {MAX_FILE_SIZE}')
+        chunk_size = DEFAULT_CHUNK_SIZE if chunk_size is None else chunk_size
+        if (not isinstance(chunk_size, int) or isinstance(chunk_size, bool)
+                or not BLOCK <= chunk_size <= MAX_CHUNK_SIZE or chunk_size % BLOCK):
+            raise UploadError(f'chunk_size must be a multiple of {BLOCK} up to {MAX_CHUNK_SIZE}')
+
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.expire()
+        upload_id = secrets.token_hex(16)
+        encryptor = CBCEncryptor(self.key_func())
+        with open(self._part_path(upload_id), 'xb') as f:
+            f.write(encryptor.iv)
+            if size == 0:
+                # Nothing will arrive: the padding block is the whole ciphertext
+                f.write(encryptor.finalize())
+            f.flush()
+            os.fsync(f.fileno())
+        now = time.time()
+        state = {
+            'upload_id': upload_id,
+            'owner': owner,
+            'filename': filename,
+            'size': size,
+            'chunk_size': chunk_size,
+            'received': 0,
+            'created': now,
+            'updated': now,
+        }
+        self._save(state)
+        return public_state(state)
+
+    def status(self, owner, upload_id):
+        return public_state(self._load(owner, upload_id))
+
+    def write_chunk(self, owner, upload_id, index, stream, length):
+        """Encrypt chunk ``index`` from ``stream`` (``length`` bytes) onto the session."""
+        with file_lock(self._part_path(upload_id)):
+            state = self._load(owner, upload_id)
+            info = public_state(state)
+            if not 0 <= index < info['chunks']:
+                raise UploadError(f"chunk index must be between 0 and {info['chunks'] - 1}")
+            if index < info['next_chunk']:
+                # Already stored, e.g. the response to an earlier attempt was lost
+                return dict(info, duplicate=True)
+            if index > info['next_chunk']:
+                raise UploadError(f"expected chunk {info['next_chunk']}", 409,
+                                  offset=info['offset'], next_chunk=info['next_chunk'])
+
+            received, size = state['received'], state['size']
+            expected = min(state['chunk_size'], size - received)
+            if length != expected:
+                raise UploadError(f'chunk {index} must be {expected} bytes, got {length}')
+            last = received + length == size
+
+            with open(self._part_path(upload_id), 'r+b') as f:
+                # Bytes past the recorded offset belong to an interrupted
+                # attempt; the block before the offset (or the file IV)
+                # continues the CBC chain
+                f.truncate(IV_SIZE + received)
+                f.seek(IV_SIZE + received - BLOCK)
+                encryptor = CBCEncryptor(self.key_func(), iv=f.read(BLOCK))
+                crypto_seconds = 0.0
+                remaining = length
+                while remaining:
+                    with timing.phase('io_read'):
+                        piece = stream.read(min(READ_SIZE, remaining))
+                    if not piece:
+                        raise UploadError(f'chunk {index} ended after {length - remaining} of {length} bytes')
+                    remaining -= len(piece)
+                    with timing.phase('encrypt'):
+                        started = time.perf_counter()
+                        data = encryptor.update(piece)
+                        if last and not remaining:
+                            data += encryptor.finalize()
+                        crypto_seconds += time.perf_counter() - started
+                    with timing.phase('io_write'):
+                        f.write(data)
+                with timing.phase('io_write'):
+                    f.flush()
+                    os.fsync(f.fileno())
+            self.crypto_bytes.inc(length)
+            self.crypto_seconds.inc(crypto_seconds)
+
+            state['received'] = received + length
+            state['updated'] = time.time()
+            self._save(state)
+            return public_state(state)
+
+    def complete(self, owner, upload_id, destination):
+        """Move the finished file to ``destination``; returns the final session state."""
+        part = self._part_path(upload_id)
+        with file_lock(part):
+            state = self._load(owner, upload_id)
+            info = public_state(state)
+            if not info['complete']:
+                raise UploadError(f"upload incomplete: {info['offset']} of {info['size']} bytes received",
+                                  409, offset=info['offset'], next_chunk=info['next_chunk'])
+            actual = part.stat().st_size
+            if actual != stored_size(state['size']):
+                raise UploadError(f'stored data has {actual} bytes, expected {stored_size(state["size"])}', 500)
+            with timing.phase('io_write'):
+                publish(part, destination)
+            self._remove(upload_id)
+        return info
+
+    def abort(self, owner, upload_id):
+        with file_lock(self._part_path(upload_id)):
+            self._load(owner, upload_id)
+            self._remove(upload_id)
+
+    def expire(self, now=None):
+        """Remove sessions idle for longer than SESSION_TTL; returns how many."""
+        now = time.time() if now is None else now
+        removed = 0
+        for path in self.directory.glob('*.part'):
+            upload_id = path.stem
+            if not _UPLOAD_ID.match(upload_id):
+                continue
+            try:
+                with open(self._state_path(upload_id), encoding='utf-8') as f:
+                    updated = json.load(f)['updated']
+            except (FileNotFoundError, ValueError, KeyError):
+                # A session that crashed before its state was written
+                try:
+                    updated = path.stat().st_mtime
+                except FileNotFoundError:
+                    continue
+            if now - updated > SESSION_TTL:
+                self._remove(upload_id)
+                removed += 1
+        return removed
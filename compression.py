@@ -0,0 +1,189 @@
+"""
+Negotiated compression of the portal apps' text responses.
+
+JSON listings such as ``/api/files`` compress to a fraction of their size,
+which matters more than the CPU spent on it once they reach megabytes.
+``init_app(app)`` adds an after_request hook that compresses a response
+when all of these hold:
+
+- the client accepts ``br`` or ``gzip`` (``Accept-Encoding`` with q-values;
+  br needs the optional ``brotli`` package and is preferred when both are
+  acceptable);
+- the body is JSON or text (COMPRESSIBLE_TYPES) and not already encoded,
+  partial (206) or marked ``Cache-Control: no-transform``;
+- a buffered body is at least PORTAL_COMPRESS_MIN_BYTES (default 1024)
+  long. Below that the headers cost more than compression saves.
+
+Buffered bodies up to STREAM_MIN_SIZE are compressed in one call and keep a
+Content-Length. Larger ones, and streamed responses, are compressed piece
+by piece while they are sent (chunked transfer), so the first bytes leave
+before the whole body is compressed and the compressed copy is never held
+in full. Pieces of a streamed response are flushed as they come, so a
+client sees each one as soon as the app produces it.
+
+Every compressible response gets ``Vary: Accept-Encoding``. A strong ETag
+becomes weak on a compressed response, since the bytes differ from the
+uncompressed representation. One-call compression shows up as the
+``compress`` phase in Server-Timing; bytes before and after are counted in
+``portal_compression_bytes_total`` either way.
+"""
+
+import os
+import zlib
+
+from flask import request
+
+import metrics
+import timing
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+MIN_SIZE = int(os.environ.get('PORTAL_COMPRESS_MIN_BYTES') or 1024)
+# Level 3 gets a 100k-entry listing to 6.9x in half the time of level 6 (7.8x); see bench_json.py
+GZIP_LEVEL = int(os.environ.get('PORTAL_GZIP_LEVEL') or 3)
+# Qualities above 5 are much slower for little gain on dynamic responses
+BROTLI_QUALITY = int(os.environ.get('PORTAL_BROTLI_QUALITY') or 4)
+COMPRESSIBLE_TYPES = frozenset({
+    'application/json', 'text/plain', 'text/html', 'text/csv', 'text/css', 'application/javascript',
+})
+# Buffered bodies larger than this are compressed while they are sent
+STREAM_MIN_SIZE = 1024 * 1024
+STREAM_PIECE = 256 * 1024
+
+
+def supported_encodings():
+    """Content codings this process can produce, in order of preference."""
+    return ('br', 'gzip') if brotli is not None else ('gzip',)
+
+
+class Compressor:
+    """Incremental br or gzip compressor: ``compress`` pieces, ``flush`` after each, ``finish`` once."""
+
+    def __init__(self, encoding):
+        self.encoding = encoding
+        if encoding == 'br':
+            self._brotli = brotli.Compressor(quality=BROTLI_QUALITY)
+        elif encoding == 'gzip':
+            # wbits 31: gzip header and trailer around the deflate stream
+            self._zlib = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+        else:
+            raise ValueError(f'unsupported content coding {encoding!r}')
+
+    def compress(self, data):
+        if self.encoding == 'br':
+            return self._brotli.process(data)
+        return self._zlib.compress(data)
+
+    def flush(self):
+        if self.encoding == 'br':
+            return self._brotli.flush()
+        return self._zlib.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        if self.encoding == 'br':
+            return self._brotli.finish()
+        return self._zlib.flush()
+
+
+def compress(data, encoding):
+    """``data`` compressed in one go."""
+    compressor = Compressor(encoding)
+    return compressor.compress(data) + compressor.finish()
+
+
+def negotiate(accept_encodings):
+    """The coding to use for a request's parsed ``Accept-Encoding``, or None."""
+    return accept_encodings.best_match(supported_encodings())
+
+
+def is_compressible(response):
+    if response.direct_passthrough or response.mimetype not in COMPRESSIBLE_TYPES:
+        return False
+    if response.status_code < 200 or response.status_code in (204, 206, 304):
+        return False
+    if 'Content-Encoding' in response.headers:
+        return False
+    return 'no-transform' not in response.headers.get('Cache-Control', '')
+
+
+def _compress_pieces(pieces, compressor, counter_in, counter_out, flush):
+    source = iter(pieces)
+    size_in = size_out = 0
+    try:
+        for piece in source:
+            if isinstance(piece, str):
+                piece = piece.encode('utf-8')
+            size_in += len(piece)
+            data = compressor.compress(piece)
+            if flush:
+                data += compressor.flush()
+            if data:
+                size_out += len(data)
+                yield data
+        data = compressor.finish()
+        size_out += len(data)
+        yield data
+    finally:
+        # The wrapped iterable may hold resources (files, mmaps) released on close
+        close = getattr(pieces, 'close', None)
+        if close is not None:
+            close()
+        counter_in.inc(size_in)
+        counter_out.inc(size_out)
+
+
+def _slices(body):
+    view = memoryview(body)
+    for start in range(0, len(view), STREAM_PIECE):
+        yield view[start:start + STREAM_PIECE]
+
+
+def init_app(app, name=None, min_size=None):
+    """Compress ``app``'s JSON and text responses for clients that accept it.
+
+    Call it after ``timing.init_app``: after_request hooks run in reverse
+    order, so compression then happens inside the request's timed total.
+    """
+    name = name or app.import_name
+    min_size = MIN_SIZE if min_size is None else min_size
+
+    @app.after_request
+    def _compress_response(response):
+        if request.method == 'HEAD' or not is_compressible(response):
+            return response
+        response.vary.add('Accept-Encoding')
+        encoding = negotiate(request.accept_encodings)
+        if encoding is None:
+            return response
+
+        counter_in = metrics.COMPRESSION_BYTES.labels(name, encoding, 'in')
+        counter_out = metrics.COMPRESSION_BYTES.labels(name, encoding, 'out')
+        if response.is_streamed:
+            response.response = _compress_pieces(response.response, Compressor(encoding),
+                                                 counter_in, counter_out, flush=True)
+            response.headers.pop('Content-Length', None)
+        else:
+            body = response.get_data()
+            if len(body) < min_size:
+                return response
+            if len(body) > STREAM_MIN_SIZE:
+                response.response = _compress_pieces(_slices(body), Compressor(encoding),
+                                                     counter_in, counter_out, flush=False)
+                response.headers.pop('Content-Length', None)
+            else:
+                with timing.phase('compress'):
+                    data = compress(body, encoding)
+                counter_in.inc(len(body))
+                counter_out.inc(len(data))
+                response.set_data(data)
+
+        response.headers['Content-Encoding'] = encoding
+        etag, weak = response.get_etag()
+        if etag and not weak:
+            response.set_etag(etag, weak=True)
+        return response
+
+    return app
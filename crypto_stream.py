@@ -0,0 +1,167 @@
+"""
+Incremental AES-256-CBC in the portal's stored format.
+
+``encrypt_file``/``decrypt_file`` in the portal modules work on whole byte
+strings: ``[16-byte IV][CBC ciphertext of the PKCS#7-padded plaintext]``.
+The classes here produce and consume exactly that format piece by piece, so
+a file can be encrypted as it arrives or decrypted as it is sent without
+holding all of it in memory. Output is byte-for-byte what the one-shot
+functions produce for the same key and IV.
+
+CBC chains every block to the previous ciphertext block. That makes
+encryption resumable: to continue a partly written file, start a new
+``CBCEncryptor`` with the file's last ciphertext block as its IV (see
+chunked_upload.py).
+
+``decrypt_view`` is the zero-copy variant for data that is already
+addressable, e.g. a memoryview over an ``mmap`` of a stored file: it
+decrypts slices of the input straight into one reused output buffer, so
+no file-sized objects are created. ``plaintext_length`` gets the plaintext
+size (and checks the padding) from the last block alone.
+
+    enc = CBCEncryptor(key)
+    out.write(enc.iv)
+    for piece in pieces:
+        out.write(enc.update(piece))
+    out.write(enc.finalize())
+"""
+
+from Crypto.Cipher import AES
+from Crypto.Random import get_random_bytes
+
+BLOCK = AES.block_size
+IV_SIZE = 16
+# Raw downloads name the stored format in this header (see portal_client.py)
+FORMAT_HEADER = 'X-Portal-Format'
+FORMAT = 'aes-256-cbc; iv=16; padding=pkcs7'
+
+
+def padded_size(size):
+    """Ciphertext length of ``size`` plaintext bytes (PKCS#7 always adds 1-16 bytes)."""
+    return (size // BLOCK + 1) * BLOCK
+
+
+def stored_size(size):
+    """Length of the stored file (IV + ciphertext) for ``size`` plaintext bytes."""
+    return IV_SIZE + padded_size(size)
+
+
+class CBCEncryptor:
+    """Encrypt a stream; ``update`` returns whole blocks, ``finalize`` the padded tail."""
+
+    def __init__(self, key, iv=None):
+        self.iv = iv if iv is not None else get_random_bytes(IV_SIZE)
+        self._cipher = AES.new(key, AES.MODE_CBC, iv=self.iv)
+        self._tail = b''
+
+    def update(self, data):
+        if self._tail:
+            data = self._tail + data
+        cut = len(data) - len(data) % BLOCK
+        self._tail = data[cut:]
+        return self._cipher.encrypt(data[:cut]) if cut else b''
+
+    def finalize(self):
+        padding = BLOCK - len(self._tail)
+        block = self._tail + bytes([padding]) * padding
+        self._tail = b''
+        return self._cipher.encrypt(block)
+
+
+class CBCDecryptor:
+    """Decrypt a stream; the last block is held back until ``finalize`` removes the padding."""
+
+    def __init__(self, key, iv):
+        if len(iv) != IV_SIZE:
+            raise ValueError('IV must be 16 bytes')
+        self._cipher = AES.new(key, AES.MODE_CBC, iv=iv)
+        self._tail = b''
+
+    def update(self, data):
+        if self._tail:
+            data = self._tail + data
+        # Keep at least one whole block back: it may be the padded last one
+        cut = len(data) - len(data) % BLOCK
+        if cut == len(data):
+            cut -= BLOCK
+        if cut <= 0:
+            self._tail = data
+            return b''
+        self._tail = data[cut:]
+        return self._cipher.decrypt(data[:cut])
+
+    def finalize(self):
+        if len(self._tail) != BLOCK:
+            raise ValueError('ciphertext length is not a multiple of the block size')
+        block = self._cipher.decrypt(self._tail)
+        self._tail = b''
+        padding = block[-1]
+        if not 1 <= padding <= BLOCK or block[-padding:] != bytes([padding]) * padding:
+            raise ValueError('Padding is incorrect.')
+        return block[:-padding]
+
+
+def plaintext_length(key, data):
+    """Plaintext size of the stored-format ``data`` (any bytes-like object).
+
+    Only the last block is decrypted, which is enough to read the padding.
+    That also catches most wrong keys and damaged files up front. Raises
+    ValueError like CBCDecryptor.finalize.
+    """
+    size = len(data)
+    if size < IV_SIZE + BLOCK or (size - IV_SIZE) % BLOCK:
+        raise ValueError('encrypted data has an invalid length')
+    # In CBC each block is decrypted with the previous ciphertext block as IV
+    block = AES.new(key, AES.MODE_CBC, iv=bytes(data[size - 2 * BLOCK:size - BLOCK])).decrypt(
+        bytes(data[size - BLOCK:]))
+    padding = block[-1]
+    if not 1 <= padding <= BLOCK or block[-padding:] != bytes([padding]) * padding:
+        raise ValueError('Padding is incorrect.')
+    return size - IV_SIZE - padding
+
+
+def decrypt_view(key, data, chunk_size=1024 * 1024, output=None):
+    """Yield the plaintext of the stored-format ``data`` as views of one reused buffer.
+
+    ``data`` is any bytes-like object; slices of a memoryview are decrypted
+    without copying the ciphertext. Every piece is decrypted into ``output``
+    (a writable buffer of at least ``chunk_size`` bytes, allocated once if
+    not given), so each yielded memoryview is only valid until the next one
+    is requested: copy it or write it out before asking for more. Padding is
+    checked before the first piece is yielded and cut off the last one.
+    """
+    remaining = plaintext_length(key, data)
+    chunk_size = max(BLOCK, chunk_size - chunk_size % BLOCK)
+    buffer = memoryview(output if output is not None else bytearray(chunk_size))
+    view = memoryview(data)
+    cipher = AES.new(key, AES.MODE_CBC, iv=bytes(view[:IV_SIZE]))
+    offset, end = IV_SIZE, len(view)
+    while offset < end:
+        n = min(chunk_size, end - offset)
+        cipher.decrypt(view[offset:offset + n], output=buffer[:n])
+        offset += n
+        piece = min(n, remaining)
+        remaining -= piece
+        if piece:
+            yield buffer[:piece]
+
+
+def decrypt_chunks(key, fileobj, chunk_size=1024 * 1024):
+    """Yield the plaintext of a stored file object in pieces of about ``chunk_size``.
+
+    Raises ValueError on a short file or bad padding; by then earlier pieces
+    have already been yielded, so callers streaming to a client should
+    check the length up front.
+    """
+    iv = fileobj.read(IV_SIZE)
+    if len(iv) != IV_SIZE:
+        raise ValueError('encrypted data too short')
+    decryptor = CBCDecryptor(key, iv)
+    while True:
+        data = fileobj.read(chunk_size)
+        if not data:
+            break
+        plain = decryptor.update(data)
+        if plain:
+            yield plain
+    yield decryptor.finalize()
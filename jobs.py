@@ -0,0 +1,371 @@
+"""
+Persistent background jobs: a SQLite queue worked by threads in every process.
+
+A request that would otherwise hold a worker thread for a long time (e.g.
+encrypting and fsyncing a big upload) hands its input to ``submit``, which
+spools it to disk, records a job row and returns at once with the job ID.
+The client then polls ``get`` through a status endpoint.
+
+Everything lives in one directory, normally ``<UPLOAD_FOLDER>/.jobs``:
+``jobs.sqlite3`` (WAL mode, so every process sharing the folder can use
+it) and one ``<id>.spool`` file per job. There is no broker: every process
+that called ``ensure_started`` runs a few worker threads that claim jobs
+from the table.
+
+Claiming takes a *lease*: the worker marks the job ``running`` with a
+random lease token and an expiry, and renews the expiry whenever the
+handler reports progress. If the process dies, the lease runs out and
+another worker (or the same one after a restart) claims the job again. A
+failing handler is retried with a growing delay, up to MAX_ATTEMPTS runs
+in total; ``JobError`` fails the job at once. Handlers must therefore be
+idempotent: write to a temporary file and rename it into place, and never
+consume the spool. The spool is removed only after the job has reached
+``done`` or ``failed``.
+
+Finished jobs are kept for RETENTION seconds so clients can still read the
+outcome, then purged together with any orphaned spool files.
+
+Worker threads do not survive ``fork``. ``ensure_started`` starts them
+once per process id, and ``init_app`` calls it before each request, so a
+pre-forked worker starts its threads with its first request.
+"""
+
+import contextlib
+import json
+import logging
+import os
+import re
+import secrets
+import shutil
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+DB_NAME = 'jobs.sqlite3'
+SPOOL_SUFFIX = '.spool'
+DEFAULT_WORKERS = 2
+POLL_INTERVAL = 0.5
+LEASE_SECONDS = 60
+MAX_ATTEMPTS = 3
+RETRY_DELAY = 5  # seconds, multiplied by the attempt number
+PROGRESS_INTERVAL = 0.5  # at most one progress write per job per interval
+RETENTION = 7 * 24 * 3600
+SPOOL_READ_SIZE = 256 * 1024
+
+QUEUED, RUNNING, DONE, FAILED = 'queued', 'running', 'done', 'failed'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    owner TEXT NOT NULL,
+    params TEXT NOT NULL,
+    state TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    progress INTEGER NOT NULL DEFAULT 0,
+    total INTEGER,
+    result TEXT,
+    error TEXT,
+    run_after REAL NOT NULL,
+    lease TEXT,
+    lease_until REAL,
+    created REAL NOT NULL,
+    updated REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_by_state ON jobs (state, run_after);
+"""
+
+_JOB_ID = re.compile(r'^[0-9a-f]{32}$')
+
+
+class JobError(Exception):
+    """A permanent failure: the job is marked failed without further attempts."""
+
+
+class JobLost(Exception):
+    """The job's lease expired and another worker has taken it over."""
+
+
+def public_state(row):
+    """What a client gets to see of a job."""
+    total = row['total']
+    return {
+        'job_id': row['id'],
+        'kind': row['kind'],
+        'state': row['state'],
+        'progress': row['progress'],
+        'total': total,
+        'percent': round(100.0 * row['progress'] / total, 1) if total else None,
+        'attempts': row['attempts'],
+        'result': json.loads(row['result']) if row['result'] else None,
+        'error': row['error'],
+        'created': row['created'],
+        'updated': row['updated'],
+    }
+
+
+class Job:
+    """A claimed job as its handler sees it."""
+
+    def __init__(self, queue, row):
+        self.queue = queue
+        self.id = row['id']
+        self.kind = row['kind']
+        self.owner = row['owner']
+        self.params = json.loads(row['params'])
+        self.attempt = row['attempts']
+        self.total = row['total']
+        self.lease = row['lease']
+        self.spool_path = queue.spool_path(self.id)
+        self._reported = 0.0
+
+    def progress(self, done, force=False):
+        """Record ``done`` units of work and renew the lease.
+
+        Writes at most every PROGRESS_INTERVAL seconds unless ``force``.
+        Raises JobLost if another worker has claimed the job meanwhile.
+        """
+        now = time.time()
+        if not force and now - self._reported < PROGRESS_INTERVAL:
+            return
+        self._reported = now
+        with self.queue._connect() as db:
+            updated = db.execute(
+                'UPDATE jobs SET progress = ?, lease_until = ?, updated = ? WHERE id = ? AND lease = ?',
+                (done, now + LEASE_SECONDS, now, self.id, self.lease)).rowcount
+        if not updated:
+            raise JobLost(self.id)
+
+
+class JobQueue:
+    """Jobs stored in ``directory``; ``handlers`` maps a job kind to ``handler(job) -> result``."""
+
+    def __init__(self, directory, handlers, workers=DEFAULT_WORKERS, app_name='portal'):
+        self.directory = Path(directory)
+        self.handlers = dict(handlers)
+        self.workers = workers
+        self.app_name = app_name
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._pid = None
+        self._threads = []
+        self._stop = threading.Event()
+        self._wake = threading.Event()
+        self._schema_ready = False
+
+    # -- storage ------------------------------------------------------------
+
+    def spool_path(self, job_id):
+        return self.directory / f'{job_id}{SPOOL_SUFFIX}'
+
+    def _connect(self):
+        """This thread's connection; usable as a transaction context manager."""
+        db = getattr(self._local, 'db', None)
+        if db is None or self._local.pid != os.getpid():
+            self.directory.mkdir(parents=True, exist_ok=True)
+            db = sqlite3.connect(self.directory / DB_NAME, timeout=30, check_same_thread=False)
+            db.row_factory = sqlite3.Row
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=FULL')
+            if not self._schema_ready:
+                db.executescript(SCHEMA)
+                self._schema_ready = True
+            self._local.db, self._local.pid = db, os.getpid()
+        return db
+
+    @contextlib.contextmanager
+    def _immediate(self):
+        """Write transaction taken up front, so concurrent claims serialize cleanly."""
+        db = self._connect()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            yield db
+        except BaseException:
+            db.rollback()
+            raise
+        db.commit()
+
+    # -- clients ------------------------------------------------------------
+
+    def submit(self, kind, owner, params, source=None, total=None):
+        """Queue a job of ``kind``; returns its public state.
+
+        ``source`` is an optional readable binary stream that is copied to
+        the job's spool file (and fsynced) before the job becomes visible.
+        """
+        if kind not in self.handlers:
+            raise ValueError(f'unknown job kind {kind!r}')
+        job_id = secrets.token_hex(16)
+        spool = self.spool_path(job_id)
+        if source is not None:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            with open(spool, 'xb') as f:
+                shutil.copyfileobj(source, f, SPOOL_READ_SIZE)
+                f.flush()
+                os.fsync(f.fileno())
+                if total is None:
+                    total = f.tell()
+        now = time.time()
+        try:
+            with self._connect() as db:
+                db.execute('INSERT INTO jobs (id, kind, owner, params, state, total, run_after, created, updated) '
+                           'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                           (job_id, kind, str(owner), json.dumps(params, ensure_ascii=False), QUEUED, total,
+                            now, now, now))
+        except BaseException:
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(spool)
+            raise
+        metrics.JOBS.labels(self.app_name, kind, 'submitted').inc()
+        self._wake.set()
+        return self.get(owner, job_id)
+
+    def get(self, owner, job_id):
+        """Public state of a job, or None if there is no such job of ``owner``."""
+        if not isinstance(job_id, str) or not _JOB_ID.match(job_id):
+            return None
+        row = self._connect().execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        # Other users' jobs do not exist as far as the caller can tell
+        if row is None or row['owner'] != str(owner):
+            return None
+        return public_state(row)
+
+    # -- workers ------------------------------------------------------------
+
+    def _claim(self):
+        now = time.time()
+        with self._immediate() as db:
+            row = db.execute(
+                'SELECT * FROM jobs WHERE (state = ? AND run_after <= ?) OR (state = ? AND lease_until < ?) '
+                'ORDER BY run_after LIMIT 1', (QUEUED, now, RUNNING, now)).fetchone()
+            if row is None:
+                return None
+            if row['attempts'] >= MAX_ATTEMPTS:
+                # Its last attempt died with the process that ran it
+                self._close(db, row['id'], FAILED, error='interrupted too many times')
+                return 'skip'
+            lease = secrets.token_hex(8)
+            db.execute('UPDATE jobs SET state = ?, attempts = attempts + 1, lease = ?, lease_until = ?, '
+                       'updated = ? WHERE id = ?', (RUNNING, lease, now + LEASE_SECONDS, now, row['id']))
+            return db.execute('SELECT * FROM jobs WHERE id = ?', (row['id'],)).fetchone()
+
+    def _close(self, db, job_id, state, result=None, error=None, lease=None):
+        """Move a job to a final state; returns False if ``lease`` is no longer held."""
+        now = time.time()
+        query = ('UPDATE jobs SET state = ?, result = ?, error = ?, lease = NULL, lease_until = NULL, '
+                 'updated = ? WHERE id = ?')
+        args = [state, json.dumps(result) if result is not None else None, error, now, job_id]
+        if lease is not None:
+            query += ' AND lease = ?'
+            args.append(lease)
+        if not db.execute(query, args).rowcount:
+            return False
+        if state == DONE:
+            db.execute('UPDATE jobs SET progress = COALESCE(total, progress) WHERE id = ?', (job_id,))
+        # The spool goes once the outcome is committed: a crash in between
+        # only leaves an orphan for purge()
+        db.commit()
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(self.spool_path(job_id))
+        return True
+
+    def run_once(self):
+        """Claim and run one job; returns False if none was ready."""
+        row = self._claim()
+        if row is None:
+            return False
+        if row == 'skip':
+            return True
+        job = Job(self, row)
+        handler = self.handlers.get(job.kind)
+        try:
+            if handler is None:
+                raise JobError(f'no handler for job kind {job.kind!r}')
+            result = handler(job)
+        except JobLost:
+            logger.warning('job lease lost', extra={'job': job.id, 'kind': job.kind})
+            return True
+        except Exception as e:
+            permanent = isinstance(e, JobError) or job.attempt >= MAX_ATTEMPTS
+            with self._immediate() as db:
+                if permanent:
+                    self._close(db, job.id, FAILED, error=str(e), lease=job.lease)
+                else:
+                    now = time.time()
+                    db.execute('UPDATE jobs SET state = ?, error = ?, run_after = ?, lease = NULL, '
+                               'lease_until = NULL, updated = ? WHERE id = ? AND lease = ?',
+                               (QUEUED, str(e), now + RETRY_DELAY * job.attempt, now, job.id, job.lease))
+            outcome = 'failed' if permanent else 'retried'
+            metrics.JOBS.labels(self.app_name, job.kind, outcome).inc()
+            logger.warning(f'job {outcome}', exc_info=not isinstance(e, JobError),
+                           extra={'job': job.id, 'kind': job.kind, 'attempt': job.attempt, 'error': str(e)})
+            return True
+        with self._immediate() as db:
+            closed = self._close(db, job.id, DONE, result=result, lease=job.lease)
+        if closed:
+            metrics.JOBS.labels(self.app_name, job.kind, 'done').inc()
+        return True
+
+    def _work(self):
+        while not self._stop.is_set():
+            try:
+                ran = self.run_once()
+            except Exception:
+                logger.exception('job worker error')
+                ran = False
+            if not ran:
+                self._wake.wait(POLL_INTERVAL)
+                self._wake.clear()
+
+    def ensure_started(self):
+        """Start this process's worker threads (again, after a fork)."""
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._stop = threading.Event()
+            self._wake = threading.Event()
+            self._local = threading.local()
+            self.purge()
+            self._threads = [threading.Thread(target=self._work, name=f'jobs-{i}', daemon=True)
+                             for i in range(self.workers)]
+            for thread in self._threads:
+                thread.start()
+            self._pid = os.getpid()
+
+    def shutdown(self, timeout=5):
+        """Stop the worker threads; a job still running is picked up again after its lease expires."""
+        self._stop.set()
+        self._wake.set()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+        self._pid = None
+
+    def init_app(self, app):
+        app.before_request(self.ensure_started)
+        app.extensions['jobs'] = self
+        return self
+
+    # -- housekeeping -------------------------------------------------------
+
+    def purge(self, now=None):
+        """Delete finished jobs older than RETENTION and orphaned spool files; returns how many jobs."""
+        now = time.time() if now is None else now
+        with self._connect() as db:
+            removed = db.execute('DELETE FROM jobs WHERE state IN (?, ?) AND updated < ?',
+                                 (DONE, FAILED, now - RETENTION)).rowcount
+            pending = {row['id'] for row in db.execute('SELECT id FROM jobs WHERE state IN (?, ?)',
+                                                       (QUEUED, RUNNING))}
+        for spool in self.directory.glob('*' + SPOOL_SUFFIX):
+            # A spool younger than a minute may belong to a submit in progress
+            with contextlib.suppress(FileNotFoundError):
+                if spool.stem not in pending and now - spool.stat().st_mtime > 60:
+                    os.unlink(spool)
+        return removed
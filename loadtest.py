@@ -0,0 +1,342 @@
+"""
+HTTP load generator for the portal servers.
+
+Logs in through /api/login, then sends a weighted mix of /api/files,
+/api/upload and /api/download requests at a fixed target rate to one of the
+ports started by start_multiple_servers.py (or balancer.py / serve.py /
+multi_host.py, anything that speaks the same API).
+
+The load is open-loop: requests are scheduled at the target rate whether or
+not earlier ones have finished, and latency is measured from the scheduled
+send time. A server that falls behind therefore shows up as rising latency
+instead of silently lowering the offered rate. ``--concurrency`` caps the
+number of connections; requests waiting for a free connection keep aging.
+
+Uploads rotate over a fixed set of ``--files`` names so repeated runs do
+not grow the upload folder; downloads pick one of the names uploaded so far.
+
+Usage:
+    python loadtest.py --port 5000 --rps 50 --duration 30
+    python loadtest.py --port 8000 --mix files=8,upload=1,download=1 --upload-size 64K
+    python loadtest.py --port 5003 --rps 20 --json result.json
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import sys
+import time
+import uuid
+from pathlib import Path
+
+from balancer import BadRequest, body_framing, header, read_head, serialize_head
+from sizes import parse_size
+from start_multiple_servers import SERVERS
+
+DEFAULT_MIX = 'files=6,upload=2,download=2'
+ENDPOINTS = ('files', 'upload', 'download')
+
+
+class RequestFailed(Exception):
+    pass
+
+
+def parse_mix(text):
+    """'files=6,upload=2' -> {'files': 6.0, 'upload': 2.0}"""
+    mix = {}
+    for part in text.split(','):
+        name, _, weight = part.partition('=')
+        name = name.strip()
+        if name not in ENDPOINTS:
+            raise argparse.ArgumentTypeError(f'unknown endpoint {name!r}, expected one of {ENDPOINTS}')
+        mix[name] = float(weight or 1)
+    if not any(mix.values()):
+        raise argparse.ArgumentTypeError('mix needs at least one positive weight')
+    return mix
+
+
+def percentile(ordered, fraction):
+    """Nearest-rank percentile of an already sorted list."""
+    if not ordered:
+        return None
+    index = min(len(ordered) - 1, max(0, int(round(fraction * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+def multipart_body(filename, payload):
+    boundary = uuid.uuid4().hex
+    body = b''.join([
+        f'--{boundary}\r\n'.encode(),
+        f'Content-Disposition: form-data; name="file"; filename="{filename}"\r\n'.encode(),
+        b'Content-Type: application/octet-stream\r\n\r\n',
+        payload,
+        f'\r\n--{boundary}--\r\n'.encode(),
+    ])
+    return f'multipart/form-data; boundary={boundary}', body
+
+
+async def read_body(reader, framing, length):
+    """Read and count a response body; returns its size in bytes."""
+    if framing == 'length':
+        await reader.readexactly(length)
+        return length
+    if framing == 'chunked':
+        total = 0
+        while True:
+            size = int((await reader.readline()).split(b';', 1)[0].strip() or b'0', 16)
+            if size == 0:
+                while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                    pass
+                return total
+            await reader.readexactly(size + 2)
+            total += size
+    total = 0
+    while chunk := await reader.read(64 * 1024):
+        total += len(chunk)
+    return total
+
+
+class Client:
+    """A small keep-alive HTTP/1.1 client over a bounded set of connections."""
+
+    def __init__(self, host, port, max_connections):
+        self.host = host
+        self.port = port
+        self.idle = []
+        self.slots = asyncio.Semaphore(max_connections)
+        self.connects = 0
+
+    async def request(self, method, path, headers=(), body=b''):
+        """Send one request; returns (status, json_or_None, body_bytes)."""
+        async with self.slots:
+            if self.idle:
+                reader, writer = self.idle.pop()
+            else:
+                reader, writer = await asyncio.open_connection(self.host, self.port)
+                self.connects += 1
+            reusable = False
+            try:
+                head = [('Host', f'{self.host}:{self.port}'), ('Content-Length', str(len(body))),
+                        *headers]
+                writer.write(serialize_head(f'{method} {path} HTTP/1.1', head) + body)
+                await writer.drain()
+                response = await read_head(reader)
+                if response is None:
+                    raise RequestFailed('connection closed before the response')
+                status_line, resp_headers = response
+                status = int(status_line.split(' ', 2)[1])
+                framing, length = body_framing(resp_headers)
+                if framing == 'length' and (header(resp_headers, 'Content-Type') or '').startswith('application/json'):
+                    payload = await reader.readexactly(length)
+                    data, size = json.loads(payload or b'null'), length
+                else:
+                    data, size = None, await read_body(reader, framing, length)
+                reusable = framing != 'none' and \
+                    'close' not in (header(resp_headers, 'Connection') or '').lower()
+                return status, data, size
+            except (OSError, BadRequest, ValueError, asyncio.IncompleteReadError) as e:
+                raise RequestFailed(f'{type(e).__name__}: {e}') from e
+            finally:
+                if reusable:
+                    self.idle.append((reader, writer))
+                else:
+                    writer.close()
+
+    def close(self):
+        for _, writer in self.idle:
+            writer.close()
+        self.idle.clear()
+
+
+class EndpointStats:
+    def __init__(self):
+        self.latencies = []
+        self.statuses = {}
+        self.errors = 0
+        self.bytes = 0
+
+    def add(self, latency, status=None, size=0):
+        self.latencies.append(latency)
+        self.bytes += size
+        key = str(status) if status is not None else 'exception'
+        self.statuses[key] = self.statuses.get(key, 0) + 1
+        if status is None or status >= 400:
+            self.errors += 1
+
+    def summary(self, elapsed):
+        ordered = sorted(self.latencies)
+        count = len(ordered)
+        return {
+            'requests': count,
+            'errors': self.errors,
+            'error_rate': self.errors / count if count else 0.0,
+            'throughput_rps': count / elapsed if elapsed else 0.0,
+            'mb_per_second': self.bytes / elapsed / 1e6 if elapsed else 0.0,
+            'p50_ms': percentile(ordered, 0.50) * 1000 if count else None,
+            'p95_ms': percentile(ordered, 0.95) * 1000 if count else None,
+            'p99_ms': percentile(ordered, 0.99) * 1000 if count else None,
+            'max_ms': ordered[-1] * 1000 if count else None,
+            'statuses': dict(sorted(self.statuses.items())),
+        }
+
+
+class LoadTest:
+    def __init__(self, client, mix, upload_size, file_names, username, password):
+        self.client = client
+        self.mix = mix
+        self.payload = os.urandom(upload_size)
+        self.file_names = file_names
+        self.username = username
+        self.password = password
+        self.uploaded = []
+        self.upload_names = itertools.cycle(file_names)
+        self.auth = []
+        self.stats = {name: EndpointStats() for name in mix}
+
+    async def login(self):
+        body = json.dumps({'username': self.username, 'password': self.password}).encode()
+        status, data, _ = await self.client.request(
+            'POST', '/api/login', [('Content-Type', 'application/json')], body)
+        if status == 404:
+            print('No /api/login on this server, continuing without a token', file=sys.stderr)
+            return
+        if status != 200 or not data or 'token' not in data:
+            raise SystemExit(f'login failed with status {status}: {data}')
+        self.auth = [('Authorization', f"Bearer {data['token']}")]
+
+    async def do_files(self):
+        status, _, size = await self.client.request('GET', '/api/files', self.auth)
+        return status, size
+
+    async def do_upload(self):
+        name = next(self.upload_names)
+        content_type, body = multipart_body(name, self.payload)
+        status, _, _ = await self.client.request(
+            'POST', '/api/upload', [*self.auth, ('Content-Type', content_type)], body)
+        if status == 200 and name not in self.uploaded:
+            self.uploaded.append(name)
+        return status, len(body)
+
+    async def do_download(self):
+        name = random.choice(self.uploaded or self.file_names)
+        status, _, size = await self.client.request('GET', f'/api/download/{name}', self.auth)
+        return status, size
+
+    async def seed(self, count):
+        """Upload a few files up front so downloads have something to fetch."""
+        if 'download' in self.mix:
+            for _ in range(min(count, len(self.file_names))):
+                await self.do_upload()
+
+    async def one(self, endpoint, scheduled):
+        action = getattr(self, f'do_{endpoint}')
+        try:
+            status, size = await action()
+        except RequestFailed:
+            self.stats[endpoint].add(time.perf_counter() - scheduled)
+            return
+        self.stats[endpoint].add(time.perf_counter() - scheduled, status, size)
+
+    async def run(self, rps, duration, poisson=False):
+        endpoints = list(self.mix)
+        weights = [self.mix[name] for name in endpoints]
+        tasks = set()
+        started = time.perf_counter()
+        next_at = started
+        while next_at < started + duration:
+            delay = next_at - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            endpoint = random.choices(endpoints, weights)[0]
+            task = asyncio.ensure_future(self.one(endpoint, next_at))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+            next_at += random.expovariate(rps) if poisson else 1.0 / rps
+        sent_until = time.perf_counter()
+        if tasks:
+            await asyncio.wait(tasks)
+        return sent_until - started, time.perf_counter() - started
+
+
+def print_report(results):
+    print(f"target {results['target']}  offered {results['offered_rps']:.1f} req/s  "
+          f"for {results['duration_seconds']:.1f} s  ({results['connections_opened']} connections opened)")
+    print(f"{'endpoint':<10} {'reqs':>7} {'req/s':>8} {'errors':>7} {'err %':>6} "
+          f"{'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'max ms':>8}  statuses")
+
+    def fmt(value):
+        return f'{value:8.1f}' if value is not None else f"{'-':>8}"
+
+    for name, s in results['endpoints'].items():
+        statuses = ' '.join(f'{k}:{v}' for k, v in s['statuses'].items())
+        print(f"{name:<10} {s['requests']:>7} {s['throughput_rps']:>8.1f} {s['errors']:>7} "
+              f"{s['error_rate'] * 100:>6.1f} {fmt(s['p50_ms'])} {fmt(s['p95_ms'])} "
+              f"{fmt(s['p99_ms'])} {fmt(s['max_ms'])}  {statuses}")
+
+
+async def main_async(args):
+    client = Client(args.host, args.port, args.concurrency)
+    test = LoadTest(client, args.mix, args.upload_size,
+                    [f'loadtest-{i}.bin' for i in range(args.files)],
+                    args.username, args.password)
+    try:
+        await test.login()
+        await test.seed(args.seed)
+        offered, elapsed = await test.run(args.rps, args.duration, args.poisson)
+    finally:
+        client.close()
+
+    total = EndpointStats()
+    for stats in test.stats.values():
+        total.latencies += stats.latencies
+        total.errors += stats.errors
+        total.bytes += stats.bytes
+        for key, count in stats.statuses.items():
+            total.statuses[key] = total.statuses.get(key, 0) + count
+    endpoints = {name: stats.summary(elapsed) for name, stats in test.stats.items()}
+    endpoints['total'] = total.summary(elapsed)
+    return {
+        'target': f'{args.host}:{args.port}',
+        'variant': next((Path(s).stem for s, p in SERVERS if p == args.port), None),
+        'offered_rps': endpoints['total']['requests'] / offered if offered else 0.0,
+        'duration_seconds': elapsed,
+        'connections_opened': client.connects,
+        'endpoints': endpoints,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Open-loop HTTP load test for a portal server')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5000,
+                        help='Server port, e.g. one of start_multiple_servers.SERVERS (default 5000)')
+    parser.add_argument('--rps', type=float, default=50.0, help='Target requests per second')
+    parser.add_argument('--duration', type=float, default=10.0, help='Seconds of load')
+    parser.add_argument('--concurrency', type=int, default=32, help='Maximum open connections')
+    parser.add_argument('--mix', type=parse_mix, default=parse_mix(DEFAULT_MIX),
+                        help=f'Endpoint weights (default {DEFAULT_MIX})')
+    parser.add_argument('--upload-size', type=parse_size, default=parse_size('4K'),
+                        help='Upload payload size, e.g. 4K or 1M')
+    parser.add_argument('--files', type=int, default=20, help='Distinct upload file names to rotate over')
+    parser.add_argument('--seed', type=int, default=5, help='Files uploaded before the run starts')
+    parser.add_argument('--poisson', action='store_true',
+                        help='Exponential inter-arrival times instead of a fixed interval')
+    parser.add_argument('--username', default='admin')
+    parser.add_argument('--password', default='admin123')
+    parser.add_argument('--json', metavar='PATH', help='Also write the results to PATH as JSON')
+    args = parser.parse_args(argv)
+
+    results = asyncio.run(main_async(args))
+    print_report(results)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f'\nWrote results to {args.json}')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,367 @@
+"""
+Index of the objects in the encrypted store, kept in SQLite next to them.
+
+One row per stored ``<name>.enc`` file of an UPLOAD_FOLDER, in
+``<UPLOAD_FOLDER>/.metadata/index.sqlite3`` so that every instance sharing
+the folder sees the same index. A row records the file's identity (size,
+mtime and inode, see ``identity``), the SHA-256 of its ciphertext and the
+outcome of the last integrity check (scrubber.py), the SHA-256 and length
+of its plaintext as computed while it was encrypted (app.py), and the ID
+of the user who uploaded it.
+
+Small objects are not files of their own but records in a segment file
+(packstore.py). Their rows carry the location, ``segment``,
+``segment_offset`` and ``segment_length``, instead of an inode, and the
+row decides which copy is current: a packed row wins over a ``<name>.enc``
+file of the same name, and a standalone write clears the location.
+``segments`` holds the bytes appended to each segment file and how many of
+them still belong to current records. Triggers keep ``live`` current as rows are packed,
+moved, superseded and deleted, so finding segments worth compacting does
+not scan the objects.
+
+Every digest belongs to the identity stored with it: once the file is
+replaced it describes another file and must not be used.
+
+Storage quotas are accounted in the same database. ``usage`` holds each
+owner's stored bytes and file count. Triggers on ``objects`` keep it up to
+date in the same transaction as every insert, update and delete of a row,
+so reading an owner's usage is one primary-key lookup however many files
+there are. Rows marked ``missing`` (the file is gone) are not charged.
+Uploads in progress hold a ``reservation`` for the bytes they are about to
+write; ``reserve`` admits an upload only if usage plus reservations plus
+the new bytes fit the owner's limit. ``recompute_usage`` rebuilds the
+counters from the rows and corrects any drift (see quota.py).
+
+Columns are declared in COLUMNS; a database created by an older version
+gets the missing ones added when it is opened, so new fields can be
+introduced without a migration step.
+"""
+
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+INDEX_DIR = '.metadata'
+DB_NAME = 'index.sqlite3'
+
+# (column, type); ``name`` is the stored file name without ``.enc``
+COLUMNS = (
+    ('name', 'TEXT PRIMARY KEY'),
+    ('size', 'INTEGER'),
+    ('mtime_ns', 'INTEGER'),
+    ('inode', 'INTEGER'),
+    ('cipher_sha256', 'TEXT'),
+    ('plain_sha256', 'TEXT'),
+    ('plain_size', 'INTEGER'),
+    ('status', 'TEXT'),      # ok, corrupt, missing, error
+    ('error', 'TEXT'),
+    ('checked', 'REAL'),     # time of the last integrity check
+    ('updated', 'REAL'),
+    ('owner', 'INTEGER'),    # user ID of the uploader; NULL for files stored before quotas
+    ('segment', 'INTEGER'),  # packed objects: segment file number, offset and length of the stored bytes
+    ('segment_offset', 'INTEGER'),
+    ('segment_length', 'INTEGER'),
+)
+FIELDS = tuple(name for name, _ in COLUMNS)
+# Reservations of uploads that never finished (the process died) stop counting after this long
+RESERVATION_TTL = 3600
+
+# What a row is charged to its owner: nothing once the file is missing
+_CHARGE = """
+INSERT INTO usage (owner, bytes, files) VALUES ({row}.owner, coalesce({row}.size, 0), {sign})
+ON CONFLICT(owner) DO UPDATE SET bytes = bytes {op} coalesce({row}.size, 0), files = files {op} 1;
+"""
+_CHARGED = "{row}.owner IS NOT NULL AND {row}.status IS NOT 'missing'"
+# Bytes of a packed record in its segment: packstore's header (magic, name length, data length), name and data
+PACKED_HEADER_SIZE = 10
+_RECORD = f"({{row}}.segment_length + {PACKED_HEADER_SIZE} + length(CAST({{row}}.name AS BLOB)))"
+_SCHEMA = f"""
+CREATE TABLE IF NOT EXISTS usage (owner INTEGER PRIMARY KEY, bytes INTEGER NOT NULL, files INTEGER NOT NULL);
+CREATE TABLE IF NOT EXISTS reservations (id INTEGER PRIMARY KEY, owner INTEGER NOT NULL,
+                                         bytes INTEGER NOT NULL, created REAL NOT NULL);
+CREATE INDEX IF NOT EXISTS reservations_owner ON reservations (owner);
+CREATE TRIGGER IF NOT EXISTS usage_insert AFTER INSERT ON objects WHEN {_CHARGED.format(row='NEW')}
+BEGIN {_CHARGE.format(row='NEW', sign=1, op='+')} END;
+CREATE TRIGGER IF NOT EXISTS usage_delete AFTER DELETE ON objects WHEN {_CHARGED.format(row='OLD')}
+BEGIN {_CHARGE.format(row='OLD', sign=-1, op='-')} END;
+CREATE TRIGGER IF NOT EXISTS usage_update_old AFTER UPDATE OF owner, size, status ON objects
+WHEN {_CHARGED.format(row='OLD')}
+BEGIN {_CHARGE.format(row='OLD', sign=-1, op='-')} END;
+CREATE TRIGGER IF NOT EXISTS usage_update_new AFTER UPDATE OF owner, size, status ON objects
+WHEN {_CHARGED.format(row='NEW')}
+BEGIN {_CHARGE.format(row='NEW', sign=1, op='+')} END;
+CREATE TABLE IF NOT EXISTS segments (id INTEGER PRIMARY KEY, bytes INTEGER NOT NULL, live INTEGER NOT NULL);
+CREATE INDEX IF NOT EXISTS objects_segment ON objects (segment, segment_offset) WHERE segment IS NOT NULL;
+CREATE TRIGGER IF NOT EXISTS segment_insert AFTER INSERT ON objects WHEN NEW.segment IS NOT NULL
+BEGIN UPDATE segments SET live = live + {_RECORD.format(row='NEW')} WHERE id = NEW.segment; END;
+CREATE TRIGGER IF NOT EXISTS segment_delete AFTER DELETE ON objects WHEN OLD.segment IS NOT NULL
+BEGIN UPDATE segments SET live = live - {_RECORD.format(row='OLD')} WHERE id = OLD.segment; END;
+CREATE TRIGGER IF NOT EXISTS segment_update_old AFTER UPDATE OF segment, segment_length ON objects
+WHEN OLD.segment IS NOT NULL
+BEGIN UPDATE segments SET live = live - {_RECORD.format(row='OLD')} WHERE id = OLD.segment; END;
+CREATE TRIGGER IF NOT EXISTS segment_update_new AFTER UPDATE OF segment, segment_length ON objects
+WHEN NEW.segment IS NOT NULL
+BEGIN UPDATE segments SET live = live + {_RECORD.format(row='NEW')} WHERE id = NEW.segment; END;
+"""
+
+
+class QuotaExceeded(Exception):
+    """An upload of ``requested`` bytes does not fit its owner's ``limit``."""
+
+    def __init__(self, owner, requested, used, reserved, limit):
+        super().__init__(f'storage quota exceeded: {used} bytes used and {reserved} reserved of {limit}, '
+                         f'{requested} more requested')
+        self.owner = owner
+        self.requested = requested
+        self.used = used
+        self.reserved = reserved
+        self.limit = limit
+
+
+def identity(stat):
+    """``(size, mtime_ns, inode)`` of an ``os.stat`` result; changes whenever the file is replaced."""
+    return stat.st_size, stat.st_mtime_ns, stat.st_ino
+
+
+class MetadataIndex:
+    """The object index of ``upload_folder``."""
+
+    def __init__(self, upload_folder):
+        self.directory = Path(upload_folder) / INDEX_DIR
+        self.path = self.directory / DB_NAME
+        self._local = threading.local()
+
+    def _connect(self):
+        db = getattr(self._local, 'db', None)
+        if db is None or self._local.pid != os.getpid():
+            self.directory.mkdir(parents=True, exist_ok=True)
+            db = sqlite3.connect(self.path, timeout=30)
+            db.row_factory = sqlite3.Row
+            db.execute('PRAGMA journal_mode=WAL')
+            columns = ', '.join(f'{name} {kind}' for name, kind in COLUMNS)
+            db.execute(f'CREATE TABLE IF NOT EXISTS objects ({columns})')
+            existing = {row['name'] for row in db.execute('PRAGMA table_info(objects)')}
+            for name, kind in COLUMNS:
+                if name not in existing:
+                    db.execute(f'ALTER TABLE objects ADD COLUMN {name} {kind}')
+            db.commit()
+            db.executescript(_SCHEMA)
+            self._local.db, self._local.pid = db, os.getpid()
+        return db
+
+    def get(self, name):
+        row = self._connect().execute('SELECT * FROM objects WHERE name = ?', (name,)).fetchone()
+        return dict(row) if row is not None else None
+
+    def all(self):
+        """``{name: row}`` for every indexed object."""
+        return {row['name']: dict(row) for row in self._connect().execute('SELECT * FROM objects')}
+
+    def update(self, name, **fields):
+        """Insert or update the row of ``name``; unknown field names raise ValueError."""
+        unknown = set(fields) - set(FIELDS)
+        if unknown:
+            raise ValueError(f'unknown metadata fields: {sorted(unknown)}')
+        fields['updated'] = time.time()
+        names = ', '.join(fields)
+        placeholders = ', '.join('?' for _ in fields)
+        assignments = ', '.join(f'{field} = excluded.{field}' for field in fields)
+        with self._connect() as db:
+            db.execute(f'INSERT INTO objects (name, {names}) VALUES (?, {placeholders}) '
+                       f'ON CONFLICT(name) DO UPDATE SET {assignments}', (name, *fields.values()))
+
+    def record_plaintext(self, name, stat, sha256, size, owner=None, supersede=True):
+        """Record the plaintext digest of the file ``name`` whose ``os.stat`` is ``stat``.
+
+        ``sha256`` may be None when the writer could not compute it. If the
+        row described another version of the file, its ciphertext digest and
+        check status are cleared as well. An ``owner`` takes the file over
+        (and its bytes onto their usage); None keeps the recorded one.
+
+        A writer that just stored the file makes it the current version
+        (``supersede``), replacing a packed one. A reader recording a digest
+        it computed passes False, so a packed write that happened meanwhile
+        is not undone.
+        """
+        size_, mtime_ns, inode = identity(stat)
+        now = time.time()
+        condition = '' if supersede else ' WHERE segment IS NULL'
+        with self._connect() as db:
+            db.execute('INSERT INTO objects (name, size, mtime_ns, inode, plain_sha256, plain_size, owner, updated) '
+                       'VALUES (?, ?, ?, ?, ?, ?, ?, ?) ON CONFLICT(name) DO UPDATE SET '
+                       'cipher_sha256 = CASE WHEN (size, mtime_ns, inode) = '
+                       '(excluded.size, excluded.mtime_ns, excluded.inode) THEN cipher_sha256 END, '
+                       'status = CASE WHEN (size, mtime_ns, inode) = '
+                       '(excluded.size, excluded.mtime_ns, excluded.inode) THEN status END, '
+                       'error = CASE WHEN (size, mtime_ns, inode) = '
+                       '(excluded.size, excluded.mtime_ns, excluded.inode) THEN error END, '
+                       'size = excluded.size, mtime_ns = excluded.mtime_ns, inode = excluded.inode, '
+                       'plain_sha256 = excluded.plain_sha256, plain_size = excluded.plain_size, '
+                       'owner = coalesce(excluded.owner, owner), updated = excluded.updated, '
+                       'segment = NULL, segment_offset = NULL, segment_length = NULL' + condition,
+                       (name, size_, mtime_ns, inode, sha256, size, owner, now))
+
+    def record_packed(self, segment, appended, objects, owner=None):
+        """Make packed records the current versions of their objects, in one transaction.
+
+        ``appended`` bytes were added to segment ``segment``. ``objects``
+        are ``(name, offset, length, cipher_sha256, plain_sha256,
+        plain_size)`` tuples. Returns ``{name: row}`` of the versions they
+        replaced, for objects that had one.
+        """
+        now = time.time()
+        mtime_ns = time.time_ns()
+        db = self._connect()
+        with db:
+            db.execute('INSERT INTO segments (id, bytes, live) VALUES (?, ?, 0) '
+                       'ON CONFLICT(id) DO UPDATE SET bytes = bytes + excluded.bytes', (segment, appended))
+            names = [entry[0] for entry in objects]
+            replaced = {}
+            for start in range(0, len(names), 500):
+                part = names[start:start + 500]
+                placeholders = ', '.join('?' for _ in part)
+                replaced.update((row['name'], dict(row)) for row in db.execute(
+                    f'SELECT * FROM objects WHERE name IN ({placeholders})', part))
+            db.executemany(
+                'INSERT INTO objects (name, size, mtime_ns, inode, cipher_sha256, plain_sha256, plain_size, owner, '
+                'segment, segment_offset, segment_length, updated) VALUES (?, ?, ?, NULL, ?, ?, ?, ?, ?, ?, ?, ?) '
+                'ON CONFLICT(name) DO UPDATE SET size = excluded.size, mtime_ns = excluded.mtime_ns, inode = NULL, '
+                'cipher_sha256 = excluded.cipher_sha256, plain_sha256 = excluded.plain_sha256, '
+                'plain_size = excluded.plain_size, status = NULL, error = NULL, '
+                'owner = coalesce(excluded.owner, owner), segment = excluded.segment, '
+                'segment_offset = excluded.segment_offset, segment_length = excluded.segment_length, '
+                'updated = excluded.updated',
+                [(name, length, mtime_ns, cipher_sha256, plain_sha256, plain_size, owner, segment, offset, length, now)
+                 for name, offset, length, cipher_sha256, plain_sha256, plain_size in objects])
+        return replaced
+
+    def packed(self, name):
+        """The row of ``name`` if its current version is packed, else None."""
+        row = self._connect().execute('SELECT * FROM objects WHERE name = ? AND segment IS NOT NULL',
+                                      (name,)).fetchone()
+        return dict(row) if row is not None else None
+
+    def packed_objects(self):
+        """``{name: {'segment_length': ..., 'mtime_ns': ...}}`` for every object whose current version is packed.
+
+        Only what listings need, which keeps this a fraction of the cost of
+        full rows at millions of objects.
+        """
+        rows = self._connect().execute(
+            'SELECT name, segment_length, mtime_ns FROM objects WHERE segment IS NOT NULL')
+        return {name: {'segment_length': length, 'mtime_ns': mtime_ns} for name, length, mtime_ns in rows}
+
+    def segments(self):
+        """Rows of the segments table: ``id``, appended ``bytes`` and ``live`` bytes."""
+        return [dict(row) for row in self._connect().execute('SELECT * FROM segments ORDER BY id')]
+
+    def segment_objects(self, segment):
+        """``(name, offset, length)`` of the live records in ``segment``, in file order."""
+        return [tuple(row) for row in self._connect().execute(
+            'SELECT name, segment_offset, segment_length FROM objects WHERE segment = ? ORDER BY segment_offset',
+            (segment,))]
+
+    def move_packed(self, segment, appended, moves):
+        """Point objects at their copies in ``segment``; returns how many still pointed at the original.
+
+        ``moves`` are ``(name, old segment, old offset, new offset)``. An
+        object written or deleted since it was copied is left alone.
+        """
+        db = self._connect()
+        with db:
+            db.execute('INSERT INTO segments (id, bytes, live) VALUES (?, ?, 0) '
+                       'ON CONFLICT(id) DO UPDATE SET bytes = bytes + excluded.bytes', (segment, appended))
+            moved = 0
+            for name, old_segment, old_offset, offset in moves:
+                moved += db.execute('UPDATE objects SET segment = ?, segment_offset = ? '
+                                    'WHERE name = ? AND segment = ? AND segment_offset = ?',
+                                    (segment, offset, name, old_segment, old_offset)).rowcount
+        return moved
+
+    def drop_segment(self, segment):
+        """Forget ``segment`` if no object is stored in it any more; returns whether it was dropped."""
+        db = self._connect()
+        with db:
+            if db.execute('SELECT 1 FROM objects WHERE segment = ? LIMIT 1', (segment,)).fetchone():
+                return False
+            db.execute('DELETE FROM segments WHERE id = ?', (segment,))
+        return True
+
+    def plaintext_digest(self, name, stat):
+        """``(sha256, size)`` of the plaintext of ``name``, or None if unknown for this version."""
+        row = self._connect().execute(
+            'SELECT plain_sha256, plain_size FROM objects WHERE name = ? AND size = ? AND mtime_ns = ? '
+            'AND inode = ? AND plain_sha256 IS NOT NULL', (name, *identity(stat))).fetchone()
+        return (row['plain_sha256'], row['plain_size']) if row is not None else None
+
+    def remove(self, name):
+        with self._connect() as db:
+            db.execute('DELETE FROM objects WHERE name = ?', (name,))
+
+    def usage(self, owner):
+        """``(bytes, files, reserved bytes)`` charged to ``owner``."""
+        db = self._connect()
+        row = db.execute('SELECT bytes, files FROM usage WHERE owner = ?', (owner,)).fetchone()
+        reserved = db.execute('SELECT coalesce(sum(bytes), 0) FROM reservations WHERE owner = ? AND created >= ?',
+                              (owner, time.time() - RESERVATION_TTL)).fetchone()[0]
+        return (row['bytes'], row['files'], reserved) if row is not None else (0, 0, reserved)
+
+    def reserve(self, owner, amount, limit, replaces=(), hold=True):
+        """Admit ``amount`` more bytes for ``owner`` under ``limit`` (None: no limit).
+
+        Bytes of files in ``replaces`` that the owner already has are
+        credited, since writing them frees the old versions. Raises
+        QuotaExceeded if the bytes do not fit. Otherwise, with ``hold``,
+        returns the ID of a reservation that counts against the limit until
+        ``release``; without it nothing is held and None is returned.
+        """
+        now = time.time()
+        replaces = list(replaces)
+        db = self._connect()
+        with db:
+            # Take the write lock first, so no other upload is admitted in between
+            db.execute('DELETE FROM reservations WHERE created < ?', (now - RESERVATION_TTL,))
+            if limit is not None:
+                row = db.execute('SELECT bytes FROM usage WHERE owner = ?', (owner,)).fetchone()
+                used = row['bytes'] if row is not None else 0
+                reserved = db.execute('SELECT coalesce(sum(bytes), 0) FROM reservations WHERE owner = ?',
+                                      (owner,)).fetchone()[0]
+                credit = 0
+                if replaces:
+                    placeholders = ', '.join('?' for _ in replaces)
+                    credit = db.execute(f"SELECT coalesce(sum(size), 0) FROM objects WHERE owner = ? AND "
+                                        f"status IS NOT 'missing' AND name IN ({placeholders})",
+                                        (owner, *replaces)).fetchone()[0]
+                if used + reserved + amount - credit > limit:
+                    raise QuotaExceeded(owner, amount, used, reserved, limit)
+            if not hold:
+                return None
+            return db.execute('INSERT INTO reservations (owner, bytes, created) VALUES (?, ?, ?)',
+                              (owner, amount, now)).lastrowid
+
+    def release(self, reservation):
+        """Drop a reservation returned by ``reserve`` (None is ignored)."""
+        if reservation is None:
+            return
+        with self._connect() as db:
+            db.execute('DELETE FROM reservations WHERE id = ?', (reservation,))
+
+    def recompute_usage(self):
+        """Rebuild ``usage`` from the rows; returns ``{owner: (old, new)}`` for counters that were off.
+
+        Counters are ``(bytes, files)`` pairs.
+        """
+        db = self._connect()
+        with db:
+            db.execute('BEGIN IMMEDIATE')
+            old = {row['owner']: (row['bytes'], row['files']) for row in db.execute('SELECT * FROM usage')}
+            new = {row['owner']: (row['bytes'], row['files']) for row in db.execute(
+                "SELECT owner, coalesce(sum(size), 0) AS bytes, count(*) AS files FROM objects "
+                "WHERE owner IS NOT NULL AND status IS NOT 'missing' GROUP BY owner")}
+            db.execute('DELETE FROM usage')
+            db.executemany('INSERT INTO usage (owner, bytes, files) VALUES (?, ?, ?)',
+                           [(owner, *counters) for owner, counters in new.items()])
+        return {owner: (old.get(owner, (0, 0)), new.get(owner, (0, 0)))
+                for owner in set(old) | set(new) if old.get(owner, (0, 0)) != new.get(owner, (0, 0))}
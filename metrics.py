@@ -0,0 +1,477 @@
+"""
+Prometheus-style metrics for the portal apps, served at ``/metrics``.
+
+Counters, gauges and histograms are kept in plain float slots keyed by
+(metric, sample, labels). Where the slots live depends on how the app runs:
+
+- single process (``app.run``, multi_host.py): an in-memory dict;
+- pre-forked (serve.py sets ``PORTAL_METRICS_DIR``): one mmap'd file per
+  process and kind, ``counter_<pid>.db`` and ``gauge_<pid>.db``. Each
+  process only ever writes its own files; ``/metrics`` in any worker reads
+  all of them and sums the slots, so the output covers the whole server
+  regardless of which worker answers the scrape. Counter and histogram files
+  of dead workers are kept (their totals must not go backwards); gauge files
+  only count while their process is alive.
+
+An update is a dict lookup for the slot offset plus a struct unpack/pack
+under a per-process lock, cheap enough for every request.
+
+File layout: an 8-byte header holding the number of used bytes, followed by
+entries of ``uint32 key length | key (UTF-8 JSON) | padding to 8 | float64``.
+A new entry is written completely before the header is bumped, so readers
+never see a half-written key.
+
+Usage in a portal module::
+
+    metrics.init_app(app, __name__)            # request metrics + /metrics route
+
+    @metrics.crypto_op(__name__, 'encrypt')    # bytes and time spent in AES
+    def encrypt_file(file_data): ...
+
+    metrics.JWT_FAILURES.labels(__name__, 'expired').inc()
+"""
+
+import bisect
+import glob
+import json
+import math
+import mmap
+import os
+import struct
+import threading
+import time
+from functools import wraps
+
+from flask import Response, g, request
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+_INITIAL_FILE_SIZE = 64 * 1024
+_HEADER = struct.Struct('<Q')
+_KEY_LENGTH = struct.Struct('<I')
+_VALUE = struct.Struct('<d')
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+
+
+# ---------------------------------------------------------------------------
+# Value stores
+# ---------------------------------------------------------------------------
+
+class _DictStore:
+    """Slots of a single-process server."""
+
+    def __init__(self):
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def add(self, pairs):
+        with self.lock:
+            for key, amount in pairs:
+                self.values[key] = self.values.get(key, 0.0) + amount
+
+    def entries(self):
+        with self.lock:
+            return list(self.values.items())
+
+
+def _padded(length):
+    return (length + 7) & ~7
+
+
+class _MmapStore:
+    """Slots of one process in a file shared with the other workers."""
+
+    def __init__(self, path, fresh=False):
+        self.path = path
+        self.lock = threading.Lock()
+        self.positions = {}
+        self.file = open(path, 'w+b' if fresh else 'a+b')
+        size = os.fstat(self.file.fileno()).st_size
+        if size < _INITIAL_FILE_SIZE:
+            self.file.truncate(_INITIAL_FILE_SIZE)
+            size = _INITIAL_FILE_SIZE
+        self.map = mmap.mmap(self.file.fileno(), size)
+        self.used = _HEADER.unpack_from(self.map, 0)[0]
+        if self.used == 0:
+            self.used = _HEADER.size
+            _HEADER.pack_into(self.map, 0, self.used)
+        # A pid can be reused; carry on with what the earlier process wrote
+        for key, _, position in _read_entries(self.map, self.used):
+            self.positions[key] = position
+
+    def _allocate(self, key):
+        encoded = key.encode()
+        value_offset = _padded(_KEY_LENGTH.size + len(encoded))
+        needed = self.used + value_offset + _VALUE.size
+        if needed > len(self.map):
+            size = len(self.map)
+            while size < needed:
+                size *= 2
+            self.map.close()
+            self.file.truncate(size)
+            self.map = mmap.mmap(self.file.fileno(), size)
+        start = self.used
+        _KEY_LENGTH.pack_into(self.map, start, len(encoded))
+        self.map[start + _KEY_LENGTH.size:start + _KEY_LENGTH.size + len(encoded)] = encoded
+        _VALUE.pack_into(self.map, start + value_offset, 0.0)
+        self.used = needed
+        _HEADER.pack_into(self.map, 0, self.used)
+        self.positions[key] = start + value_offset
+        return start + value_offset
+
+    def add(self, pairs):
+        with self.lock:
+            for key, amount in pairs:
+                position = self.positions.get(key)
+                if position is None:
+                    position = self._allocate(key)
+                _VALUE.pack_into(self.map, position, _VALUE.unpack_from(self.map, position)[0] + amount)
+
+    def entries(self):
+        with self.lock:
+            return [(key, value) for key, value, _ in _read_entries(self.map, self.used)]
+
+
+def _read_entries(data, used):
+    position = _HEADER.size
+    while position < used:
+        length = _KEY_LENGTH.unpack_from(data, position)[0]
+        key_start = position + _KEY_LENGTH.size
+        key = bytes(data[key_start:key_start + length]).decode()
+        value_position = position + _padded(_KEY_LENGTH.size + length)
+        yield key, _VALUE.unpack_from(data, value_position)[0], value_position
+        position = value_position + _VALUE.size
+
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def _directory():
+    return os.environ.get('PORTAL_METRICS_DIR')
+
+
+def _store(kind):
+    store = _stores.get(kind)
+    if store is None:
+        with _stores_lock:
+            store = _stores.get(kind)
+            if store is None:
+                directory = _directory()
+                if directory:
+                    # Gauges describe this process only; never inherit old values
+                    store = _MmapStore(os.path.join(directory, f'{kind}_{os.getpid()}.db'),
+                                       fresh=kind == 'gauge')
+                else:
+                    store = _DictStore()
+                _stores[kind] = store
+    return store
+
+
+def _reset_after_fork():
+    # The child must not write into its parent's files
+    _stores.clear()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def use_directory(path):
+    """Switch this process to multiprocess mode in ``path``, clearing old files."""
+    os.makedirs(path, exist_ok=True)
+    for old in glob.glob(os.path.join(path, '*.db')):
+        os.remove(old)
+    os.environ['PORTAL_METRICS_DIR'] = path
+    _stores.clear()
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _collect():
+    """{key: summed value} over every process of this server."""
+    directory = _directory()
+    if not directory:
+        totals = {}
+        for kind in ('counter', 'gauge'):
+            for key, value in _store(kind).entries():
+                totals[key] = totals.get(key, 0.0) + value
+        return totals
+
+    # Make sure this process's files exist so an idle worker still scrapes
+    _store('counter'), _store('gauge')
+    totals = {}
+    for path in glob.glob(os.path.join(directory, '*.db')):
+        kind, _, pid = os.path.basename(path)[:-3].partition('_')
+        if kind == 'gauge' and not _pid_alive(int(pid)):
+            continue
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            continue
+        used = min(_HEADER.unpack_from(data, 0)[0], len(data)) if len(data) >= _HEADER.size else 0
+        for key, value, _ in _read_entries(data, used):
+            totals[key] = totals.get(key, 0.0) + value
+    return totals
+
+
+# ---------------------------------------------------------------------------
+# Metric types
+# ---------------------------------------------------------------------------
+
+REGISTRY = []
+
+
+def _key(family, sample, labels):
+    return json.dumps([family, sample, labels], separators=(',', ':'), ensure_ascii=False)
+
+
+class _Metric:
+    kind = None
+    store_kind = 'counter'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def labels(self, *values):
+        child = self._children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError(f'{self.name} expects labels {self.labelnames}, got {values}')
+            with self._lock:
+                child = self._children.get(values)
+                if child is None:
+                    child = self._make_child([list(pair) for pair in zip(self.labelnames, map(str, values))])
+                    self._children[values] = child
+        return child
+
+
+class _CounterChild:
+    def __init__(self, store_kind, key):
+        self.store_kind = store_kind
+        self.key = key
+
+    def inc(self, amount=1.0):
+        _store(self.store_kind).add(((self.key, amount),))
+
+    def dec(self, amount=1.0):
+        _store(self.store_kind).add(((self.key, -amount),))
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def _make_child(self, labels):
+        return _CounterChild(self.store_kind, _key(self.name, self.name, labels))
+
+
+class Gauge(Counter):
+    """Gauge updated with inc()/dec(); summed over the live processes."""
+
+    kind = 'gauge'
+    store_kind = 'gauge'
+
+
+class _HistogramChild:
+    def __init__(self, bounds, bucket_keys, sum_key, count_key):
+        self.bounds = bounds
+        self.bucket_keys = bucket_keys
+        self.sum_key = sum_key
+        self.count_key = count_key
+
+    def observe(self, value):
+        bucket = self.bucket_keys[bisect.bisect_left(self.bounds, value)]
+        _store('counter').add(((bucket, 1.0), (self.sum_key, value), (self.count_key, 1.0)))
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.bounds = tuple(float(b) for b in buckets) + (math.inf,)
+
+    def _make_child(self, labels):
+        # Buckets are stored non-cumulative; exposition adds them up
+        bucket_keys = [_key(self.name, self.name + '_bucket', labels + [['le', _format_value(bound)]])
+                       for bound in self.bounds]
+        return _HistogramChild(self.bounds, bucket_keys,
+                               _key(self.name, self.name + '_sum', labels),
+                               _key(self.name, self.name + '_count', labels))
+
+
+# ---------------------------------------------------------------------------
+# Exposition
+# ---------------------------------------------------------------------------
+
+def _format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    if value == int(value) and abs(value) < 1e15:
+        return str(int(value))
+    return repr(value)
+
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _sample_line(sample, labels, value):
+    if labels:
+        rendered = ','.join(f'{name}="{_escape(val)}"' for name, val in labels)
+        return f'{sample}{{{rendered}}} {_format_value(value)}'
+    return f'{sample} {_format_value(value)}'
+
+
+def generate_latest():
+    """The text exposition format for every registered metric."""
+    by_family = {}
+    for key, value in _collect().items():
+        family, sample, labels = json.loads(key)
+        by_family.setdefault(family, []).append((sample, labels, value))
+
+    lines = []
+    for metric in REGISTRY:
+        lines.append(f'# HELP {metric.name} {metric.documentation}')
+        lines.append(f'# TYPE {metric.name} {metric.kind}')
+        samples = by_family.get(metric.name, [])
+        if metric.kind != 'histogram':
+            for sample, labels, value in sorted(samples, key=lambda s: s[1]):
+                lines.append(_sample_line(sample, labels, value))
+            continue
+
+        series = {}
+        for sample, labels, value in samples:
+            base = tuple(tuple(pair) for pair in labels if pair[0] != 'le')
+            entry = series.setdefault(base, {'buckets': {}, 'sum': 0.0, 'count': 0.0})
+            if sample.endswith('_bucket'):
+                le = dict(labels)['le']
+                entry['buckets'][le] = entry['buckets'].get(le, 0.0) + value
+            elif sample.endswith('_sum'):
+                entry['sum'] += value
+            else:
+                entry['count'] += value
+        for base in sorted(series):
+            entry = series[base]
+            cumulative = 0.0
+            for bound in metric.bounds:
+                le = _format_value(bound)
+                cumulative += entry['buckets'].get(le, 0.0)
+                lines.append(_sample_line(metric.name + '_bucket', list(base) + [('le', le)], cumulative))
+            lines.append(_sample_line(metric.name + '_sum', list(base), entry['sum']))
+            lines.append(_sample_line(metric.name + '_count', list(base), entry['count']))
+    return '\n'.join(lines) + '\n'
+
+
+# ---------------------------------------------------------------------------
+# Portal metrics
+# ---------------------------------------------------------------------------
+
+REQUESTS = Counter('portal_http_requests_total', 'HTTP requests handled',
+                   ['app', 'route', 'method', 'status'])
+LATENCY = Histogram('portal_http_request_duration_seconds', 'Time spent handling a request',
+                    ['app', 'route', 'method'])
+IN_FLIGHT = Gauge('portal_http_requests_in_flight', 'Requests currently being handled', ['app'])
+REQUEST_SIZE = Histogram('portal_http_request_size_bytes', 'Request body sizes (uploads)',
+                         ['app', 'route'], buckets=SIZE_BUCKETS)
+RESPONSE_SIZE = Histogram('portal_http_response_size_bytes', 'Response body sizes (downloads)',
+                          ['app', 'route'], buckets=SIZE_BUCKETS)
+CRYPTO_BYTES = Counter('portal_crypto_bytes_total', 'Bytes passed to encrypt_file/decrypt_file',
+                       ['app', 'op'])
+CRYPTO_SECONDS = Counter('portal_crypto_seconds_total', 'Seconds spent in encrypt_file/decrypt_file',
+                         ['app', 'op'])
+JWT_FAILURES = Counter('portal_jwt_verify_failures_total', 'Rejected bearer tokens',
+                       ['app', 'reason'])
+KEY_LOADS = Counter('portal_key_loads_total', 'Encryption key lookups', ['app', 'source'])
+PLAINTEXT_CACHE_LOOKUPS = Counter('portal_plaintext_cache_lookups_total', 'Decrypted file cache lookups',
+                                  ['app', 'result'])
+PLAINTEXT_CACHE_EVICTIONS = Counter('portal_plaintext_cache_evictions_total',
+                                    'Decrypted file cache entries dropped (and zeroed)', ['app', 'reason'])
+JOBS = Counter('portal_jobs_total', 'Background job events (submitted, done, retried, failed)',
+               ['app', 'kind', 'event'])
+DOWNLOAD_CHECKSUMS = Counter('portal_download_checksums_total',
+                             'Plaintext checksums of downloads (verified, mismatch, recorded)', ['app', 'result'])
+REQUESTS_REJECTED = Counter('portal_requests_rejected_total',
+                             'Requests turned away before the view ran (in_flight cap, or the rate limit rule)',
+                             ['app', 'reason'])
+COMPRESSION_BYTES = Counter('portal_compression_bytes_total', 'Response bytes before (in) and after (out) compression',
+                            ['app', 'encoding', 'stage'])
+PACKED_BYTES = Counter('portal_packed_bytes_total',
+                       'Segment file bytes of packed small objects (appended, or reclaimed by compaction)',
+                       ['app', 'kind'])
+PLAINTEXT_CACHE_BYTES = Gauge('portal_plaintext_cache_bytes', 'Plaintext bytes held in the cache', ['app'])
+
+
+def crypto_op(app_name, op):
+    """Decorator counting bytes and seconds of an encrypt/decrypt function."""
+    def decorator(func):
+        bytes_total = CRYPTO_BYTES.labels(app_name, op)
+        seconds_total = CRYPTO_SECONDS.labels(app_name, op)
+
+        @wraps(func)
+        def wrapper(data, *args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return func(data, *args, **kwargs)
+            finally:
+                seconds_total.inc(time.perf_counter() - started)
+                bytes_total.inc(len(data))
+        return wrapper
+    return decorator
+
+
+def _route():
+    rule = request.url_rule
+    return rule.rule if rule is not None else '<unmatched>'
+
+
+def init_app(app, name=None):
+    """Record request metrics for ``app`` and serve them at /metrics."""
+    name = name or app.import_name
+    in_flight = IN_FLIGHT.labels(name)
+
+    @app.before_request
+    def _metrics_start():
+        g._metrics_started = time.perf_counter()
+        in_flight.inc()
+
+    @app.after_request
+    def _metrics_response(response):
+        route = _route()
+        REQUESTS.labels(name, route, request.method, response.status_code).inc()
+        if request.content_length:
+            REQUEST_SIZE.labels(name, route).observe(request.content_length)
+        if response.content_length is not None:
+            RESPONSE_SIZE.labels(name, route).observe(response.content_length)
+        return response
+
+    @app.teardown_request
+    def _metrics_finish(exc):
+        started = g.pop('_metrics_started', None)
+        if started is None:
+            return
+        in_flight.dec()
+        LATENCY.labels(name, _route(), request.method).observe(time.perf_counter() - started)
+
+    @app.route('/metrics')
+    def metrics():
+        return Response(generate_latest(), mimetype=CONTENT_TYPE)
+
+    app.extensions['metrics'] = name
+    return app
@@ -0,0 +1,245 @@
+"""
+Host every portal variant in a single Python process.
+
+start_multiple_servers.py starts one interpreter per variant, and each of
+them imports Flask, pycryptodome and PyJWT again. This host imports every
+module once into one process and dispatches requests with WSGI:
+
+- ``--mode ports`` (default): one listening socket per entry of
+  start_multiple_servers.SERVERS; requests are dispatched on the port they
+  arrived on, so clients keep using 5000-5005 unchanged.
+- ``--mode prefix``: a single port; werkzeug's DispatcherMiddleware mounts
+  each variant under a path prefix (/app, /unauth, /dir_traversal, /ecb,
+  /sql).
+
+Each variant keeps its own Flask app object, so config, JWT secret and
+encryption key files stay isolated exactly as in the multi-process layout.
+
+``--report`` starts both layouts and prints resident memory and startup time
+for the six-process fleet versus this one-process host (Linux only).
+
+Usage:
+    python multi_host.py
+    python multi_host.py --mode prefix --port 8080
+    python multi_host.py --report
+"""
+
+import argparse
+import importlib
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+from pathlib import Path
+
+from flask import Flask, jsonify
+from werkzeug.middleware.dispatcher import DispatcherMiddleware
+from werkzeug.serving import make_server
+
+from serve import KeepAliveRequestHandler
+from start_multiple_servers import SERVERS
+
+# Path prefix of each variant in prefix mode
+PREFIXES = {
+    'app': '/app',
+    'vuln_unauth': '/unauth',
+    'vuln_dir_traversal': '/dir_traversal',
+    'vuln_ecb_mode': '/ecb',
+    'vuln_sql_injection': '/sql',
+}
+
+
+def load_apps():
+    """Import every variant of SERVERS once; returns {module_name: flask_app}."""
+    apps = {}
+    for script, _ in SERVERS:
+        name = Path(script).stem
+        if name not in apps:
+            apps[name] = importlib.import_module(name).app
+    return apps
+
+
+class PortDispatcher:
+    """WSGI app that picks the variant by the port the request came in on."""
+
+    def __init__(self, apps_by_port):
+        self.apps_by_port = apps_by_port
+
+    def __call__(self, environ, start_response):
+        app = self.apps_by_port.get(int(environ['SERVER_PORT']))
+        if app is None:
+            start_response('404 Not Found', [('Content-Type', 'text/plain')])
+            return [b'No application on this port']
+        return app(environ, start_response)
+
+
+def build_prefix_app(apps):
+    """One WSGI app with every variant mounted under its prefix."""
+    index = Flask('multi_host')
+
+    @index.route('/')
+    def mounts():
+        return jsonify({'mounts': {PREFIXES[name]: name for name in apps}})
+
+    return DispatcherMiddleware(index, {PREFIXES[name]: app for name, app in apps.items()})
+
+
+def serve_ports(apps, host, port_offset=0):
+    """Serve each SERVERS entry on its own port, all from this process."""
+    dispatcher = PortDispatcher({})
+    servers = []
+    for script, port in SERVERS:
+        server = make_server(host, port + port_offset, dispatcher, threaded=True,
+                             request_handler=KeepAliveRequestHandler)
+        dispatcher.apps_by_port[server.port] = apps[Path(script).stem]
+        servers.append((script, server))
+
+    threads = []
+    for script, server in servers:
+        print(f"{script} -> http://{host}:{server.port}")
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        threads.append(thread)
+    print(f"Serving {len(apps)} apps on {len(servers)} ports from one process (pid {os.getpid()})")
+    try:
+        for thread in threads:
+            thread.join()
+    except KeyboardInterrupt:
+        for _, server in servers:
+            server.shutdown()
+
+
+def serve_prefix(apps, host, port):
+    server = make_server(host, port, build_prefix_app(apps), threaded=True,
+                         request_handler=KeepAliveRequestHandler)
+    for name in apps:
+        print(f"{name} -> http://{host}:{port}{PREFIXES[name]}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+# ---------------------------------------------------------------------------
+# Memory / startup report
+# ---------------------------------------------------------------------------
+
+def _rss_kb(pid):
+    """Resident set size of one process in kB, from /proc."""
+    with open(f'/proc/{pid}/status') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1])
+    return 0
+
+
+def _tree_pids(root_pid):
+    """root_pid and all of its descendants (the debug reloader forks a child)."""
+    children = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat') as f:
+                ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(ppid, []).append(int(entry))
+    pids, stack = [], [root_pid]
+    while stack:
+        pid = stack.pop()
+        pids.append(pid)
+        stack.extend(children.get(pid, []))
+    return pids
+
+
+def _wait_for_ports(ports, timeout=60.0):
+    deadline = time.monotonic() + timeout
+    pending = set(ports)
+    while pending and time.monotonic() < deadline:
+        for port in list(pending):
+            try:
+                socket.create_connection(('127.0.0.1', port), timeout=0.2).close()
+                pending.discard(port)
+            except OSError:
+                pass
+        time.sleep(0.05)
+    if pending:
+        raise RuntimeError(f'ports never came up: {sorted(pending)}')
+
+
+def _measure(commands, ports, settle=2.0):
+    """Start commands, wait for every port, return (startup_seconds, rss_kb, process_count)."""
+    started = time.monotonic()
+    procs = [subprocess.Popen(cmd, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+             for cmd, env in commands]
+    try:
+        _wait_for_ports(ports)
+        startup = time.monotonic() - started
+        # Let the debug reloader children finish importing too
+        time.sleep(settle)
+        pids = [pid for proc in procs for pid in _tree_pids(proc.pid)]
+        rss = 0
+        for pid in pids:
+            try:
+                rss += _rss_kb(pid)
+            except OSError:
+                pass
+        return startup, rss, len(pids)
+    finally:
+        for proc in procs:
+            for pid in reversed(_tree_pids(proc.pid)):
+                try:
+                    os.kill(pid, 15)
+                except OSError:
+                    pass
+            proc.wait()
+
+
+def report(port_offset=1000):
+    """Compare the six-process layout with this one-process host."""
+    if not os.path.isdir('/proc'):
+        raise SystemExit('--report needs /proc (Linux)')
+    ports = [port + port_offset for _, port in SERVERS]
+
+    fleet = [([sys.executable, script],
+              {**os.environ, 'FLASK_RUN_PORT': str(port + port_offset), 'FLASK_RUN_HOST': '127.0.0.1'})
+             for script, port in SERVERS]
+    single = [([sys.executable, __file__, '--port-offset', str(port_offset)], dict(os.environ))]
+
+    rows = [('six processes (start_multiple_servers.py)',) + _measure(fleet, ports),
+            ('one process (multi_host.py --mode ports)',) + _measure(single, ports)]
+
+    print(f"{'layout':<44} {'startup s':>10} {'RSS MB':>10} {'processes':>10}")
+    for label, startup, rss, count in rows:
+        print(f"{label:<44} {startup:>10.2f} {rss / 1024:>10.1f} {count:>10}")
+    return rows
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Host all portal variants in one process')
+    parser.add_argument('--mode', choices=['ports', 'prefix'], default='ports')
+    parser.add_argument('--host', default=os.environ.get('FLASK_RUN_HOST', '127.0.0.1'))
+    parser.add_argument('--port', type=int, default=int(os.environ.get('FLASK_RUN_PORT', 8080)),
+                        help='Listening port in prefix mode')
+    parser.add_argument('--port-offset', type=int, default=0,
+                        help='Added to every SERVERS port in ports mode')
+    parser.add_argument('--report', action='store_true',
+                        help='Measure RSS and startup time of both layouts and exit')
+    args = parser.parse_args(argv)
+
+    if args.report:
+        report()
+        return
+
+    apps = load_apps()
+    if args.mode == 'ports':
+        serve_ports(apps, args.host, args.port_offset)
+    else:
+        serve_prefix(apps, args.host, args.port)
+
+
+if __name__ == '__main__':
+    main()
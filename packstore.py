@@ -0,0 +1,315 @@
+"""
+Packed storage of small encrypted objects in large segment files.
+
+Most uploads are a few KB. Stored as ``<name>.enc`` files, each one also
+costs an inode, a directory entry and a filesystem block. At millions of
+files that metadata outweighs the data, and every ``glob`` of
+UPLOAD_FOLDER and every backup walks all of it. Objects up to
+PORTAL_PACK_MAX_BYTES of plaintext (e.g. 65536) can therefore be
+appended as records to segment files in ``<UPLOAD_FOLDER>/.segments``
+instead. Larger ones stay standalone ``.enc`` files.
+
+Packing is off by default. Only app.py knows about packed objects:
+secure_app.py and the vuln_*.py apps glob and write ``<name>.enc`` in the
+same ``protected_files``, so they would not see packed uploads, and an
+``.enc`` they wrote for a packed name would stay hidden behind the index
+row. Turn it on only for an UPLOAD_FOLDER that app.py instances alone
+write to.
+
+A record is a header (magic, name length, data length), the UTF-8 name
+and the stored bytes. The stored bytes are the same ``[IV][ciphertext]``
+a standalone file holds. The metadata index (metadata.py) maps each
+packed object to its segment, offset and length, so a read is one index
+lookup and one positioned read. The headers make a segment
+self-describing, and let the scrubber check that a location really holds
+the object it is supposed to.
+
+Writes append to the newest segment under one lock. A batch goes in with
+a single write and fsync, and only then is it recorded in the index in one
+transaction. A crash in between leaves unreferenced bytes, never a
+reference to bytes that are not there. A new segment is started once the
+newest one has reached PORTAL_SEGMENT_MB (default 64). The index row
+decides which version of an object is current: a packed write supersedes
+a standalone file of the same name, and the file is removed if it is
+still the version the index knew about. A standalone write likewise
+supersedes a packed record.
+
+Overwritten and deleted objects leave dead records behind. ``compact``
+copies the live records of every segment that is at least
+COMPACT_DEAD_RATIO dead (never the newest one, which is still being
+written) to the newest segment. It repoints the index at the copies and
+deletes the old segment. A reader that looked up an old location just
+before it was deleted gets FileNotFoundError on open and looks again. One
+that already has it open keeps reading the old copy, which holds the same
+bytes. app.py queues compaction as a background job when a write or
+delete leaves a segment worth compacting. It can also be run by hand:
+
+    python packstore.py stats                  # segments, live and dead bytes
+    python packstore.py compact                # compact protected_files once
+    python packstore.py compact --every 3600   # keep running, one pass per hour
+"""
+
+import argparse
+import hashlib
+import io
+import json
+import logging
+import os
+import struct
+import sys
+import time
+from pathlib import Path
+
+import metadata
+import metrics
+from storage import file_lock, fsync_directory
+
+logger = logging.getLogger('portal.packstore')
+
+SEGMENT_DIR = '.segments'
+SEGMENT_SUFFIX = '.seg'
+# Objects up to this much plaintext are packed; 0 (the default) stores everything as standalone files
+PACK_MAX_BYTES = int(os.environ.get('PORTAL_PACK_MAX_BYTES') or 0)
+SEGMENT_SIZE = int(os.environ.get('PORTAL_SEGMENT_MB') or 64) * 1024 * 1024
+# Segments with at least this share of dead bytes are compacted
+COMPACT_DEAD_RATIO = 0.5
+# Live data copied per append while compacting, bounding the memory it takes
+COMPACT_BATCH_BYTES = 8 * 1024 * 1024
+MAGIC = b'PSR1'
+# Magic, name length, data length: metadata.PACKED_HEADER_SIZE bytes, which the index counts per record
+_HEADER = struct.Struct('>4sHI')
+
+
+def read_record(f, name, offset, length):
+    """The stored bytes of ``name``'s record at ``offset`` in the open segment ``f``.
+
+    Raises ValueError if the header there does not describe that record.
+    """
+    encoded = name.encode('utf-8')
+    f.seek(offset - _HEADER.size - len(encoded))
+    header = f.read(_HEADER.size + len(encoded))
+    if len(header) < _HEADER.size:
+        raise ValueError(f'{name}: segment ends before the record')
+    magic, name_length, data_length = _HEADER.unpack_from(header)
+    if magic != MAGIC or header[_HEADER.size:] != encoded or data_length != length:
+        raise ValueError(f'{name}: record header does not match the index')
+    data = f.read(length)
+    if len(data) != length:
+        raise ValueError(f'{name}: segment ends inside the record')
+    return data
+
+
+class PackedObject:
+    """A packed object as an archive source: ``size``, ``mtime`` and ``open()``."""
+
+    def __init__(self, store, name, row):
+        self.store = store
+        self.name = name
+        self.size = row['segment_length']
+        self.mtime = row['mtime_ns'] / 1e9
+
+    def open(self):
+        found = self.store.read(self.name)
+        if found is None:
+            raise FileNotFoundError(f'{self.name} is no longer stored')
+        return io.BytesIO(found[1])
+
+
+class PackStore:
+    """The segment files of ``upload_folder`` and their entries in the metadata ``index``."""
+
+    def __init__(self, upload_folder, index=None, app_name='portal'):
+        self.folder = Path(upload_folder)
+        self.directory = self.folder / SEGMENT_DIR
+        self.index = index if index is not None else metadata.MetadataIndex(self.folder)
+        self.app_name = app_name
+
+    def segment_path(self, segment):
+        return self.directory / f'{segment:08d}{SEGMENT_SUFFIX}'
+
+    def _append(self, records, commit):
+        """Append ``(name, data)`` records to the newest segment and call ``commit`` under the lock.
+
+        ``commit(segment, appended, offsets)`` gets the data offset of each
+        record and records them in the index; its result is returned.
+        """
+        self.directory.mkdir(parents=True, exist_ok=True)
+        buffer = bytearray()
+        relative = []
+        for name, data in records:
+            encoded = name.encode('utf-8')
+            buffer += _HEADER.pack(MAGIC, len(encoded), len(data))
+            buffer += encoded
+            relative.append(len(buffer))
+            buffer += data
+        with file_lock(self.directory / 'append'):
+            segments = self.index.segments()
+            segment = segments[-1]['id'] if segments else 1
+            path = self.segment_path(segment)
+            try:
+                size = path.stat().st_size
+            except FileNotFoundError:
+                size = 0
+            if size and size + len(buffer) > SEGMENT_SIZE:
+                segment += 1
+                path = self.segment_path(segment)
+            created = not path.exists()
+            with open(path, 'ab') as f:
+                # Bytes of a write that crashed before its commit stay unreferenced in front of ours
+                start = f.seek(0, os.SEEK_END)
+                f.write(buffer)
+                f.flush()
+                os.fsync(f.fileno())
+            if created:
+                fsync_directory(self.directory)
+            result = commit(segment, len(buffer), [start + offset for offset in relative])
+        metrics.PACKED_BYTES.labels(self.app_name, 'appended').inc(len(buffer))
+        return result
+
+    def put_many(self, objects, owner=None):
+        """Store ``(name, stored bytes, plaintext sha256, plaintext size)`` objects; one write and fsync for all.
+
+        Returns ``{name: row}`` of the versions they replaced. A standalone
+        ``<name>.enc`` that was the replaced version is removed.
+        """
+        cipher_digests = [hashlib.sha256(data).hexdigest() for _, data, _, _ in objects]
+
+        def commit(segment, appended, offsets):
+            return self.index.record_packed(segment, appended, [
+                (name, offset, len(data), cipher_sha256, sha256, size)
+                for (name, data, sha256, size), offset, cipher_sha256 in zip(objects, offsets, cipher_digests)],
+                owner)
+
+        replaced = self._append([(name, data) for name, data, _, _ in objects], commit)
+        for name, row in replaced.items():
+            if row['segment'] is None and row['inode'] is not None:
+                self._remove_superseded(name, row)
+        return replaced
+
+    def _remove_superseded(self, name, row):
+        path = self.folder / (name + '.enc')
+        # Under the writers' lock: a standalone write renamed in since has another identity and is kept
+        with file_lock(path):
+            try:
+                if metadata.identity(path.stat()) != (row['size'], row['mtime_ns'], row['inode']):
+                    return
+                os.unlink(path)
+            except FileNotFoundError:
+                return
+
+    def read(self, name):
+        """``(row, stored bytes)`` of ``name`` if its current version is packed, else None."""
+        for _ in range(3):
+            row = self.index.packed(name)
+            if row is None:
+                return None
+            try:
+                f = open(self.segment_path(row['segment']), 'rb')
+            except FileNotFoundError:
+                # Compacted between the lookup and the open: the row points at the copy now
+                continue
+            with f:
+                return row, read_record(f, name, row['segment_offset'], row['segment_length'])
+        raise FileNotFoundError(f'segment of {name} keeps disappearing')
+
+    def needs_compaction(self, dead_ratio=COMPACT_DEAD_RATIO):
+        segments = self.index.segments()
+        return any(segment['bytes'] - segment['live'] >= segment['bytes'] * dead_ratio
+                   for segment in segments[:-1])
+
+    def compact(self, dead_ratio=COMPACT_DEAD_RATIO):
+        """Compact every sealed segment that is at least ``dead_ratio`` dead; returns a report dict."""
+        report = {'segments': 0, 'moved': 0, 'copied': 0, 'reclaimed': 0}
+        self.directory.mkdir(parents=True, exist_ok=True)
+        with file_lock(self.directory / 'compact'):
+            segments = self.index.segments()
+            for segment in segments[:-1]:
+                if segment['bytes'] - segment['live'] < segment['bytes'] * dead_ratio:
+                    continue
+                moved, copied = self._compact_segment(segment['id'])
+                report['moved'] += moved
+                report['copied'] += copied
+                path = self.segment_path(segment['id'])
+                if self.index.drop_segment(segment['id']):
+                    try:
+                        report['reclaimed'] += path.stat().st_size
+                        path.unlink()
+                    except FileNotFoundError:
+                        pass
+                    report['segments'] += 1
+        metrics.PACKED_BYTES.labels(self.app_name, 'reclaimed').inc(report['reclaimed'])
+        return report
+
+    def _compact_segment(self, segment):
+        moved = copied = 0
+        live = self.index.segment_objects(segment)
+        try:
+            f = open(self.segment_path(segment), 'rb')
+        except FileNotFoundError:
+            return moved, copied
+        with f:
+            start = 0
+            while start < len(live):
+                batch, size = [], 0
+                while start < len(live) and (not batch or size < COMPACT_BATCH_BYTES):
+                    name, offset, length = live[start]
+                    start += 1
+                    try:
+                        batch.append((name, offset, read_record(f, name, offset, length)))
+                    except ValueError as e:
+                        # Left where it is (so the segment is kept) for the scrubber to report
+                        logger.error('not compacting damaged record', extra={'segment': segment, 'error': str(e)})
+                        continue
+                    size += length
+                if not batch:
+                    break
+
+                def commit(new_segment, appended, offsets, batch=batch):
+                    return self.index.move_packed(new_segment, appended, [
+                        (name, segment, offset, new_offset)
+                        for (name, offset, _), new_offset in zip(batch, offsets)])
+
+                moved += self._append([(name, data) for name, _, data in batch], commit)
+                copied += size
+        return moved, copied
+
+    def stats(self):
+        segments = self.index.segments()
+        return {
+            'segments': len(segments),
+            'bytes': sum(segment['bytes'] for segment in segments),
+            'live': sum(segment['live'] for segment in segments),
+            'worth_compacting': sum(1 for segment in segments[:-1]
+                                    if segment['bytes'] - segment['live'] >= segment['bytes'] * COMPACT_DEAD_RATIO),
+        }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Inspect or compact the packed small-object segments')
+    parser.add_argument('command', choices=['stats', 'compact'])
+    parser.add_argument('folder', nargs='?', default='protected_files', help='UPLOAD_FOLDER (default: protected_files)')
+    parser.add_argument('--dead-ratio', type=float, default=COMPACT_DEAD_RATIO,
+                        help=f'Compact segments at least this dead (default: {COMPACT_DEAD_RATIO})')
+    parser.add_argument('--every', type=float, metavar='SECONDS', help='With compact: repeat every SECONDS')
+    parser.add_argument('--json', action='store_true', help='Print the result as JSON')
+    args = parser.parse_args(argv)
+
+    store = PackStore(args.folder)
+    while True:
+        if args.command == 'stats':
+            result = store.stats()
+        else:
+            started = time.perf_counter()
+            result = store.compact(args.dead_ratio)
+            result['seconds'] = round(time.perf_counter() - started, 3)
+        if args.json:
+            print(json.dumps(result))
+        else:
+            print(' '.join(f'{key}={value}' for key, value in result.items()))
+        if args.command != 'compact' or args.every is None:
+            return 0
+        time.sleep(args.every)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
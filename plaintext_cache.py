@@ -0,0 +1,122 @@
+"""
+Bounded in-memory cache of decrypted files, for hot downloads.
+
+A few files (shared reports, templates) are downloaded over and over, and
+every download reads the ciphertext again and runs decrypt_file on it.
+``PlaintextCache`` keeps the plaintext of recently downloaded files within
+a fixed byte budget and evicts the least recently used ones to stay inside
+it.
+
+Entries are keyed by path and remember the version of the file they were
+decrypted from: device, inode, size and modification time, taken with
+``fstat`` on the descriptor the ciphertext is read from, so the version
+always matches the bytes that were decrypted. storage.atomic_write
+replaces a file with a new inode, so an overwritten file never matches its
+old entry; the stale entry is dropped on the next lookup.
+
+Plaintext is held in a ``bytearray`` that is overwritten with zeros when
+the entry is evicted, replaced or cleared, so evicted files do not linger
+in freed memory. Callers get a copy (a memcpy, far cheaper than
+decrypting). That copy and the intermediate buffers of decryption are
+ordinary objects, exactly as without the cache.
+
+The cache is per process: under serve.py each worker has its own budget.
+"""
+
+import ctypes
+import threading
+from collections import OrderedDict
+
+import metrics
+
+
+def version_of(stat):
+    """Version key of a file from its ``os.stat``/``os.fstat`` result."""
+    return (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+
+def _zero(buffer):
+    if buffer:
+        ctypes.memset((ctypes.c_char * len(buffer)).from_buffer(buffer), 0, len(buffer))
+
+
+class _Entry:
+    __slots__ = ('version', 'buffer')
+
+    def __init__(self, version, buffer):
+        self.version = version
+        self.buffer = buffer
+
+
+class PlaintextCache:
+    """LRU cache of file plaintexts, at most ``max_bytes`` in total.
+
+    Files larger than ``max_entry_bytes`` (default: a quarter of the
+    budget) are never cached, so one big download cannot flush every hot
+    small file.
+    """
+
+    def __init__(self, max_bytes, max_entry_bytes=None, app_name='portal'):
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_bytes // 4 if max_entry_bytes is None else max_entry_bytes
+        self.size = 0
+        self._entries = OrderedDict()  # path -> _Entry, least recently used first
+        self._lock = threading.Lock()
+        self._hits = metrics.PLAINTEXT_CACHE_LOOKUPS.labels(app_name, 'hit')
+        self._misses = metrics.PLAINTEXT_CACHE_LOOKUPS.labels(app_name, 'miss')
+        self._evictions = {reason: metrics.PLAINTEXT_CACHE_EVICTIONS.labels(app_name, reason)
+                           for reason in ('capacity', 'stale', 'discard')}
+        self._bytes = metrics.PLAINTEXT_CACHE_BYTES.labels(app_name)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _drop(self, path, reason):
+        # Caller holds the lock
+        entry = self._entries.pop(path)
+        size = len(entry.buffer)
+        _zero(entry.buffer)
+        self.size -= size
+        self._bytes.dec(size)
+        self._evictions[reason].inc()
+
+    def get(self, path, version):
+        """Plaintext of ``path`` at ``version``, or None."""
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is not None and entry.version != version:
+                self._drop(path, 'stale')
+                entry = None
+            if entry is None:
+                self._misses.inc()
+                return None
+            self._entries.move_to_end(path)
+            self._hits.inc()
+            return bytes(entry.buffer)
+
+    def put(self, path, version, plaintext):
+        """Cache ``plaintext`` as ``path`` at ``version``; returns whether it was kept."""
+        size = len(plaintext)
+        if size > self.max_entry_bytes or size > self.max_bytes:
+            return False
+        buffer = bytearray(plaintext)
+        with self._lock:
+            if path in self._entries:
+                self._drop(path, 'stale')
+            while self._entries and self.size + size > self.max_bytes:
+                self._drop(next(iter(self._entries)), 'capacity')
+            self._entries[path] = _Entry(version, buffer)
+            self.size += size
+            self._bytes.inc(size)
+        return True
+
+    def discard(self, path):
+        """Forget ``path``, e.g. after it was deleted."""
+        with self._lock:
+            if path in self._entries:
+                self._drop(path, 'discard')
+
+    def clear(self):
+        with self._lock:
+            for path in list(self._entries):
+                self._drop(path, 'discard')
@@ -0,0 +1,225 @@
+"""
+Client for raw downloads: fetch stored ciphertext and decrypt it locally.
+
+``/api/download/<name>`` decrypts on the server. Clients that hold the
+encryption key themselves, such as backup agents, use
+``/api/download/<name>/raw`` instead: the server sends the stored file
+unchanged (with sendfile, or through the front-end server) and this module
+turns it back into the plaintext.
+
+The stored format is ``[16-byte IV][AES-256-CBC ciphertext of the PKCS#7
+padded plaintext]``, announced by the ``X-Portal-Format`` response header;
+decryption is crypto_stream.decrypt_chunks, the same code the server uses.
+Downloads are decrypted as they arrive, in pieces of CHUNK_SIZE, and written
+to a temporary file that is only renamed into place once the padding has
+checked out, so a wrong key or a truncated response never leaves a
+plausible-looking output file behind.
+
+``--raw`` keeps the ciphertext as it is (e.g. to back it up still
+encrypted), and ``decrypt`` turns such a file into plaintext later.
+
+Usage:
+    python portal_client.py --url http://127.0.0.1:5000 fetch report.pdf
+    python portal_client.py fetch report.pdf -o /backup/report.pdf --key /secure/portal.key
+    python portal_client.py fetch report.pdf --raw -o /backup/report.pdf.enc
+    python portal_client.py decrypt /backup/report.pdf.enc /tmp/report.pdf --key /secure/portal.key
+"""
+
+import argparse
+import contextlib
+import http.client
+import json
+import os
+import sys
+import tempfile
+from pathlib import Path
+from urllib.parse import quote, urlsplit
+
+from crypto_stream import FORMAT, FORMAT_HEADER, decrypt_chunks
+
+DEFAULT_KEY_FILE = 'keys/encryption_key_secure.app.key'
+CHUNK_SIZE = 1024 * 1024
+KEY_SIZE = 32
+
+
+class PortalError(Exception):
+    """The portal refused a request; ``status`` is the HTTP status code."""
+
+    def __init__(self, status, message):
+        super().__init__(f'{status}: {message}')
+        self.status = status
+        self.message = message
+
+
+def load_key(path=DEFAULT_KEY_FILE):
+    """Read the raw 32-byte AES-256 key from ``path``."""
+    with open(path, 'rb') as f:
+        key = f.read()
+    if len(key) != KEY_SIZE:
+        raise ValueError(f'{path}: expected a {KEY_SIZE}-byte key, got {len(key)} bytes')
+    return key
+
+
+def _write_atomically(destination, write):
+    """Call ``write(fileobj)`` on a temporary file, then rename it to ``destination``."""
+    destination = Path(destination)
+    fd, tmp_name = tempfile.mkstemp(prefix='.tmp-', dir=destination.parent)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            written = write(f)
+        os.replace(tmp_name, destination)
+    except BaseException:
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(tmp_name)
+        raise
+    return written
+
+
+def decrypt_stream(key, source, destination, chunk_size=CHUNK_SIZE):
+    """Decrypt the stored-format stream ``source`` into the file object ``destination``.
+
+    Returns the plaintext size. Raises ValueError on a wrong key or a
+    truncated stream.
+    """
+    size = 0
+    for piece in decrypt_chunks(key, source, chunk_size):
+        destination.write(piece)
+        size += len(piece)
+    return size
+
+
+def decrypt_file(key, source_path, destination_path):
+    """Decrypt a raw download saved at ``source_path``; returns the plaintext size."""
+    with open(source_path, 'rb') as source:
+        return _write_atomically(destination_path, lambda f: decrypt_stream(key, source, f))
+
+
+def _copy(source, destination, chunk_size=CHUNK_SIZE):
+    size = 0
+    while True:
+        data = source.read(chunk_size)
+        if not data:
+            return size
+        destination.write(data)
+        size += len(data)
+
+
+class PortalClient:
+    """Minimal HTTP client for one portal instance (or the balancer in front of it)."""
+
+    def __init__(self, url='http://127.0.0.1:5000', token=None, timeout=60):
+        parts = urlsplit(url)
+        if parts.scheme not in ('http', 'https'):
+            raise ValueError(f'unsupported URL: {url}')
+        self.scheme = parts.scheme
+        self.host = parts.hostname
+        self.port = parts.port
+        self.base_path = parts.path.rstrip('/')
+        self.token = token
+        self.timeout = timeout
+
+    def _connection(self):
+        cls = http.client.HTTPSConnection if self.scheme == 'https' else http.client.HTTPConnection
+        return cls(self.host, self.port, timeout=self.timeout)
+
+    def _request(self, method, path, body=None, headers=None):
+        """Send a request; returns ``(connection, response)`` with the body still unread."""
+        headers = dict(headers or {})
+        if self.token:
+            headers['Authorization'] = f'Bearer {self.token}'
+        connection = self._connection()
+        try:
+            connection.request(method, self.base_path + path, body=body, headers=headers)
+            response = connection.getresponse()
+        except BaseException:
+            connection.close()
+            raise
+        if response.status >= 400:
+            try:
+                message = json.loads(response.read()).get('message', response.reason)
+            except ValueError:
+                message = response.reason
+            finally:
+                connection.close()
+            raise PortalError(response.status, message)
+        return connection, response
+
+    def login(self, username, password):
+        """Log in and keep the token for the following requests; returns the token."""
+        connection, response = self._request(
+            'POST', '/api/login', json.dumps({'username': username, 'password': password}).encode(),
+            {'Content-Type': 'application/json'})
+        with contextlib.closing(connection):
+            self.token = json.loads(response.read())['token']
+        return self.token
+
+    @contextlib.contextmanager
+    def open_raw(self, name):
+        """Context manager yielding the HTTP response of a raw download of ``name``."""
+        connection, response = self._request('GET', f"/api/download/{quote(name, safe='')}/raw")
+        with contextlib.closing(connection):
+            stored_format = response.getheader(FORMAT_HEADER)
+            if stored_format != FORMAT:
+                raise PortalError(response.status, f'unexpected stored format {stored_format!r}')
+            yield response
+
+    def download_raw(self, name, destination):
+        """Save the stored ciphertext of ``name`` to the path ``destination``; returns its size."""
+        with self.open_raw(name) as response:
+            return _write_atomically(destination, lambda f: _copy(response, f))
+
+    def download(self, name, key, destination):
+        """Download ``name`` and decrypt it locally into the path ``destination``.
+
+        Returns the plaintext size. Leaves no file behind if the key is wrong
+        (ValueError) or the response was cut short (http.client.IncompleteRead).
+        """
+        with self.open_raw(name) as response:
+            return _write_atomically(destination, lambda f: decrypt_stream(key, response, f))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Download raw ciphertext from the portal and decrypt it locally')
+    parser.add_argument('--url', default=os.environ.get('PORTAL_URL', 'http://127.0.0.1:5000'),
+                        help='Portal base URL (default: $PORTAL_URL or http://127.0.0.1:5000)')
+    parser.add_argument('--username', default='admin')
+    parser.add_argument('--password', default='admin123')
+    parser.add_argument('--key', default=DEFAULT_KEY_FILE, help=f'Key file (default: {DEFAULT_KEY_FILE})')
+    commands = parser.add_subparsers(dest='command', required=True)
+    fetch = commands.add_parser('fetch', help='Download files')
+    fetch.add_argument('names', nargs='+')
+    fetch.add_argument('-o', '--output', help='Output file (one name) or directory (default: current directory)')
+    fetch.add_argument('--raw', action='store_true', help='Keep the ciphertext instead of decrypting it')
+    decrypt = commands.add_parser('decrypt', help='Decrypt a file saved with fetch --raw')
+    decrypt.add_argument('source')
+    decrypt.add_argument('destination')
+    args = parser.parse_args(argv)
+
+    try:
+        if args.command == 'decrypt':
+            size = decrypt_file(load_key(args.key), args.source, args.destination)
+            print(f'{args.destination}: {size} bytes')
+            return 0
+
+        key = None if args.raw else load_key(args.key)
+        client = PortalClient(args.url)
+        client.login(args.username, args.password)
+        for name in args.names:
+            suffix = '.enc' if args.raw else ''
+            if args.output and len(args.names) == 1 and not os.path.isdir(args.output):
+                destination = args.output
+            else:
+                destination = os.path.join(args.output or '.', name + suffix)
+            if args.raw:
+                size = client.download_raw(name, destination)
+            else:
+                size = client.download(name, key, destination)
+            print(f'{destination}: {size} bytes')
+    except (PortalError, OSError, ValueError, http.client.HTTPException) as e:
+        print(f'error: {e}', file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
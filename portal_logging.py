@@ -0,0 +1,195 @@
+"""
+Structured, non-blocking logging for the portal modules.
+
+``setup()`` installs one handler on the root logger. It does not write
+anything itself: it drops the record into a bounded in-memory queue and
+returns. A ``QueueListener`` thread takes records off the queue, renders them
+as one JSON object per line and writes them to stderr (or
+``PORTAL_LOG_FILE``). A slow terminal or disk therefore never stalls a
+request thread; if the queue is full the record is dropped and counted
+instead of blocking.
+
+Configuration, all through the environment:
+
+    PORTAL_LOG_LEVEL    default level of every logger (INFO)
+    PORTAL_LOG_LEVELS   per-logger levels, e.g.
+                        "vuln_dir_traversal=DEBUG,werkzeug=WARNING"
+    PORTAL_LOG_SAMPLE   keep only a fraction of DEBUG/INFO records per
+                        logger, e.g. "werkzeug=0.01,vuln_unauth=0.1";
+                        WARNING and above are always kept
+    PORTAL_LOG_FILE     write to this file instead of stderr
+    PORTAL_LOG_QUEUE    queue size (10000)
+
+Keyword data goes in ``extra`` and comes out as JSON fields::
+
+    logger.info('download', extra={'file': name, 'bytes': len(data)})
+    {"ts": "...", "level": "INFO", "logger": "vuln_dir_traversal",
+     "msg": "download", "pid": 4242, "thread": "Thread-7", "file": "a.txt",
+     "bytes": 5}
+
+Guard expensive arguments with ``logger.isEnabledFor(logging.DEBUG)`` so a
+disabled level costs nothing.
+
+The listener thread does not survive fork(); after a fork the child gets a
+fresh queue and its own listener, so pre-forked serve.py workers keep
+logging.
+"""
+
+import atexit
+import copy
+import datetime
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+import threading
+
+# Attributes every LogRecord has; anything else came in through ``extra``
+_STANDARD_ATTRS = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+
+def _parse_pairs(text):
+    pairs = {}
+    for part in (text or '').split(','):
+        name, sep, value = part.partition('=')
+        if sep and name.strip():
+            pairs[name.strip()] = value.strip()
+    return pairs
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per record."""
+
+    def format(self, record):
+        entry = {
+            'ts': datetime.datetime.fromtimestamp(record.created, datetime.timezone.utc)
+                  .isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+            'pid': record.process,
+            'thread': record.threadName,
+        }
+        for key, value in vars(record).items():
+            if key not in _STANDARD_ATTRS and not key.startswith('_'):
+                entry[key] = value
+        if record.exc_text:
+            entry['exc'] = record.exc_text
+        elif record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class SamplingFilter(logging.Filter):
+    """Keep a fraction of the DEBUG/INFO records of selected loggers."""
+
+    def __init__(self, rates):
+        super().__init__()
+        # Longest prefix first, so "werkzeug.serving" beats "werkzeug"
+        self.rates = sorted(rates.items(), key=lambda item: len(item[0]), reverse=True)
+
+    def rate_for(self, name):
+        for prefix, rate in self.rates:
+            if name == prefix or name.startswith(prefix + '.'):
+                return rate
+        return 1.0
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING or not self.rates:
+            return True
+        rate = self.rate_for(record.name)
+        return rate >= 1.0 or random.random() < rate
+
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that drops (and counts) records instead of blocking."""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # Only make the record picklable-safe and self-contained; the JSON
+        # rendering happens on the listener thread. A copy, like the stdlib
+        # QueueHandler: other handlers of the logger still get the original
+        message = record.getMessage()
+        exc_text = record.exc_text
+        if record.exc_info and not exc_text:
+            exc_text = logging.Formatter().formatException(record.exc_info)
+        record = copy.copy(record)
+        record.msg = message
+        record.args = None
+        record.exc_text = exc_text
+        record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+_handler = None
+_listener = None
+_lock = threading.Lock()
+
+
+def _output_handler():
+    path = os.environ.get('PORTAL_LOG_FILE')
+    handler = logging.FileHandler(path, encoding='utf-8') if path else logging.StreamHandler(sys.stderr)
+    handler.setFormatter(JsonFormatter())
+    return handler
+
+
+def _start_listener():
+    global _listener
+    _listener = logging.handlers.QueueListener(_handler.queue, _output_handler())
+    _listener.start()
+
+
+def _after_fork_in_child():
+    # The parent's listener thread is gone in the child: give the child its
+    # own queue (records queued before the fork belong to the parent)
+    if _handler is not None:
+        _handler.queue = queue.Queue(_handler.queue.maxsize)
+        _start_listener()
+
+
+def setup():
+    """Install the queue handler and levels; safe to call from every module."""
+    global _handler
+    with _lock:
+        if _handler is not None:
+            return
+        root = logging.getLogger()
+        root.setLevel(os.environ.get('PORTAL_LOG_LEVEL', 'INFO').upper())
+        for name, level in _parse_pairs(os.environ.get('PORTAL_LOG_LEVELS')).items():
+            logging.getLogger(name).setLevel(level.upper())
+
+        _handler = NonBlockingQueueHandler(queue.Queue(int(os.environ.get('PORTAL_LOG_QUEUE', 10000))))
+        rates = {name: float(rate) for name, rate in _parse_pairs(os.environ.get('PORTAL_LOG_SAMPLE')).items()}
+        if rates:
+            _handler.addFilter(SamplingFilter(rates))
+        root.addHandler(_handler)
+        _start_listener()
+
+        atexit.register(shutdown)
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=_after_fork_in_child)
+
+
+def shutdown():
+    """Flush everything still queued and stop the listener thread."""
+    if _listener is not None and _listener._thread is not None:
+        _listener.stop()
+    if _handler is not None and _handler.dropped:
+        sys.stderr.write(f'portal_logging: dropped {_handler.dropped} records (queue full)\n')
+
+
+def dropped():
+    """Records dropped so far because the queue was full."""
+    return _handler.dropped if _handler is not None else 0
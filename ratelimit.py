@@ -0,0 +1,243 @@
+"""
+Token-bucket rate limiting and admission control for the portal apps.
+
+A login costs a scrypt password check and an upload a full encryption, so
+one client looping on either can keep every instance busy. Two defences
+run in a before_request hook, before the view does any of that work:
+
+1. Admission control. Each process serves at most ``max_in_flight``
+   requests at a time, counted until the response body has been sent
+   (streamed ZIPs, mmap downloads and compressed streams included; a
+   ``send_file`` body is handed to the server as is and counts until the
+   view returns). Past that a request is answered
+   ``503`` with ``Retry-After: 1`` straight away. Werkzeug's threaded server would
+   otherwise start a thread for every connection and let all of them
+   slow down together. With serve.py the host-wide cap is workers times
+   ``max_in_flight``.
+2. Rate limits. Each rule is a token bucket (``rate`` tokens per second,
+   at most ``burst`` saved up) per key: client IP, user, submitted user
+   name, or whatever the rule's ``key`` function returns for the request.
+   A request takes ``cost`` tokens (1 by default, e.g. the body size for a
+   bytes-per-second rule) from every rule that applies to it. If any
+   bucket is short, it is answered ``429`` with ``Retry-After`` set to
+   when that bucket will have enough.
+
+Buckets live in one SQLite database (WAL) that every process and every app
+sharing the folder use, so a client cannot get around a limit by landing
+on another worker or instance. A check is one UPSERT per rule, in a
+single transaction, that refills, decides and takes tokens atomically.
+If any rule denies the request the transaction is rolled back, so a
+throttled client does not use up its other buckets.
+Its cost does not depend on how many clients there are. Durability is
+off (``synchronous=OFF``): a crash at worst forgets a few recent
+requests. If the database fails, requests are let through and the error
+is logged, so the limiter cannot take the portal down.
+
+Behind balancer.py (or another proxy) every request comes from the
+proxy's address; set PORTAL_TRUSTED_PROXIES to the number of proxies in
+front so the client address is taken from X-Forwarded-For instead.
+"""
+
+import logging
+import math
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+from flask import g, jsonify, request
+
+import metrics
+
+logger = logging.getLogger('portal.ratelimit')
+
+DB_DIR = '.ratelimit'
+DB_NAME = 'buckets.sqlite3'
+# Proxies in front of the app whose X-Forwarded-For entries are trusted
+TRUSTED_PROXIES = int(os.environ.get('PORTAL_TRUSTED_PROXIES') or 0)
+# Buckets untouched for this long are full again and can be dropped
+IDLE_SECONDS = 3600
+PURGE_INTERVAL = 60
+
+_TAKE = '''
+INSERT INTO buckets (key, tokens, updated, allowed) VALUES (:key, :burst - :cost, :now, 1)
+ON CONFLICT(key) DO UPDATE SET
+    tokens = CASE WHEN min(:burst, tokens + max(0, :now - updated) * :rate) >= :cost
+                  THEN min(:burst, tokens + max(0, :now - updated) * :rate) - :cost
+                  ELSE min(:burst, tokens + max(0, :now - updated) * :rate) END,
+    allowed = min(:burst, tokens + max(0, :now - updated) * :rate) >= :cost,
+    updated = max(updated, :now)
+RETURNING tokens, allowed
+'''
+
+
+def client_ip():
+    """The client's address, looking through PORTAL_TRUSTED_PROXIES proxies."""
+    if TRUSTED_PROXIES:
+        forwarded = [part.strip() for part in request.headers.get('X-Forwarded-For', '').split(',') if part.strip()]
+        if len(forwarded) >= TRUSTED_PROXIES:
+            return forwarded[-TRUSTED_PROXIES]
+    return request.remote_addr or 'unknown'
+
+
+class Rule:
+    """A token bucket per ``key()`` for the requests to ``endpoints`` (all if None)."""
+
+    def __init__(self, name, rate, burst, key=client_ip, endpoints=None, cost=None):
+        self.name = name
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.key = key
+        self.endpoints = frozenset(endpoints) if endpoints is not None else None
+        self.cost = cost
+
+    def applies(self, endpoint):
+        return self.endpoints is None or endpoint in self.endpoints
+
+
+class RateLimiter:
+    """Shared token buckets in ``db_path`` plus a per-process in-flight cap."""
+
+    def __init__(self, db_path, app_name='portal', max_in_flight=0, exempt=('metrics',)):
+        self.path = Path(db_path)
+        self.app_name = app_name
+        self.max_in_flight = max_in_flight
+        self.exempt = frozenset(exempt)
+        self.rules = []
+        self._local = threading.local()
+        self._in_flight = 0
+        self._in_flight_lock = threading.Lock()
+        self._purged = 0.0
+
+    def rule(self, name, rate, burst, key=client_ip, endpoints=None, cost=None):
+        """Add a rule; see Rule. Returns the limiter, so rules can be chained."""
+        self.rules.append(Rule(name, rate, burst, key, endpoints, cost))
+        return self
+
+    def _connect(self):
+        db = getattr(self._local, 'db', None)
+        if db is None or self._local.pid != os.getpid():
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            db = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=OFF')
+            db.execute('CREATE TABLE IF NOT EXISTS buckets (key TEXT PRIMARY KEY, tokens REAL NOT NULL, '
+                       'updated REAL NOT NULL, allowed INTEGER NOT NULL) WITHOUT ROWID')
+            self._local.db, self._local.pid = db, os.getpid()
+        return db
+
+    def take(self, checks, now=None):
+        """Take tokens for ``(rule, key, cost)`` checks in one transaction.
+
+        Returns None if all were granted, else ``(rule, retry_after)`` for
+        the bucket that needs the longest wait. Tokens are only taken if
+        every check passes: a denied request leaves all buckets as they were.
+        """
+        now = time.time() if now is None else now
+        denied = None
+        db = self._connect()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            for rule, key, cost in checks:
+                cost = min(float(cost), rule.burst)
+                tokens, allowed = db.execute(_TAKE, {'key': f'{rule.name}:{key}', 'rate': rule.rate,
+                                                     'burst': rule.burst, 'cost': cost, 'now': now}).fetchone()
+                if not allowed:
+                    wait = (cost - tokens) / rule.rate if rule.rate > 0 else IDLE_SECONDS
+                    if denied is None or wait > denied[1]:
+                        denied = (rule, wait)
+            if denied is not None:
+                # Undo what the passing rules took; a throttled client must not drain its other buckets
+                db.execute('ROLLBACK')
+                return denied
+            if now - self._purged > PURGE_INTERVAL:
+                self._purged = now
+                db.execute('DELETE FROM buckets WHERE updated < ?', (now - IDLE_SECONDS,))
+            db.execute('COMMIT')
+        except BaseException:
+            if db.in_transaction:
+                db.execute('ROLLBACK')
+            raise
+        return denied
+
+    def reset(self):
+        """Forget all buckets (tests, or after changing the rules)."""
+        self._connect().execute('DELETE FROM buckets')
+
+    def _admit(self):
+        with self._in_flight_lock:
+            if self.max_in_flight and self._in_flight >= self.max_in_flight:
+                return False
+            self._in_flight += 1
+            return True
+
+    def _release(self):
+        with self._in_flight_lock:
+            self._in_flight -= 1
+
+    def init_app(self, app):
+        """Check every request of ``app`` before its view runs.
+
+        Call it before ``compression.init_app``: after_request hooks run in
+        reverse order, so a body compressed while it is sent is already
+        streamed when the slot is handed to ``call_on_close``.
+        """
+
+        @app.before_request
+        def _limit_request():
+            endpoint = request.endpoint
+            if endpoint in self.exempt:
+                return None
+            if not self._admit():
+                metrics.REQUESTS_REJECTED.labels(self.app_name, 'in_flight').inc()
+                response = jsonify({'message': 'Server busy, try again shortly'})
+                response.status_code = 503
+                response.headers['Retry-After'] = '1'
+                return response
+            g._ratelimit_admitted = True
+
+            checks = []
+            for rule in self.rules:
+                if not rule.applies(endpoint):
+                    continue
+                key = rule.key()
+                if key is None:
+                    continue
+                cost = rule.cost() if rule.cost is not None else 1
+                if cost > 0:
+                    checks.append((rule, key, cost))
+            if not checks:
+                return None
+            try:
+                denied = self.take(checks)
+            except (sqlite3.Error, OSError) as e:
+                logger.warning('rate limiter unavailable, request let through', extra={'error': str(e)})
+                return None
+            if denied is None:
+                return None
+            rule, wait = denied
+            retry_after = max(1, math.ceil(wait))
+            metrics.REQUESTS_REJECTED.labels(self.app_name, rule.name).inc()
+            response = jsonify({'message': 'Too many requests', 'limit': rule.name, 'retry_after': retry_after})
+            response.status_code = 429
+            response.headers['Retry-After'] = str(retry_after)
+            return response
+
+        @app.after_request
+        def _hold_streamed_response(response):
+            # A streamed body (ZIP, mmap download, compressed stream) still holds the worker and its files
+            # after the view returns, so its slot is freed when the server closes the response. A direct
+            # passthrough body (send_file) goes to the server without the response, whose close never runs
+            if (response.is_streamed and not response.direct_passthrough
+                    and g.pop('_ratelimit_admitted', False)):
+                response.call_on_close(self._release)
+            return response
+
+        @app.teardown_request
+        def _release_request(exc):
+            if g.pop('_ratelimit_admitted', False):
+                self._release()
+
+        app.extensions['ratelimit'] = self
+        return self
@@ -0,0 +1,139 @@
+"""
+Sampling profiler for a live portal process.
+
+``profile(seconds)`` starts a background thread that, every ``interval``
+seconds, takes a snapshot of every thread's Python stack with
+``sys._current_frames()`` and counts identical stacks. Nothing is hooked into
+the interpreter (no sys.setprofile/settrace), so the profiled code runs at
+full speed; the cost is one stack walk per thread per sample, paid by the
+sampler thread.
+
+The result is in "collapsed stack" format, one line per distinct stack,
+root first, frames separated by ``;`` and followed by the sample count::
+
+    process_request_thread;serve.py:run_wsgi;app.py:api_download_file;app.py:decrypt_file 42
+
+That is what flamegraph.pl, speedscope and inferno read directly. Each
+stack starts with the thread's name (numbered request threads are merged
+into one name), so request threads, the logging listener and any thread
+pool show up as separate towers.
+
+Only threads of the current process are sampled: under serve.py the
+profile covers the one worker that received the request.
+
+Usage from code::
+
+    stacks = sampler.profile(10, interval=0.005)
+    text = sampler.collapsed(stacks)
+"""
+
+import re
+import sys
+import threading
+import time
+from collections import Counter
+
+DEFAULT_INTERVAL = 0.01
+MAX_SECONDS = 60.0
+
+# "Thread-12 (process_request_thread)" -> "process_request_thread"
+_NUMBERED_THREAD = re.compile(r'^Thread-\d+ \((.+)\)$')
+
+# Only one profile per process at a time
+_busy = threading.Lock()
+
+
+class ProfilerBusy(Exception):
+    pass
+
+
+def _thread_label(name):
+    match = _NUMBERED_THREAD.match(name)
+    return match.group(1) if match else name
+
+
+def _frame_label(code):
+    filename = code.co_filename.replace('\\', '/').rsplit('/', 1)[-1]
+    return f'{filename}:{code.co_name}'
+
+
+def sample_once(counts, skip=()):
+    """Add the current stack of every thread not in ``skip`` to ``counts``."""
+    names = {thread.ident: thread.name for thread in threading.enumerate()}
+    for ident, frame in sys._current_frames().items():
+        if ident in skip:
+            continue
+        stack = []
+        while frame is not None:
+            stack.append(_frame_label(frame.f_code))
+            frame = frame.f_back
+        stack.append(_thread_label(names.get(ident, f'thread-{ident}')))
+        stack.reverse()
+        counts[';'.join(stack)] += 1
+
+
+def profile(seconds, interval=DEFAULT_INTERVAL, exclude_current=True):
+    """Sample every thread for ``seconds``; returns a Counter of stacks.
+
+    With ``exclude_current`` the calling thread is left out, so the request
+    that asked for the profile (and is just waiting here) does not show up.
+    Raises ProfilerBusy if another profile is already running.
+    """
+    seconds = max(0.0, min(float(seconds), MAX_SECONDS))
+    if not _busy.acquire(blocking=False):
+        raise ProfilerBusy('a profile is already running in this process')
+    try:
+        counts = Counter()
+        skip = {threading.get_ident()} if exclude_current else set()
+        state = {'samples': 0}
+
+        def run():
+            skip.add(threading.get_ident())
+            deadline = time.monotonic() + seconds
+            next_at = time.monotonic()
+            while True:
+                now = time.monotonic()
+                if now >= deadline:
+                    break
+                if now < next_at:
+                    time.sleep(next_at - now)
+                    continue
+                sample_once(counts, skip)
+                state['samples'] += 1
+                # Fall behind rather than burst if a sample took too long
+                next_at = max(next_at + interval, now)
+
+        worker = threading.Thread(target=run, name='sampler', daemon=True)
+        worker.start()
+        worker.join()
+        counts.samples = state['samples']
+        return counts
+    finally:
+        _busy.release()
+
+
+def collapsed(counts):
+    """Collapsed-stack text, heaviest stacks first."""
+    return ''.join(f'{stack} {count}\n' for stack, count in counts.most_common())
+
+
+def summary(counts, top=20):
+    """Self and total sample counts per frame, for a quick look without a flamegraph."""
+    self_counts = Counter()
+    total_counts = Counter()
+    for stack, count in counts.items():
+        frames = stack.split(';')[1:]
+        if not frames:
+            continue
+        self_counts[frames[-1]] += count
+        for frame in set(frames):
+            total_counts[frame] += count
+    samples = sum(counts.values())
+    return {
+        'samples': getattr(counts, 'samples', None),
+        'thread_samples': samples,
+        'top_self': [{'frame': f, 'samples': n, 'fraction': n / samples}
+                     for f, n in self_counts.most_common(top)] if samples else [],
+        'top_total': [{'frame': f, 'samples': n, 'fraction': n / samples}
+                      for f, n in total_counts.most_common(top)] if samples else [],
+    }
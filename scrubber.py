@@ -0,0 +1,389 @@
+"""
+Integrity scrubber for the encrypted file store.
+
+Files are stored as ``[IV][AES-256-CBC ciphertext]`` without an
+authentication tag, so until now a damaged ``.enc`` file only showed up
+when a download failed with a padding error. The scrubber walks
+UPLOAD_FOLDER ahead of that and checks every stored file without
+decrypting it:
+
+- the length must be the IV plus a whole number of AES blocks;
+- the last block must decrypt to valid PKCS#7 padding (only the last two
+  blocks are decrypted, no plaintext is kept). This only counts for
+  objects the index records as app.py's (with an owner or a plaintext
+  digest): secure_app.py and the vuln_*.py apps share the folder but
+  encrypt with their own keys, so a failure on any other file is
+  reported as unverifiable, not corrupt. Its identity and digest are
+  still recorded, so the next check catches it rotting;
+- the SHA-256 of the ciphertext must match the one recorded in the
+  metadata index (metadata.py) by the previous pass, unless the file was
+  replaced since then (size, mtime or inode changed). Same identity but
+  different bytes means the data rotted on disk.
+
+Packed objects (packstore.py) get the same checks on their record in the
+segment file, after checking that the record header there names the
+object the index points at.
+
+Results go into the metadata index. Files that fail are reported as
+corrupt. Index entries whose file is gone are reported as missing, and so
+are leftovers that belong to no object: temporary files of interrupted
+writes older than an hour, lock files of deleted objects, ``.enc`` files
+superseded by a packed object, segment files the index no longer knows
+and unknown files.
+
+Files are hashed by a process pool. The workers share one read budget of
+``--rate`` bytes per second and run at a lower CPU (and hence I/O)
+priority, so a pass does not starve live traffic. ``--incremental`` only
+checks files that are new, changed or neither ok nor unverifiable since
+the last pass; a full pass re-reads everything and is what catches bit
+rot.
+
+Usage:
+    python scrubber.py                              # full pass over protected_files
+    python scrubber.py --incremental                # only new or changed files
+    python scrubber.py --rate 20M --workers 2 --json scrub.json
+    python scrubber.py --incremental --every 3600   # keep running, one pass per hour
+
+The exit status is 1 if anything is corrupt, missing or unreadable.
+"""
+
+import argparse
+import hashlib
+import json
+import multiprocessing
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+
+import metadata
+import packstore
+from crypto_stream import BLOCK, IV_SIZE, plaintext_length
+from portal_client import DEFAULT_KEY_FILE, load_key
+from sizes import parse_size
+from storage import LOCK_SUFFIX, TEMP_PREFIX
+
+READ_SIZE = 1024 * 1024
+DEFAULT_RATE = '50M'
+# Temporary files of a write in progress are younger than this
+TEMP_MAX_AGE = 3600
+
+
+class RateLimiter:
+    """Pace readers sharing one budget of ``rate`` bytes per second (0: unlimited).
+
+    The budget is a shared ``multiprocessing.Value``: the time at which the
+    bytes read so far have been paid for. Each read moves it forward and the
+    reader sleeps until then, so the pool as a whole stays at ``rate`` no
+    matter how the files are spread over the workers.
+    """
+
+    def __init__(self, rate, paid_until=None):
+        self.rate = rate
+        self.paid_until = paid_until if paid_until is not None else multiprocessing.Value('d', 0.0)
+
+    def consume(self, amount):
+        if not self.rate:
+            return
+        now = time.monotonic()
+        with self.paid_until.get_lock():
+            until = max(self.paid_until.value, now) + amount / self.rate
+            self.paid_until.value = until
+        if until > now:
+            time.sleep(until - now)
+
+
+# Set in each pool process by _init_worker
+_limiter = None
+
+
+def _init_worker(rate, paid_until):
+    global _limiter
+    _limiter = RateLimiter(rate, paid_until)
+    if hasattr(os, 'nice'):
+        os.nice(10)
+
+
+def check_file(path, key):
+    """Check one stored file (in a pool process); returns a result dict.
+
+    The dict has the file's ``size``, ``mtime_ns``, ``inode`` and ciphertext
+    ``sha256``, plus ``problem`` if the file itself is invalid, ``padding``
+    if its last block does not decrypt with ``key``, or ``error`` if it
+    could not be read.
+    """
+    result = {}
+    try:
+        with open(path, 'rb') as f:
+            result.update(zip(('size', 'mtime_ns', 'inode'), metadata.identity(os.fstat(f.fileno()))))
+            _check_data(result, iter(lambda: f.read(READ_SIZE), b''))
+    except FileNotFoundError:
+        result['vanished'] = True
+        return result
+    except OSError as e:
+        result['error'] = str(e)
+        return result
+    return _check_padding(result, key)
+
+
+def check_packed(segment_path, name, row, key):
+    """Check the record of a packed object (in a pool process); returns a result dict like check_file.
+
+    The identity in the result is the row's: a record never changes once
+    written, only moves.
+    """
+    result = {field: row[field] for field in ('size', 'mtime_ns', 'inode')}
+    try:
+        with open(segment_path, 'rb') as f:
+            data = packstore.read_record(f, name, row['segment_offset'], row['segment_length'])
+    except FileNotFoundError:
+        result['vanished'] = True
+        return result
+    except OSError as e:
+        result['error'] = str(e)
+        return result
+    except ValueError as e:
+        result.update(problem=str(e), sha256=None)
+        return result
+    _check_data(result, (data[i:i + READ_SIZE] for i in range(0, len(data), READ_SIZE)))
+    return _check_padding(result, key)
+
+
+def _check_data(result, pieces):
+    size = result['size']
+    if size < IV_SIZE + BLOCK or (size - IV_SIZE) % BLOCK:
+        result['problem'] = f'invalid length {size}'
+    digest = hashlib.sha256()
+    tail = b''
+    for data in pieces:
+        digest.update(data)
+        tail = data[-2 * BLOCK:] if len(data) >= 2 * BLOCK else (tail + data)[-2 * BLOCK:]
+        if _limiter is not None:
+            _limiter.consume(len(data))
+    result['sha256'] = digest.hexdigest()
+    result['tail'] = tail
+
+
+def _check_padding(result, key):
+    tail = result.pop('tail', b'')
+    if key is not None and 'problem' not in result:
+        try:
+            # The last block and the one before it are all the padding check needs
+            plaintext_length(key, tail)
+        except ValueError as e:
+            result['padding'] = f'last block does not decrypt: {e}'
+    return result
+
+
+def find_orphans(folder, objects, now, packed=(), segments=()):
+    """``(file name, reason)`` for files in ``folder`` that belong to no stored object.
+
+    ``packed`` are the names of packed objects and ``segments`` the IDs of
+    the segment files in the index.
+    """
+    orphans = []
+    for path in folder.iterdir():
+        name = path.name
+        if name.endswith('.enc') and name[:-len('.enc')] in packed and path.is_file():
+            orphans.append((name, 'superseded by a packed object'))
+            continue
+        if name.endswith('.enc') or path.is_dir():
+            continue
+        try:
+            age = now - path.stat().st_mtime
+        except FileNotFoundError:
+            continue
+        if name.startswith(TEMP_PREFIX):
+            if age > TEMP_MAX_AGE:
+                orphans.append((name, 'temporary file of an interrupted write'))
+        elif name.startswith('.') and name.endswith(LOCK_SUFFIX):
+            target = name[1:-len(LOCK_SUFFIX)]
+            stored = target[:-len('.enc')]
+            if target.endswith('.enc') and stored not in objects and stored not in packed:
+                orphans.append((name, 'lock file of a deleted object'))
+        elif not name.startswith('.'):
+            orphans.append((name, 'not a stored object'))
+    for path in (folder / packstore.SEGMENT_DIR).glob('*' + packstore.SEGMENT_SUFFIX):
+        try:
+            segment, age = int(path.stem), now - path.stat().st_mtime
+        except (ValueError, FileNotFoundError):
+            continue
+        # A new segment is in the index once its first append commits; compaction drops old ones before deleting
+        if segment not in segments and age > TEMP_MAX_AGE:
+            orphans.append((f'{packstore.SEGMENT_DIR}/{path.name}', 'segment file not in the index'))
+    return sorted(orphans)
+
+
+def scrub(upload_folder, key, workers=2, rate=parse_size(DEFAULT_RATE), incremental=False):
+    """Run one pass over ``upload_folder``; returns the report dict."""
+    folder = Path(upload_folder)
+    index = metadata.MetadataIndex(folder)
+    known = index.all()
+    now = time.time()
+    started = time.perf_counter()
+    # A packed row is the current version even if a superseded .enc file is still there
+    packed = {name: row for name, row in known.items() if row['segment'] is not None}
+    objects = {p.name[:-len('.enc')]: p for p in folder.glob('*.enc') if p.is_file()
+               and p.name[:-len('.enc')] not in packed}
+    store = packstore.PackStore(folder, index)
+
+    report = {'folder': str(folder), 'incremental': incremental, 'objects': len(objects) + len(packed), 'checked': 0,
+              'skipped': 0, 'bytes': 0, 'ok': 0, 'corrupt': [], 'unverifiable': [],
+              'missing': [], 'errors': [], 'orphans': []}
+    todo = []
+    for name, path in sorted(objects.items()):
+        row = known.get(name)
+        # An unverifiable file has a recorded identity and digest like an ok one; nothing new to learn if unchanged
+        if incremental and row and row['status'] in ('ok', 'unverifiable'):
+            try:
+                unchanged = metadata.identity(path.stat()) == (row['size'], row['mtime_ns'], row['inode'])
+            except FileNotFoundError:
+                continue
+            if unchanged:
+                report['skipped'] += 1
+                continue
+        todo.append((name, path))
+    todo_packed = []
+    for name, row in sorted(packed.items()):
+        # Records are never rewritten in place, so an ok one stays ok until the next full pass
+        if incremental and row['status'] == 'ok':
+            report['skipped'] += 1
+            continue
+        todo_packed.append((name, row))
+
+    if todo or todo_packed:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                 initargs=(rate, multiprocessing.Value('d', 0.0))) as pool:
+            futures = {pool.submit(check_file, path, key): name for name, path in todo}
+            futures.update((pool.submit(check_packed, store.segment_path(row['segment']), name, row, key), name)
+                           for name, row in todo_packed)
+            for future in as_completed(futures):
+                name = futures[future]
+                row = known.get(name)
+                if name in packed:
+                    _record_packed(index, report, name, row, future.result(), now)
+                else:
+                    _record(index, report, name, row, future.result(), now)
+
+    for name, row in sorted(known.items()):
+        if name not in objects and name not in packed:
+            if row['status'] != 'missing':
+                index.update(name, status='missing', error='file not found', checked=now)
+            report['missing'].append(name)
+
+    segments = {segment['id'] for segment in index.segments()}
+    report['orphans'] = [{'file': name, 'reason': reason}
+                         for name, reason in find_orphans(folder, objects, now, packed, segments)]
+    report['seconds'] = round(time.perf_counter() - started, 3)
+    return report
+
+
+def _record(index, report, name, row, result, now):
+    if result.get('vanished'):
+        # Deleted while the pass was running; the next pass reports it
+        return
+    if 'error' in result:
+        index.update(name, status='error', error=result['error'], checked=now)
+        report['errors'].append({'name': name, 'error': result['error']})
+        return
+    report['checked'] += 1
+    report['bytes'] += result['size']
+    fields = {field: result[field] for field in ('size', 'mtime_ns', 'inode')}
+    problem = result.get('problem')
+    same_file = row is not None and (row['size'], row['mtime_ns'], row['inode']) == (
+        result['size'], result['mtime_ns'], result['inode'])
+    if problem is None and same_file and row['cipher_sha256'] and row['cipher_sha256'] != result['sha256']:
+        # Keep the recorded digest: the file stays corrupt until it is rewritten
+        problem = 'ciphertext changed on disk without being rewritten'
+    elif result['sha256'] is not None:
+        fields['cipher_sha256'] = result['sha256']
+    if row is not None and not same_file:
+        # The file was replaced by a writer that did not record its plaintext digest
+        fields.update(plain_sha256=None, plain_size=None)
+    unverifiable = None
+    if problem is None and 'padding' in result:
+        # Only app.py's own uploads are known to use its key; secure_app.py and the vuln_*.py apps write
+        # .enc files with theirs into the same folder, and for those the padding check proves nothing.
+        # Their identity and digest are still recorded, so bit rot in them is caught like in any other file
+        if same_file and (row['owner'] is not None or row['plain_sha256'] is not None):
+            problem = result['padding']
+        else:
+            unverifiable = result['padding']
+    if problem:
+        index.update(name, status='corrupt', error=problem, checked=now, **fields)
+        report['corrupt'].append({'name': name, 'problem': problem})
+    elif unverifiable:
+        index.update(name, status='unverifiable', error=unverifiable, checked=now, **fields)
+        report['unverifiable'].append({'name': name, 'problem': unverifiable})
+    else:
+        index.update(name, status='ok', error=None, checked=now, **fields)
+        report['ok'] += 1
+
+
+def _record_packed(index, report, name, row, result, now):
+    current = index.packed(name)
+    location = ('segment', 'segment_offset', 'segment_length')
+    if current is None or any(current[field] != row[field] for field in location):
+        # Rewritten, deleted or moved by compaction while the pass was running; the next pass checks it
+        return
+    if result.get('vanished'):
+        index.update(name, status='missing', error='segment file not found', checked=now)
+        report['missing'].append(name)
+        return
+    _record(index, report, name, current, result, now)
+
+
+def print_report(report):
+    rate = report['bytes'] / report['seconds'] / 1e6 if report['seconds'] else 0.0
+    print(f"{report['folder']}: {report['objects']} objects, {report['checked']} checked "
+          f"({report['bytes'] / 1e6:.1f} MB at {rate:.1f} MB/s), {report['skipped']} unchanged, "
+          f"{report['ok']} ok, {len(report['corrupt'])} corrupt, {len(report['unverifiable'])} unverifiable, "
+          f"{len(report['missing'])} missing, {len(report['errors'])} unreadable, {len(report['orphans'])} orphans in {report['seconds']:.2f}s")
+    for entry in report['corrupt']:
+        print(f"  corrupt     {entry['name']}: {entry['problem']}")
+    for entry in report['unverifiable']:
+        print(f"  unverifiable {entry['name']}: {entry['problem']}")
+    for name in report['missing']:
+        print(f"  missing     {name}")
+    for entry in report['errors']:
+        print(f"  unreadable  {entry['name']}: {entry['error']}")
+    for entry in report['orphans']:
+        print(f"  orphan      {entry['file']}: {entry['reason']}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Verify the stored .enc files and report damaged or orphaned ones')
+    parser.add_argument('folder', nargs='?', default='protected_files', help='UPLOAD_FOLDER (default: protected_files)')
+    parser.add_argument('--key', default=DEFAULT_KEY_FILE,
+                        help=f'Key file for the padding check (default: {DEFAULT_KEY_FILE}); skipped if missing')
+    parser.add_argument('--workers', type=int, default=2, help='Hashing processes (default: 2)')
+    parser.add_argument('--rate', default=DEFAULT_RATE,
+                        help=f'Total read rate limit, e.g. 20M; 0 for none (default: {DEFAULT_RATE})')
+    parser.add_argument('--incremental', action='store_true', help='Only check files changed since the last pass')
+    parser.add_argument('--every', type=float, metavar='SECONDS', help='Repeat the pass every SECONDS')
+    parser.add_argument('--json', metavar='PATH', help='Also write the report to PATH as JSON')
+    args = parser.parse_args(argv)
+
+    try:
+        key = load_key(args.key)
+    except OSError:
+        print(f'{args.key} not found: padding checks skipped', file=sys.stderr)
+        key = None
+    rate = parse_size(args.rate)
+    workers = max(1, args.workers)
+
+    while True:
+        report = scrub(args.folder, key, workers, rate, args.incremental)
+        print_report(report)
+        if args.json:
+            with open(args.json, 'w') as f:
+                json.dump(report, f, indent=2)
+        failed = report['corrupt'] or report['missing'] or report['errors']
+        if args.every is None:
+            return 1 if failed else 0
+        time.sleep(args.every)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
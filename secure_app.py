@@ -39,6 +39,17 @@ from Crypto.Util.Padding import pad, unpad
 from Crypto.Random import get_random_bytes
 import jwt
 import datetime
+import startup
+import metrics
+import compression
+import json_provider
+import timing
+import tracing
+import portal_logging
+from storage import atomic_write
+
+# Structured JSON logging, written by a background thread
+portal_logging.setup()
 
 # Initialize Flask application
 app = Flask(__name__)
@@ -50,6 +61,16 @@ app.config['JWT_SECRET_KEY'] = secrets.token_hex(32)  # For JWT tokens
 # Enable CORS for API endpoints
 CORS(app, resources={r"/api/*": {"origins": "*"}})
 
+# Request, latency and crypto metrics at /metrics
+metrics.init_app(app, __name__)
+# Per-phase Server-Timing header on every response
+timing.init_app(app, __name__)
+# Request traces with one span per phase, when PORTAL_TRACE_DIR is set
+tracing.init_app(app, __name__)
+# orjson-backed jsonify (stdlib fallback) and gzip/br compression of JSON responses
+json_provider.init_app(app)
+compression.init_app(app, __name__)
+
 # Initialize Flask-Login
 login_manager = LoginManager()
 login_manager.init_app(app)
@@ -61,16 +82,22 @@ os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 os.makedirs('keys', exist_ok=True)
 
 # Simple user storage (in production, use a database)
-users = {
-    'admin': {
-        'password': generate_password_hash('admin123'),
-        'id': 1
-    },
-    'user1': {
-        'password': generate_password_hash('password123'),
-        'id': 2
-    }
-}
+users = {}
+
+def init_users():
+    users.update({
+        'admin': {
+            'password': generate_password_hash('admin123'),
+            'id': 1
+        },
+        'user1': {
+            'password': generate_password_hash('password123'),
+            'id': 2
+        }
+    })
+
+# Password hashing dominates startup; PORTAL_LAZY_INIT=1 defers it to the first request
+startup.deferred(app, __name__, 'hash users', init_users)
 
 class User(UserMixin):
     def __init__(self, username, user_id):
@@ -89,14 +116,18 @@ def get_encryption_key():
     """Get or generate encryption key for file encryption"""
     key_file = Path('keys/encryption_key.key')
     if key_file.exists():
+        metrics.KEY_LOADS.labels(__name__, 'file').inc()
         with open(key_file, 'rb') as f:
             return f.read()  # 返回32字节AES-256密钥
     else:
         key = get_random_bytes(32)  # AES-256 requires 32 bytes
         with open(key_file, 'wb') as f:
             f.write(key)
+        metrics.KEY_LOADS.labels(__name__, 'generated').inc()
         return key
 
+@metrics.crypto_op(__name__, 'encrypt')
+@timing.timed('encrypt')
 def encrypt_file(file_data):
     """
     Encrypt file data using AES-256 in CBC mode.
@@ -118,6 +149,8 @@ def encrypt_file(file_data):
     # 即使同一文件，IV不同 → 密文完全不同
     return iv + encrypted_data  # Format: [IV][Encrypted Data]# IV前置存储
 
+@metrics.crypto_op(__name__, 'decrypt')
+@timing.timed('decrypt')
 def decrypt_file(encrypted_data):
     """
     Decrypt file data using AES-256 in CBC mode.
@@ -162,6 +195,7 @@ def token_required(f):
         token = request.headers.get('Authorization')
         
         if not token:
+            metrics.JWT_FAILURES.labels(__name__, 'missing').inc()
             return jsonify({'message': 'Token is missing'}), 401
         
         try:
@@ -169,11 +203,14 @@ def token_required(f):
             if token.startswith('Bearer '):
                 token = token[7:]
                 
-            data = jwt.decode(token, app.config['JWT_SECRET_KEY'], algorithms=['HS256'])
+            with timing.phase('auth'):
+                data = jwt.decode(token, app.config['JWT_SECRET_KEY'], algorithms=['HS256'])
             current_user = User(data['username'], data['id'])
         except jwt.ExpiredSignatureError:
+            metrics.JWT_FAILURES.labels(__name__, 'expired').inc()
             return jsonify({'message': 'Token has expired'}), 401
         except jwt.InvalidTokenError:
+            metrics.JWT_FAILURES.labels(__name__, 'invalid').inc()
             return jsonify({'message': 'Token is invalid'}), 401
             
         return f(current_user, *args, **kwargs)
@@ -222,15 +259,17 @@ def api_list_files(current_user):
     # List available files
     files = []
     files_dir = Path(app.config['UPLOAD_FOLDER'])
-    if files_dir.exists():
-        for file_path in files_dir.glob('*.enc'):
-            files.append({
-                'name': file_path.stem,  # filename without .enc extension
-                'size': file_path.stat().st_size,
-                'encrypted_name': file_path.name
-            })
+    with timing.phase('lookup'):
+        if files_dir.exists():
+            for file_path in files_dir.glob('*.enc'):
+                files.append({
+                    'name': file_path.stem,  # filename without .enc extension
+                    'size': file_path.stat().st_size,
+                    'encrypted_name': file_path.name
+                })
     
-    return jsonify({'files': files})
+    with timing.phase('serialize'):
+        return jsonify({'files': files})
 
 @app.route('/api/upload', methods=['POST'])
 @token_required
@@ -248,7 +287,8 @@ def api_upload_file(current_user):
         return jsonify({'message': 'Invalid filename'}), 400
     
     # Read file data
-    file_data = file.read()
+    with timing.phase('io_read'):
+        file_data = file.read()
     
     # Encrypt the file
     encrypted_data = encrypt_file(file_data)
@@ -258,11 +298,14 @@ def api_upload_file(current_user):
     file_path = Path(app.config['UPLOAD_FOLDER']) / encrypted_filename
     
     # Validate path to prevent directory traversal
-    if not is_safe_path(app.config['UPLOAD_FOLDER'], encrypted_filename):
+    with timing.phase('lookup'):
+        path_ok = is_safe_path(app.config['UPLOAD_FOLDER'], encrypted_filename)
+    if not path_ok:
         return jsonify({'message': 'Invalid file path'}), 400
     
-    with open(file_path, 'wb') as f:
-        f.write(encrypted_data)
+    # Temp file + fsync + locked rename: readers never see a partial file
+    with timing.phase('io_write'):
+        atomic_write(file_path, encrypted_data)
     
     return jsonify({
         'message': f'File {filename} uploaded and encrypted successfully!',
@@ -281,15 +324,18 @@ def api_download_file(current_user, filename):
     file_path = Path(app.config['UPLOAD_FOLDER']) / encrypted_filename
     
     # Validate path to prevent directory traversal
-    if not is_safe_path(app.config['UPLOAD_FOLDER'], encrypted_filename):
+    with timing.phase('lookup'):
+        path_ok = is_safe_path(app.config['UPLOAD_FOLDER'], encrypted_filename)
+        exists = path_ok and file_path.exists()
+    if not path_ok:
         return jsonify({'message': 'Invalid file path'}), 400
     
-    if not file_path.exists():
+    if not exists:
         return jsonify({'message': 'File not found'}), 404
     
     try:
         # Read encrypted file
-        with open(file_path, 'rb') as f:
+        with timing.phase('io_read'), open(file_path, 'rb') as f:
             encrypted_data = f.read()
         
         # Decrypt the file
@@ -300,12 +346,13 @@ def api_download_file(current_user, filename):
         file_obj = BytesIO(decrypted_data)
         file_obj.seek(0)
         
-        return send_file(
-            file_obj,
-            as_attachment=True,
-            download_name=safe_filename,
-            mimetype='application/octet-stream'
-        )
+        with timing.phase('serialize'):
+            return send_file(
+                file_obj,
+                as_attachment=True,
+                download_name=safe_filename,
+                mimetype='application/octet-stream'
+            )
     except Exception as e:
         return jsonify({'message': f'Error decrypting file: {str(e)}'}), 500
 
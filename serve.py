@@ -0,0 +1,373 @@
+"""
+Production launcher for the portal apps.
+
+The modules in this repository end with ``app.run(debug=True)``, which is the
+single-process Werkzeug development server with the debugger and reloader on.
+This script is the production launch mode instead:
+
+1. Import the portal module once in the master process. Everything the module
+   does at import time (key files, user store, password hashes, database
+   setup) happens exactly once.
+2. Bind one listening socket.
+3. Pre-fork N worker processes. Every worker inherits the loaded app and the
+   socket and accepts connections on it; the kernel spreads new connections
+   across the workers.
+4. Supervise the workers: restart any that die, and shut all of them down on
+   SIGINT/SIGTERM.
+
+File responses (``send_file`` with a path, e.g. raw ciphertext downloads)
+are sent with ``socket.sendfile``: the kernel copies from the page cache to
+the socket and the body never passes through Python.
+
+Each process writes its /metrics counters to its own file under
+PORTAL_METRICS_DIR (a temporary directory unless set), and every worker
+aggregates all of them when scraped; see metrics.py.
+
+Bind address and worker count come from one place, ``get_server_config``:
+command line flags first, then the FLASK_RUN_HOST / FLASK_RUN_PORT /
+PORTAL_WORKERS environment variables (the same ones start_multiple_servers.py
+sets), then the per-module default port.
+
+Usage:
+    python serve.py app --workers 4
+    FLASK_RUN_PORT=5004 PORTAL_WORKERS=4 python serve.py app
+"""
+
+import argparse
+import functools
+import importlib
+import os
+import shutil
+import signal
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+from werkzeug.serving import WSGIRequestHandler, make_server, select_address_family, get_sockaddr
+from werkzeug.wsgi import FileWrapper
+
+import metrics
+import portal_logging
+import startup
+import tracing
+
+# Default port of each portal module, mirroring their own __main__ blocks
+DEFAULT_PORTS = {
+    'app': 5000,
+    'secure_app': 5000,
+    'vuln_unauth': 5001,
+    'vuln_dir_traversal': 5002,
+    'vuln_ecb_mode': 5003,
+    'vuln_sql_injection': 5005,
+}
+
+# A worker that dies sooner than this after starting is considered crashing;
+# the supervisor backs off instead of restarting it in a tight loop.
+MIN_WORKER_LIFETIME = 1.0
+
+# Idle keep-alive connections are dropped after this many seconds. Keep it
+# above balancer.POOL_IDLE_TIMEOUT so the proxy retires pooled connections
+# before the worker does.
+KEEPALIVE_TIMEOUT = 60
+
+
+class _BodylessInput:
+    """rfile proxy for a request without a body: ``read()`` is always EOF.
+
+    After each response Werkzeug drains whatever is readable on the socket.
+    On a kept-alive connection that would swallow the next request, so the
+    drain has to see EOF instead. ``readline()`` still reaches the real
+    stream, which is how http.server reads the next request line.
+    """
+
+    def __init__(self, rfile):
+        self._rfile = rfile
+
+    def read(self, *args):
+        return b''
+
+    def __getattr__(self, name):
+        return getattr(self._rfile, name)
+
+
+class SendfileWrapper(FileWrapper):
+    """``wsgi.file_wrapper`` that sends a whole file body with ``socket.sendfile``.
+
+    Werkzeug iterates the response and writes each piece. The first
+    iteration yields ``b''``, which makes it send the status line and
+    headers; the second sends exactly Content-Length bytes from the file
+    descriptor straight to the socket and ends the body. Anything else falls
+    back to reading the file in pieces as FileWrapper does: objects without
+    a file descriptor (BytesIO), a range response (werkzeug seeks the file
+    first) and responses without a Content-Length (sent chunked).
+    """
+
+    def __init__(self, handler, file, buffer_size=8192):
+        super().__init__(file, buffer_size)
+        self.handler = handler
+        try:
+            file.fileno()
+            self._stage = 'headers'
+        except (AttributeError, OSError, ValueError):
+            self._stage = None
+
+    def seek(self, *args):
+        self._stage = None
+        super().seek(*args)
+
+    def __next__(self):
+        if self._stage == 'headers':
+            self._stage = 'body'
+            return b''
+        if self._stage == 'body':
+            self._stage = None
+            length = self.handler._response_length
+            if length is not None:
+                self._send(length)
+                raise StopIteration
+        return super().__next__()
+
+    def _send(self, length):
+        sent = self.handler.connection.sendfile(self.file, self.file.tell(), length)
+        if sent != length:
+            # The file shrank under us: the client is owed bytes it will
+            # never get, so the connection cannot carry another response
+            self.handler.close_connection = True
+            raise ConnectionError(f'sendfile sent {sent} of {length} bytes')
+
+
+class KeepAliveRequestHandler(WSGIRequestHandler):
+    """Request handler that keeps HTTP/1.1 connections open when it is safe.
+
+    Werkzeug always answers ``Connection: close`` because http.server cannot
+    drain an unread request body before parsing the next request line. A
+    request without a body has nothing to drain, so for those the connection
+    is kept alive. That is what lets balancer.py reuse pooled upstream
+    connections.
+    """
+
+    timeout = KEEPALIVE_TIMEOUT
+    _keep_alive = False
+    # Content-Length of the response being sent, when SendfileWrapper may use it
+    _response_length = None
+
+    def setup(self):
+        super().setup()
+        # Headers and body go out in separate writes; without NODELAY the
+        # second write of a kept-alive response waits on a delayed ACK
+        if self.connection.family in (socket.AF_INET, socket.AF_INET6):
+            self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def make_environ(self):
+        environ = super().make_environ()
+        environ['wsgi.file_wrapper'] = functools.partial(SendfileWrapper, self)
+        return environ
+
+    def run_wsgi(self):
+        self._response_length = None
+        self._keep_alive = self._can_keep_alive()
+        if not self._keep_alive:
+            return super().run_wsgi()
+        rfile = self.rfile
+        self.rfile = _BodylessInput(rfile)
+        try:
+            super().run_wsgi()
+        finally:
+            self.rfile = rfile
+            self._keep_alive = False
+
+    def _can_keep_alive(self):
+        if self.request_version != 'HTTP/1.1':
+            return False
+        if self.headers.get('Connection', '').lower() == 'close':
+            return False
+        if 'chunked' in self.headers.get('Transfer-Encoding', '').lower():
+            return False
+        return self.headers.get('Content-Length', '0').strip() in ('', '0')
+
+    def send_header(self, keyword, value):
+        keyword_lower = keyword.lower()
+        if keyword_lower == 'connection' and value.lower() == 'close' and self._keep_alive:
+            return
+        if keyword_lower == 'content-length':
+            self._response_length = int(value)
+        elif keyword_lower == 'transfer-encoding':
+            # A chunked body needs framing around every piece
+            self._response_length = None
+        super().send_header(keyword, value)
+
+
+def get_server_config(module_name, host=None, port=None, workers=None):
+    """Resolve bind address and worker count for a portal module.
+
+    Explicit arguments win, then environment variables, then defaults.
+    Returns a ``(host, port, workers)`` tuple.
+    """
+    if host is None:
+        host = os.environ.get('FLASK_RUN_HOST', '127.0.0.1')
+    if port is None:
+        port = int(os.environ.get('FLASK_RUN_PORT', DEFAULT_PORTS.get(module_name, 5000)))
+    if workers is None:
+        workers = int(os.environ.get('PORTAL_WORKERS', os.cpu_count() or 1))
+    return host, port, max(1, workers)
+
+
+def load_app(module_name):
+    """Import a portal module and return its Flask application object."""
+    module = importlib.import_module(module_name)
+    return module.app
+
+
+def create_listen_socket(host, port, backlog=1024):
+    """Bind the shared listening socket in the master process."""
+    family = select_address_family(host, port)
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(get_sockaddr(host, port, family))
+    sock.listen(backlog)
+    sock.set_inheritable(True)
+    return sock
+
+
+def run_worker(app, host, port, sock):
+    """Serve requests on the inherited socket until told to stop."""
+    # The master's handlers must not run in the worker
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    server = make_server(host, port, app, threaded=True,
+                         request_handler=KeepAliveRequestHandler, fd=sock.fileno())
+
+    def _stop(signum, frame):
+        # shutdown() waits for serve_forever to return, so it has to run on
+        # another thread than the one this handler interrupted
+        threading.Thread(target=server.shutdown, daemon=True).start()
+
+    signal.signal(signal.SIGTERM, _stop)
+    server.serve_forever()
+    # Let background job threads finish what they are on; a job cut short
+    # is run again elsewhere once its lease expires
+    job_queue = app.extensions.get('jobs')
+    if job_queue is not None:
+        job_queue.shutdown()
+    # os._exit skips atexit: flush the log queue and trace file by hand
+    portal_logging.shutdown()
+    tracing.shutdown()
+    os._exit(0)
+
+
+class Supervisor:
+    """Pre-forks and babysits worker processes sharing one socket."""
+
+    def __init__(self, app, host, port, workers, sock):
+        self.app = app
+        self.host = host
+        self.port = port
+        self.workers = workers
+        self.sock = sock
+        self.children = {}  # pid -> start time
+        self.running = True
+
+    def spawn(self):
+        pid = os.fork()
+        if pid == 0:
+            try:
+                run_worker(self.app, self.host, self.port, self.sock)
+            finally:
+                os._exit(1)
+        self.children[pid] = time.monotonic()
+        return pid
+
+    def stop(self, signum=None, frame=None):
+        self.running = False
+
+    def run(self):
+        signal.signal(signal.SIGINT, self.stop)
+        signal.signal(signal.SIGTERM, self.stop)
+
+        for _ in range(self.workers):
+            self.spawn()
+        print(f"Serving on http://{self.host}:{self.port} with {self.workers} workers "
+              f"(master pid {os.getpid()})")
+
+        while self.running:
+            # Poll instead of blocking: a blocking waitpid() is transparently
+            # restarted after our signal handlers run and would never notice
+            # that self.running went False.
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                break
+            if pid == 0:
+                time.sleep(0.2)
+                continue
+            started = self.children.pop(pid, None)
+            if started is None or not self.running:
+                continue
+            print(f"Worker {pid} exited with status {status}, restarting")
+            if time.monotonic() - started < MIN_WORKER_LIFETIME:
+                time.sleep(MIN_WORKER_LIFETIME)
+            self.spawn()
+
+        self.shutdown()
+
+    def shutdown(self):
+        for pid in list(self.children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        for pid in list(self.children):
+            try:
+                os.waitpid(pid, 0)
+            except ChildProcessError:
+                pass
+        self.children.clear()
+        self.sock.close()
+        print("All workers stopped")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Pre-fork production server for the portal apps')
+    parser.add_argument('module', nargs='?', default='app',
+                        help='Portal module to serve (app, vuln_unauth, ...)')
+    parser.add_argument('--host', default=None, help='Bind address (default: $FLASK_RUN_HOST or 127.0.0.1)')
+    parser.add_argument('--port', type=int, default=None, help='Bind port (default: $FLASK_RUN_PORT or module default)')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='Number of worker processes (default: $PORTAL_WORKERS or CPU count)')
+    args = parser.parse_args(argv)
+
+    host, port, workers = get_server_config(args.module, args.host, args.port, args.workers)
+
+    # Workers keep their metrics in per-process files of one directory so
+    # that /metrics on any worker reports the whole server
+    own_metrics_dir = None
+    if hasattr(os, 'fork'):
+        metrics_dir = os.environ.get('PORTAL_METRICS_DIR')
+        if not metrics_dir:
+            metrics_dir = own_metrics_dir = tempfile.mkdtemp(prefix='portal-metrics-')
+        metrics.use_directory(metrics_dir)
+
+    # Keys, users and databases are set up here, once, before forking,
+    # including steps that PORTAL_LAZY_INIT would otherwise defer
+    app = load_app(args.module)
+    app.debug = False
+    startup.initialize_all()
+
+    if not hasattr(os, 'fork'):
+        # No fork() on Windows: fall back to a single threaded server
+        print(f"os.fork() is not available, serving {args.module} with a single process")
+        make_server(host, port, app, threaded=True,
+                    request_handler=KeepAliveRequestHandler).serve_forever()
+        return
+
+    sock = create_listen_socket(host, port)
+    try:
+        Supervisor(app, host, port, workers, sock).run()
+    finally:
+        if own_metrics_dir:
+            shutil.rmtree(own_metrics_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
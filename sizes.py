@@ -0,0 +1,30 @@
+"""
+Byte sizes written the short way: ``16``, ``4K``, ``16M``, ``1.5G``.
+
+The units are binary (1K is 1024 bytes) and a trailing ``B`` is ignored.
+The benchmarks use these for their command-line sizes. quota.py and
+scrubber.py use them too, so this module must stay free of imports that
+the apps do not need.
+"""
+
+UNITS = {'': 1, 'K': 1024, 'M': 1024 * 1024, 'G': 1024 * 1024 * 1024}
+
+
+def parse_size(text):
+    """'16', '4K', '16M', '1.5G' -> bytes; ValueError for anything else."""
+    cleaned = text.strip().upper().rstrip('B')
+    unit = cleaned[-1:] if cleaned[-1:] in UNITS else ''
+    try:
+        number = float(cleaned[:len(cleaned) - len(unit)])
+    except ValueError:
+        number = -1.0
+    if not 0 <= number < float('inf'):
+        raise ValueError(f'invalid size {text!r}: expected a number of bytes such as 512, 4K, 16M or 1.5G')
+    return int(number * UNITS[unit])
+
+
+def format_size(size):
+    for unit in ('M', 'K'):
+        if size >= UNITS[unit] and size % UNITS[unit] == 0:
+            return f'{size // UNITS[unit]}{unit}'
+    return str(size)
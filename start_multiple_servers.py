@@ -4,23 +4,44 @@ This script allows running multiple backend instances simultaneously
 on ports 5000-5005 for load balancing and high availability.
 """
 
+import argparse
 import subprocess
 import sys
 import os
+import time
 from pathlib import Path
 
-def start_server(script_name, port, host='127.0.0.1'):
-    """Start a Flask server instance on the specified port."""
+# Define which scripts to run on which ports
+# balancer.py reads this table to find the backends of each variant
+SERVERS = [
+    ('app.py', 5000),
+    ('vuln_unauth.py', 5001),
+    ('vuln_dir_traversal.py', 5002),
+    ('vuln_ecb_mode.py', 5003),
+    ('app.py', 5004),
+    ('vuln_sql_injection.py', 5005)
+]
+
+def start_server(script_name, port, host='127.0.0.1', workers=None):
+    """Start a Flask server instance on the specified port.
+
+    With ``workers`` set, the module is launched through serve.py (pre-fork
+    production mode) instead of its own debug ``app.run``.
+    """
     try:
         # Use environment variables to pass host and port information
-        # This works because Flask automatically reads these environment variables
-        process = subprocess.Popen([
-            sys.executable, script_name
-        ], env={
+        # Every module's __main__ block and serve.py read these variables
+        env = {
             **os.environ,
             'FLASK_RUN_PORT': str(port),
             'FLASK_RUN_HOST': host
-        })
+        }
+        if workers:
+            env['PORTAL_WORKERS'] = str(workers)
+            command = [sys.executable, 'serve.py', Path(script_name).stem]
+        else:
+            command = [sys.executable, script_name]
+        process = subprocess.Popen(command, env=env)
         return process
     except Exception as e:
         print(f"Failed to start server on port {port}: {e}")
@@ -28,23 +49,18 @@ def start_server(script_name, port, host='127.0.0.1'):
 
 def main():
     """Main function to start multiple server instances."""
-    # Define which scripts to run on which ports
-    servers = [
-        ('app.py', 5000),
-        ('vuln_unauth.py', 5001),
-        ('vuln_dir_traversal.py', 5002),
-        ('vuln_ecb_mode.py', 5003),
-        ('app.py', 5004),
-        ('vuln_sql_injection.py', 5005)
-    ]
-    
+    parser = argparse.ArgumentParser(description='Start all portal instances')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='Run every instance through serve.py with this many pre-forked workers')
+    args = parser.parse_args()
+
     processes = []
     
     print("Starting multiple Flask instances...")
     
-    for script_name, port in servers:
+    for script_name, port in SERVERS:
         print(f"Starting {script_name} on port {port}...")
-        process = start_server(script_name, port)
+        process = start_server(script_name, port, workers=args.workers)
         if process:
             processes.append((port, process))
     
@@ -52,9 +68,9 @@ def main():
     print("Press Ctrl+C to stop all servers")
     
     try:
-        # Keep the script running
+        # Keep the script running without spinning a CPU core
         while True:
-            pass
+            time.sleep(1)
     except KeyboardInterrupt:
         print("\nShutting down all servers...")
         for port, process in processes:
@@ -0,0 +1,86 @@
+"""
+Startup step timing and lazy initialization for the portal modules.
+
+Every portal module does its setup at import time: it reads or creates key
+files, hashes the demo users' passwords and initializes its database. Each
+of those steps goes through ``deferred()``:
+
+- normally the step runs right away and its duration is recorded in
+  ``steps``, which startup_profile.py reports;
+- with ``PORTAL_LAZY_INIT=1`` the step is postponed until the app's first
+  request. A WSGI middleware runs it before Flask opens the request context,
+  so by the time any view, session or login code runs, the setup is done.
+
+serve.py calls ``initialize_all()`` before forking, so pre-forked workers
+still share one initialization even in lazy mode.
+"""
+
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+LAZY_INIT = os.environ.get('PORTAL_LAZY_INIT', '').lower() in ('1', 'true', 'yes', 'on')
+
+# (module, step, seconds) for every step that has run in this process
+steps = []
+
+# One _LazyInit per app that has deferred steps
+_lazy_inits = []
+
+
+@contextmanager
+def step(module, name):
+    """Time a named initialization step of ``module``."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        steps.append((module, name, time.perf_counter() - started))
+
+
+class _LazyInit:
+    """WSGI middleware running an app's deferred steps once, on first use."""
+
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+        self.pending = []  # (module, name, func)
+        self.lock = threading.Lock()
+        self.done = False
+
+    def run_pending(self):
+        if self.done:
+            return
+        with self.lock:
+            if self.done:
+                return
+            for module, name, func in self.pending:
+                with step(module, name + ' (deferred)'):
+                    func()
+            self.pending.clear()
+            self.done = True
+
+    def __call__(self, environ, start_response):
+        self.run_pending()
+        return self.wsgi_app(environ, start_response)
+
+
+def deferred(app, module, name, func):
+    """Run an initialization step now, or on the app's first request in lazy mode."""
+    if not LAZY_INIT:
+        with step(module, name):
+            func()
+        return
+    lazy = app.extensions.get('lazy_init')
+    if lazy is None:
+        lazy = _LazyInit(app.wsgi_app)
+        app.wsgi_app = lazy
+        app.extensions['lazy_init'] = lazy
+        _lazy_inits.append(lazy)
+    lazy.pending.append((module, name, func))
+
+
+def initialize_all():
+    """Run every step that is still deferred, in every app of this process."""
+    for lazy in _lazy_inits:
+        lazy.run_pending()
@@ -0,0 +1,171 @@
+"""
+Cold-start profiler for the portal modules.
+
+Each module is imported in a fresh interpreter started with ``-X importtime``,
+so nothing is cached from a previous import. The report breaks the import
+down into:
+
+- third-party and stdlib imports made by the module (cumulative time per
+  top-level package, from the importtime log),
+- the initialization steps recorded by startup.py (key loading, password
+  hashing, database setup),
+- everything else the module body does.
+
+With ``--lazy`` the modules are imported with PORTAL_LAZY_INIT=1 and the
+report also shows what the deferred steps cost on the first request.
+
+``--budget`` turns the profiler into a startup-time check: it exits with
+status 1 if any module takes longer than the budget to import.
+
+Usage:
+    python startup_profile.py
+    python startup_profile.py app --lazy --budget 0.5
+    python startup_profile.py --json
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+DEFAULT_MODULES = ['app', 'secure_app', 'vuln_unauth', 'vuln_dir_traversal',
+                   'vuln_ecb_mode', 'vuln_sql_injection']
+
+
+def _child(module_name):
+    """Runs inside the profiled interpreter; prints one JSON line."""
+    started = time.perf_counter()
+    # __import__ goes through the C import path that -X importtime instruments;
+    # importlib.import_module does not
+    __import__(module_name)
+    module = sys.modules[module_name]
+    import_seconds = time.perf_counter() - started
+
+    import startup
+    import_steps = list(startup.steps)
+
+    first_request = None
+    if startup.LAZY_INIT:
+        client = module.app.test_client()
+        started = time.perf_counter()
+        client.get('/')
+        first_request = time.perf_counter() - started
+
+    print(json.dumps({
+        'module': module_name,
+        'lazy': startup.LAZY_INIT,
+        'import_seconds': import_seconds,
+        'steps': import_steps,
+        'deferred_steps': startup.steps[len(import_steps):],
+        'first_request_seconds': first_request,
+    }))
+
+
+def parse_importtime(stderr, module_name):
+    """Cumulative seconds of each package imported directly by ``module_name``.
+
+    ``-X importtime`` lists children before their parent, indented two
+    spaces deeper, so the module's direct imports are the level-1 entries
+    immediately above its own level-0 line.
+    """
+    entries = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        # One space follows the bar, then two more per nesting level
+        depth = (len(name) - len(name.lstrip(' ')) - 1) // 2
+        entries.append((depth, name.strip(), int(cumulative_us) / 1e6))
+
+    for index in range(len(entries) - 1, -1, -1):
+        depth, name, _ = entries[index]
+        if depth == 0 and name == module_name:
+            break
+    else:
+        return {}
+
+    imports = {}
+    for depth, name, seconds in reversed(entries[:index]):
+        if depth == 0:
+            break
+        if depth == 1:
+            imports[name] = seconds
+    return dict(reversed(list(imports.items())))
+
+
+def profile(module_name, lazy=False):
+    env = dict(os.environ)
+    env['PORTAL_LAZY_INIT'] = '1' if lazy else '0'
+    proc = subprocess.run(
+        [sys.executable, '-X', 'importtime', os.path.abspath(__file__), '--child', module_name],
+        env=env, capture_output=True, text=True)
+    result_line = next((line for line in reversed(proc.stdout.splitlines()) if line.startswith('{')), None)
+    if proc.returncode != 0 or result_line is None:
+        raise RuntimeError(f'profiling {module_name} failed:\n{proc.stderr[-2000:]}')
+    result = json.loads(result_line)
+    result['imports'] = parse_importtime(proc.stderr, module_name)
+    accounted = sum(result['imports'].values()) + sum(seconds for _, _, seconds in result['steps'])
+    result['other_seconds'] = max(0.0, result['import_seconds'] - accounted)
+    return result
+
+
+def print_report(result, top=8):
+    def ms(seconds):
+        return f'{seconds * 1000:9.1f} ms'
+
+    mode = 'lazy' if result['lazy'] else 'eager'
+    print(f"{result['module']} ({mode}): import {ms(result['import_seconds'])}")
+    print('  imports')
+    ranked = sorted(result['imports'].items(), key=lambda item: item[1], reverse=True)
+    for name, seconds in ranked[:top]:
+        print(f'    {name:<34}{ms(seconds)}')
+    if len(ranked) > top:
+        print(f"    {'(' + str(len(ranked) - top) + ' more)':<34}{ms(sum(s for _, s in ranked[top:]))}")
+    print('  init steps')
+    if not result['steps']:
+        print('    (none at import time)')
+    for _, name, seconds in result['steps']:
+        print(f'    {name:<34}{ms(seconds)}')
+    print(f"  {'other module code':<36}{ms(result['other_seconds'])}")
+    if result['first_request_seconds'] is not None:
+        print(f"  {'first request':<36}{ms(result['first_request_seconds'])}")
+        for _, name, seconds in result['deferred_steps']:
+            print(f'    {name:<34}{ms(seconds)}')
+    print()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Profile cold start of the portal modules')
+    parser.add_argument('modules', nargs='*', default=None, help='Modules to profile (default: all)')
+    parser.add_argument('--lazy', action='store_true', help='Profile with PORTAL_LAZY_INIT=1')
+    parser.add_argument('--budget', type=float, default=None,
+                        help='Fail (exit 1) if any module takes longer than this many seconds to import')
+    parser.add_argument('--json', action='store_true', help='Print machine-readable results')
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.child:
+        _child(args.child)
+        return 0
+
+    results = [profile(name, args.lazy) for name in (args.modules or DEFAULT_MODULES)]
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        for result in results:
+            print_report(result)
+
+    if args.budget is not None:
+        over = [r for r in results if r['import_seconds'] > args.budget]
+        for r in over:
+            print(f"FAIL {r['module']}: import took {r['import_seconds']:.3f}s, budget {args.budget:.3f}s")
+        if over:
+            return 1
+        print(f'OK: every module imported within {args.budget:.3f}s')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
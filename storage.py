@@ -0,0 +1,268 @@
+"""
+Atomic, lock-safe writes into the shared encrypted file store.
+
+All portal instances share one UPLOAD_FOLDER. Writing ``<name>.enc`` in place
+lets two concurrent uploads of the same name interleave their bytes, and lets
+a download read a half-written file. ``atomic_write`` avoids both:
+
+1. the data goes to a temporary file in the same directory,
+2. the temporary file is flushed and fsynced,
+3. it is renamed over the final name while holding a per-name advisory lock,
+4. the directory is fsynced so the rename itself survives a crash.
+
+Readers never take the lock: a rename is atomic, so they see either the old
+complete file or the new complete file. Concurrent writers of the same name
+are serialized by the lock and the last one to rename wins.
+
+Run ``python storage.py --stress`` to hammer one filename from many processes
+and check that every read decrypts cleanly.
+"""
+
+import contextlib
+import os
+import tempfile
+import time
+from pathlib import Path
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+# Temporary files start with this prefix so they never match '*.enc'
+TEMP_PREFIX = '.tmp-'
+LOCK_SUFFIX = '.lock'
+
+
+def lock_path_for(path):
+    """Lock file guarding ``path``: a hidden sibling, e.g. ``.report.pdf.enc.lock``."""
+    path = Path(path)
+    return path.with_name('.' + path.name + LOCK_SUFFIX)
+
+
+@contextlib.contextmanager
+def file_lock(path):
+    """Hold the exclusive advisory lock for ``path`` for the duration of the block."""
+    lock_file = lock_path_for(path)
+    fd = os.open(lock_file, os.O_RDWR | os.O_CREAT, 0o600)
+    try:
+        if fcntl is not None:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+        else:
+            # msvcrt.locking only retries for ~10 seconds, keep trying
+            while True:
+                try:
+                    msvcrt.locking(fd, msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    continue
+        yield
+    finally:
+        if fcntl is not None:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+        else:
+            os.lseek(fd, 0, os.SEEK_SET)
+            msvcrt.locking(fd, msvcrt.LK_UNLCK, 1)
+        os.close(fd)
+
+
+def fsync_directory(directory):
+    """Persist a rename in ``directory``. A no-op where directories can't be opened."""
+    if not hasattr(os, 'O_DIRECTORY'):
+        return
+    fd = os.open(directory, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _replace(src, dst):
+    # On Windows the rename fails while a reader has dst open; retry briefly
+    for attempt in range(50):
+        try:
+            os.replace(src, dst)
+            return
+        except PermissionError:
+            if os.name != 'nt' or attempt == 49:
+                raise
+            time.sleep(0.01)
+
+
+def publish(src, path):
+    """Rename the complete, fsynced file ``src`` to ``path`` (steps 3 and 4 above).
+
+    ``src`` must be on the same filesystem as ``path``. Returns the final path.
+    """
+    path = Path(path)
+    with file_lock(path):
+        _replace(src, path)
+    fsync_directory(path.parent)
+    return path
+
+
+def atomic_write(path, data):
+    """Write ``data`` to ``path`` so readers only ever see a complete file.
+
+    Returns the final path.
+    """
+    path = Path(path)
+    directory = path.parent
+    fd, tmp_name = tempfile.mkstemp(prefix=TEMP_PREFIX, dir=directory)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        publish(tmp_name, path)
+    except BaseException:
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(tmp_name)
+        raise
+    return path
+
+
+def atomic_write_many(items):
+    """``atomic_write`` for many ``(path, data)`` pairs with grouped syncs.
+
+    Same guarantees per file, but the steps run as batches: every temporary
+    file is written first, then all are fsynced (the first fsync usually
+    commits the others' journal entries too, so the rest are cheap), then
+    each is renamed under its lock, and every directory involved is fsynced
+    once at the end instead of once per file.
+
+    Returns one entry per item, in order: the final path, or the exception
+    that item failed with. Other items are not affected by a failure.
+    """
+    results = [None] * len(items)
+    pending = []  # (index, tmp_name, path)
+    try:
+        for index, (path, data) in enumerate(items):
+            path = Path(path)
+            try:
+                fd, tmp_name = tempfile.mkstemp(prefix=TEMP_PREFIX, dir=path.parent)
+                pending.append((index, tmp_name, path))
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(data)
+            except OSError as e:
+                results[index] = e
+
+        synced = []
+        for index, tmp_name, path in pending:
+            if results[index] is not None:
+                continue
+            try:
+                fd = os.open(tmp_name, os.O_RDONLY)
+                try:
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
+                synced.append((index, tmp_name, path))
+            except OSError as e:
+                results[index] = e
+
+        directories = set()
+        for index, tmp_name, path in synced:
+            try:
+                with file_lock(path):
+                    _replace(tmp_name, path)
+                results[index] = path
+                directories.add(path.parent)
+            except OSError as e:
+                results[index] = e
+        for directory in directories:
+            fsync_directory(directory)
+    finally:
+        for index, tmp_name, path in pending:
+            if not isinstance(results[index], Path):
+                with contextlib.suppress(FileNotFoundError):
+                    os.unlink(tmp_name)
+    return results
+
+
+# ---------------------------------------------------------------------------
+# Stress test
+# ---------------------------------------------------------------------------
+
+def _stress_writer(directory, name, key, iterations, seed):
+    import hashlib
+    import random
+    from Crypto.Cipher import AES
+    from Crypto.Util.Padding import pad
+
+    rng = random.Random(seed)
+    for _ in range(iterations):
+        payload = rng.randbytes(rng.randint(1, 256 * 1024))
+        # Plaintext carries its own digest so readers can verify it
+        plaintext = hashlib.sha256(payload).digest() + payload
+        cipher = AES.new(key, AES.MODE_CBC)
+        atomic_write(Path(directory) / name, cipher.iv + cipher.encrypt(pad(plaintext, AES.block_size)))
+
+
+def _stress_reader(directory, name, key, stop_file):
+    import hashlib
+    from Crypto.Cipher import AES
+    from Crypto.Util.Padding import unpad
+
+    reads = 0
+    failures = 0
+    path = Path(directory) / name
+    while not os.path.exists(stop_file):
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            continue
+        reads += 1
+        try:
+            cipher = AES.new(key, AES.MODE_CBC, iv=data[:16])
+            plaintext = unpad(cipher.decrypt(data[16:]), AES.block_size)
+            if hashlib.sha256(plaintext[32:]).digest() != plaintext[:32]:
+                failures += 1
+        except ValueError:
+            failures += 1
+    return reads, failures
+
+
+def stress(writers=8, readers=4, iterations=100):
+    """Hammer one filename from many processes.
+
+    Returns ``(reads, failures, leftover_temp_files)``.
+    """
+    from concurrent.futures import ProcessPoolExecutor
+    from Crypto.Random import get_random_bytes
+
+    key = get_random_bytes(32)
+    name = 'stress.bin.enc'
+    with tempfile.TemporaryDirectory() as tmp:
+        stop_file = os.path.join(tmp, 'stop')
+        with ProcessPoolExecutor(max_workers=writers + readers) as pool:
+            read_jobs = [pool.submit(_stress_reader, tmp, name, key, stop_file) for _ in range(readers)]
+            write_jobs = [pool.submit(_stress_writer, tmp, name, key, iterations, seed)
+                          for seed in range(writers)]
+            for job in write_jobs:
+                job.result()
+            Path(stop_file).touch()
+            results = [job.result() for job in read_jobs]
+        leftovers = [p.name for p in Path(tmp).iterdir() if p.name.startswith(TEMP_PREFIX)]
+    reads = sum(r for r, _ in results)
+    failures = sum(f for _, f in results)
+    return reads, failures, leftovers
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Stress-test atomic writes to one filename')
+    parser.add_argument('--stress', action='store_true', help='Run the multi-process stress test')
+    parser.add_argument('--writers', type=int, default=8)
+    parser.add_argument('--readers', type=int, default=4)
+    parser.add_argument('--iterations', type=int, default=100, help='Writes per writer process')
+    args = parser.parse_args()
+    if not args.stress:
+        parser.print_help()
+    else:
+        reads, failures, leftovers = stress(args.writers, args.readers, args.iterations)
+        print(f"{args.writers} writers x {args.iterations} writes, {args.readers} readers: "
+              f"{reads} reads, {failures} failed to decrypt, {len(leftovers)} temp files left")
+        raise SystemExit(1 if failures or leftovers else 0)
@@ -0,0 +1,124 @@
+"""
+Per-request phase timers reported in the ``Server-Timing`` response header.
+
+The views mark their phases with ``timing.phase()`` (or ``timing.timed()``
+on a function). Every request then answers with a header such as::
+
+    Server-Timing: auth;dur=0.21, lookup;dur=0.05, io_read;dur=0.31,
+                   decrypt;dur=1.92, serialize;dur=0.12, total;dur=2.83
+
+Durations are in milliseconds, the unit browsers' devtools expect. A phase
+entered more than once in a request is summed. ``total`` is measured from
+before_request to after_request, so ``total`` minus the phases is the time
+spent in Flask itself and in code that is not instrumented.
+
+Phase names used by the portal modules:
+
+    auth       jwt.decode in token_required
+    lookup     filename checks, path validation, existence checks, listing
+    io_read    reading the stored file
+    decrypt    decrypt_file
+    encrypt    encrypt_file, or the read-hash-encrypt pass of a streamed upload
+    io_write   fsync and rename of the encrypted upload, index update
+    verify     SHA-256 of the decrypted plaintext on download
+    serialize  jsonify / send_file
+    compress   gzip/br of a response body (compression.py)
+
+Requests slower than ``PORTAL_SLOW_REQUEST_MS`` milliseconds (off when
+unset or 0) are logged with their breakdown on the ``portal.timing`` logger.
+Outside a request, or for an app without ``init_app``, a phase is a
+context variable lookup and nothing else. When tracing.py is recording the
+request, every phase is also written as a span of the request's trace.
+"""
+
+import contextvars
+import logging
+import os
+import time
+from functools import wraps
+
+from flask import g, request
+
+import tracing
+
+logger = logging.getLogger('portal.timing')
+
+SLOW_REQUEST_MS = float(os.environ.get('PORTAL_SLOW_REQUEST_MS') or 0)
+
+
+# Phase durations of the request being handled by this thread, or None.
+# A ContextVar rather than flask.g: the lookup stays cheap inside phases.
+_timings = contextvars.ContextVar('portal_timings', default=None)
+
+
+class phase:
+    """Time the enclosed block as phase ``name`` of the current request."""
+
+    __slots__ = ('name', 'timings', 'started', 'span')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.timings = _timings.get()
+        if self.timings is not None:
+            self.started = time.perf_counter()
+        self.span = tracing.child_span(self.name)
+        return self
+
+    def __exit__(self, *exc):
+        timings = self.timings
+        if timings is not None:
+            timings[self.name] = timings.get(self.name, 0.0) + time.perf_counter() - self.started
+        if self.span is not None:
+            self.span.__exit__(*exc)
+        return False
+
+
+def timed(name):
+    """Decorator form of ``phase``."""
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with phase(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def format_header(timings, total):
+    parts = [f'{name};dur={seconds * 1000:.2f}' for name, seconds in timings.items()]
+    parts.append(f'total;dur={total * 1000:.2f}')
+    return ', '.join(parts)
+
+
+def init_app(app, name=None, slow_request_ms=None):
+    """Add the Server-Timing header (and slow request logging) to ``app``."""
+    name = name or app.import_name
+    slow_ms = SLOW_REQUEST_MS if slow_request_ms is None else slow_request_ms
+
+    @app.before_request
+    def _timing_start():
+        _timings.set({})
+        g._timing_started = time.perf_counter()
+
+    @app.after_request
+    def _timing_header(response):
+        timings = _timings.get()
+        started = g.pop('_timing_started', None)
+        if timings is None or started is None:
+            return response
+        _timings.set(None)
+        total = time.perf_counter() - started
+        response.headers['Server-Timing'] = format_header(timings, total)
+        if slow_ms and total * 1000 >= slow_ms:
+            logger.warning('slow request app=%s %s %s status=%s total=%.1fms %s',
+                           name, request.method, request.path, response.status_code, total * 1000,
+                           ' '.join(f'{k}={v * 1000:.1f}ms' for k, v in timings.items()))
+        return response
+
+    @app.teardown_request
+    def _timing_finish(exc):
+        _timings.set(None)
+
+    return app
@@ -0,0 +1,464 @@
+"""
+Request tracing: one trace per request, one span per layer, written as NDJSON.
+
+Tracing is off unless ``PORTAL_TRACE_DIR`` is set. When it is on, every
+request handled by a portal module gets a trace ID and a root span named
+after its route; each ``timing.phase()`` inside the request (auth, lookup,
+io_read, decrypt, encrypt, io_write, serialize) becomes a child span. The
+ID travels between processes in two headers::
+
+    X-Trace-Id:        4bf92f3577b34da6a3ce929d0e0e4736
+    X-Parent-Span-Id:  00f067aa0ba902b7
+
+balancer.py starts the trace (or continues the client's) with a ``proxy``
+span and sends both headers with each upstream attempt, so its ``upstream``
+span becomes the parent of the app's request span. Responses carry
+``X-Trace-Id`` back to the client.
+
+Every process appends finished spans to its own ``trace-<pid>.ndjson`` in
+the trace directory, one JSON object per line, through a background writer
+thread (when it falls behind, spans are dropped instead of blocking the
+request)::
+
+    {"trace": "4bf9...", "span": "00f0...", "parent": null, "name": "proxy",
+     "service": "balancer", "pid": 4242, "start": 1760891234.123456,
+     "dur_ms": 12.345, "attrs": {"backend": "127.0.0.1:5000", "status": 200}}
+
+Files rotate at ``PORTAL_TRACE_MAX_BYTES`` (10 MB) keeping
+``PORTAL_TRACE_BACKUPS`` (3) old files. ``PORTAL_TRACE_SAMPLE`` (1.0) traces
+only a fraction of new requests; requests that arrive with an
+``X-Trace-Id`` are always traced.
+
+Summarize a trace directory: the slowest traces, their span trees with the
+critical path marked, and which spans the critical paths spend time in::
+
+    python tracing.py traces/ --top 10 --tree 3
+    python tracing.py traces/ --name /api/download --min-ms 50
+"""
+
+import argparse
+import atexit
+import contextvars
+import json
+import os
+import random
+import re
+import sys
+import threading
+import time
+from collections import defaultdict, deque
+from pathlib import Path
+
+TRACE_HEADER = 'X-Trace-Id'
+PARENT_HEADER = 'X-Parent-Span-Id'
+
+TRACE_DIR = os.environ.get('PORTAL_TRACE_DIR')
+SAMPLE_RATE = float(os.environ.get('PORTAL_TRACE_SAMPLE') or 1.0)
+MAX_BYTES = int(os.environ.get('PORTAL_TRACE_MAX_BYTES') or 10 * 1024 * 1024)
+BACKUPS = int(os.environ.get('PORTAL_TRACE_BACKUPS') or 3)
+QUEUE_SIZE = 10000
+FLUSH_INTERVAL = 0.1
+
+_ID = re.compile(r'^[0-9a-f]{8,64}$')
+
+# The span that new spans in this thread/task become children of
+_current = contextvars.ContextVar('portal_span', default=None)
+
+
+class Span:
+    """One timed operation of a trace; a context manager that becomes current."""
+
+    __slots__ = ('trace_id', 'span_id', 'parent_id', 'name', 'attrs', 'start', '_started', '_token')
+
+    def __init__(self, name, trace_id, parent_id=None, attrs=None):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.attrs = attrs or {}
+        self.start = time.time()
+        self._started = time.perf_counter()
+        self._token = None
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def headers(self):
+        """Headers that make a request sent now a child of this span."""
+        return [(TRACE_HEADER, self.trace_id), (PARENT_HEADER, self.span_id)]
+
+    def __enter__(self):
+        self._token = _current.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            self.attrs.setdefault('error', exc_type.__name__)
+        self.finish()
+        return False
+
+    def finish(self):
+        duration = time.perf_counter() - self._started
+        if self._token is not None:
+            try:
+                _current.reset(self._token)
+            except ValueError:
+                # Finished from another context (e.g. a teardown hook)
+                _current.set(None)
+            self._token = None
+        _writer.write({
+            'trace': self.trace_id,
+            'span': self.span_id,
+            'parent': self.parent_id,
+            'name': self.name,
+            'service': _service,
+            'pid': os.getpid(),
+            'start': round(self.start, 6),
+            'dur_ms': round(duration * 1000, 3),
+            'attrs': self.attrs,
+        })
+
+
+class _NullSpan:
+    """Stand-in when nothing is traced, so call sites need no checks."""
+
+    trace_id = None
+
+    def set(self, **attrs):
+        pass
+
+    def headers(self):
+        return []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+NULL_SPAN = _NullSpan()
+
+
+class _TraceFile:
+    """Append-only NDJSON file rotated by size (trace.ndjson -> .1 -> .2 ...)."""
+
+    def __init__(self, path, max_bytes, backups):
+        self.path = Path(path)
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.file = open(self.path, 'a', encoding='utf-8')
+        self.size = self.file.tell()
+
+    def write(self, line):
+        if self.size and self.size + len(line) > self.max_bytes:
+            self.rotate()
+        self.file.write(line)
+        self.size += len(line)
+
+    def rotate(self):
+        self.file.close()
+        for index in range(self.backups - 1, 0, -1):
+            older = self.path.with_name(f'{self.path.name}.{index}')
+            if older.exists():
+                older.replace(self.path.with_name(f'{self.path.name}.{index + 1}'))
+        if self.backups:
+            self.path.replace(self.path.with_name(f'{self.path.name}.1'))
+        else:
+            self.path.unlink()
+        self.file = open(self.path, 'a', encoding='utf-8')
+        self.size = 0
+
+    def close(self):
+        self.file.close()
+
+
+class _Writer:
+    """Background thread writing finished spans of this process to its own file.
+
+    Request threads only append to a deque (no lock, no wakeup); the thread
+    drains it every FLUSH_INTERVAL seconds. The thread and file are created
+    on first use in each process, so a pre-forked worker never shares the
+    master's (or a sibling's) file.
+    """
+
+    def __init__(self):
+        self.pid = None
+        self.pending = None
+        self.stop = None
+        self.thread = None
+        self.dropped = 0
+        self.lock = threading.Lock()
+
+    def _start(self):
+        Path(TRACE_DIR).mkdir(parents=True, exist_ok=True)
+        trace_file = _TraceFile(Path(TRACE_DIR) / f'trace-{os.getpid()}.ndjson', MAX_BYTES, BACKUPS)
+        self.pending = deque()
+        self.stop = threading.Event()
+        self.thread = threading.Thread(target=self._run, args=(self.pending, self.stop, trace_file),
+                                       name='trace-writer', daemon=True)
+        self.thread.start()
+        self.pid = os.getpid()
+
+    @staticmethod
+    def _run(pending, stop, trace_file):
+        while True:
+            stopping = stop.wait(FLUSH_INTERVAL)
+            while pending:
+                trace_file.write(json.dumps(pending.popleft(), separators=(',', ':'), default=str) + '\n')
+            trace_file.file.flush()
+            if stopping:
+                break
+        trace_file.close()
+
+    def write(self, span):
+        if self.pid != os.getpid():
+            with self.lock:
+                if self.pid != os.getpid():
+                    self._start()
+        if len(self.pending) >= QUEUE_SIZE:
+            self.dropped += 1
+            return
+        self.pending.append(span)
+
+    def close(self):
+        """Write out everything pending and stop the thread (this process only)."""
+        if self.pid != os.getpid() or self.thread is None:
+            return
+        self.stop.set()
+        self.thread.join(timeout=5)
+        self.pid = self.thread = None
+        if self.dropped:
+            sys.stderr.write(f'tracing: dropped {self.dropped} spans (writer fell behind)\n')
+
+
+_writer = _Writer()
+_service = 'portal'
+atexit.register(_writer.close)
+
+
+def enabled():
+    return TRACE_DIR is not None
+
+
+def configure(directory, service=None):
+    """Turn tracing on for this process (an alternative to PORTAL_TRACE_DIR)."""
+    global TRACE_DIR, _service
+    _writer.close()
+    TRACE_DIR = str(directory) if directory else None
+    if service:
+        _service = service
+
+
+def shutdown():
+    _writer.close()
+
+
+def current():
+    """The active span, or NULL_SPAN."""
+    return _current.get() or NULL_SPAN
+
+
+def start_trace(name, trace_id=None, parent_id=None, **attrs):
+    """Root span of a request, continuing ``trace_id`` when one came in.
+
+    Returns NULL_SPAN when tracing is off or the request is sampled out.
+    """
+    if TRACE_DIR is None:
+        return NULL_SPAN
+    if trace_id and _ID.match(trace_id):
+        if parent_id and not _ID.match(parent_id):
+            parent_id = None
+    else:
+        if SAMPLE_RATE < 1.0 and random.random() >= SAMPLE_RATE:
+            return NULL_SPAN
+        trace_id, parent_id = os.urandom(16).hex(), None
+    return Span(name, trace_id, parent_id, attrs)
+
+
+def span(name, **attrs):
+    """Child span of the active span; NULL_SPAN outside a trace."""
+    parent = _current.get()
+    if parent is None:
+        return NULL_SPAN
+    return Span(name, parent.trace_id, parent.span_id, attrs)
+
+
+def child_span(name):
+    """Started child span of the active span, or None; used by timing.phase."""
+    parent = _current.get()
+    if parent is None:
+        return None
+    return Span(name, parent.trace_id, parent.span_id).__enter__()
+
+
+def init_app(app, name=None):
+    """Trace every request of ``app`` (when tracing is enabled)."""
+    global _service
+    from flask import g, request
+
+    _service = name or app.import_name
+    if TRACE_DIR is None:
+        return app
+
+    @app.before_request
+    def _trace_start():
+        rule = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        root = start_trace(f'{request.method} {rule}',
+                           request.headers.get(TRACE_HEADER), request.headers.get(PARENT_HEADER),
+                           path=request.path)
+        if root is not NULL_SPAN:
+            g._trace_span = root.__enter__()
+
+    @app.after_request
+    def _trace_header(response):
+        root = g.get('_trace_span')
+        if root is not None:
+            root.set(status=response.status_code)
+            response.headers[TRACE_HEADER] = root.trace_id
+        return response
+
+    @app.teardown_request
+    def _trace_finish(exc):
+        root = g.pop('_trace_span', None)
+        if root is not None:
+            if exc is not None:
+                root.set(error=type(exc).__name__)
+            root.finish()
+
+    return app
+
+
+# ---------------------------------------------------------------------------
+# Summary CLI
+# ---------------------------------------------------------------------------
+
+def load_spans(directory):
+    """All spans in ``directory`` (current and rotated files), grouped by trace."""
+    traces = defaultdict(list)
+    for path in sorted(Path(directory).glob('trace-*.ndjson*')):
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue  # a line cut short by a crash
+                record['end'] = record['start'] + record['dur_ms'] / 1000
+                traces[record['trace']].append(record)
+    return traces
+
+
+def trace_info(spans):
+    ids = {s['span'] for s in spans}
+    roots = sorted((s for s in spans if s['parent'] not in ids), key=lambda s: s['start'])
+    start = min(s['start'] for s in spans)
+    end = max(s['end'] for s in spans)
+    main = max(roots, key=lambda s: s['dur_ms'])
+    children = defaultdict(list)
+    for s in spans:
+        children[s['parent']].append(s)
+    status = next((s['attrs'].get('status') for s in spans if 'status' in s.get('attrs', {})), None)
+    return {
+        'spans': spans,
+        'roots': roots,
+        'root': main,
+        'children': children,
+        'start': start,
+        'dur_ms': (end - start) * 1000,
+        'status': status,
+        'services': sorted({s['service'] for s in spans}),
+    }
+
+
+def critical_path(span, children):
+    """Spans whose time the end of ``span`` waited on, as (span, self_ms) pairs.
+
+    Walks back from the end of the span: the child that finished last before
+    the cursor is on the path, the cursor moves to that child's start, and
+    so on. Time not covered by a chosen child is the span's own time.
+    """
+    cursor = span['end']
+    covered = 0.0
+    chosen = []
+    for child in sorted(children.get(span['span'], ()), key=lambda s: s['end'], reverse=True):
+        if child['start'] >= cursor:
+            continue
+        covered += min(child['end'], cursor) - max(child['start'], span['start'])
+        chosen.append(child)
+        cursor = child['start']
+    path = [(span, max(0.0, span['dur_ms'] - covered * 1000))]
+    for child in reversed(chosen):
+        path.extend(critical_path(child, children))
+    return path
+
+
+def print_tree(info, out):
+    on_path = {s['span'] for s, _ in critical_path(info['root'], info['children'])}
+
+    def walk(span, depth):
+        offset = (span['start'] - info['start']) * 1000
+        attrs = ' '.join(f'{k}={v}' for k, v in span.get('attrs', {}).items())
+        mark = '*' if span['span'] in on_path else ' '
+        out.write(f"  {mark} +{offset:8.2f}ms {span['dur_ms']:9.2f}ms  {'  ' * depth}{span['name']}"
+                  f"  [{span['service']}]{'  ' + attrs if attrs else ''}\n")
+        for child in sorted(info['children'].get(span['span'], ()), key=lambda s: s['start']):
+            walk(child, depth + 1)
+
+    for root in info['roots']:
+        walk(root, 0)
+
+
+def summarize(directory, top=10, tree=3, name=None, min_ms=0.0, out=sys.stdout):
+    traces = [trace_info(spans) for spans in load_spans(directory).values()]
+    if name:
+        traces = [t for t in traces if any(name in s['name'] or name in str(s['attrs'].get('path', ''))
+                                           or name in str(s['attrs'].get('target', ''))
+                                           for s in t['spans'])]
+    traces = [t for t in traces if t['dur_ms'] >= min_ms]
+    if not traces:
+        out.write(f'No traces in {directory}\n')
+        return 1
+    traces.sort(key=lambda t: t['dur_ms'], reverse=True)
+    slowest = traces[:top]
+
+    durations = sorted(t['dur_ms'] for t in traces)
+    pick = lambda q: durations[min(len(durations) - 1, int(q * len(durations)))]
+    out.write(f'{len(traces)} traces  p50 {pick(0.5):.2f}ms  p95 {pick(0.95):.2f}ms  '
+              f'p99 {pick(0.99):.2f}ms  max {durations[-1]:.2f}ms\n\n')
+
+    out.write(f'Slowest {len(slowest)} traces\n')
+    out.write(f"  {'duration':>11}  {'spans':>5}  {'status':>6}  {'trace':<32}  root\n")
+    for t in slowest:
+        out.write(f"  {t['dur_ms']:9.2f}ms  {len(t['spans']):5}  {str(t['status'] or '-'):>6}  "
+                  f"{t['root']['trace']:<32}  {t['roots'][0]['name']} [{', '.join(t['services'])}]\n")
+
+    for t in slowest[:tree]:
+        out.write(f"\nTrace {t['root']['trace']}  {t['dur_ms']:.2f}ms  (* = critical path)\n")
+        print_tree(t, out)
+
+    # Where the critical paths of the slowest traces spend their time
+    by_name = defaultdict(float)
+    for t in slowest:
+        for span, self_ms in critical_path(t['root'], t['children']):
+            by_name[span['name'] if span['parent'] else 'request (own time)'] += self_ms
+    total = sum(by_name.values()) or 1.0
+    out.write(f'\nCritical path time over the slowest {len(slowest)} traces\n')
+    for span_name, ms in sorted(by_name.items(), key=lambda item: item[1], reverse=True):
+        out.write(f'  {ms:10.2f}ms  {ms / total:6.1%}  {span_name}\n')
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Summarize request traces written by tracing.py')
+    parser.add_argument('directory', nargs='?', default=TRACE_DIR or 'traces',
+                        help='Trace directory (default: $PORTAL_TRACE_DIR or ./traces)')
+    parser.add_argument('--top', type=int, default=10, help='Number of slowest traces to list')
+    parser.add_argument('--tree', type=int, default=3, help='Print the span tree of this many of them')
+    parser.add_argument('--name', default=None, help='Only traces with a span whose name, path or target contains this')
+    parser.add_argument('--min-ms', type=float, default=0.0, help='Ignore traces faster than this')
+    args = parser.parse_args(argv)
+    return summarize(args.directory, args.top, args.tree, args.name, args.min_ms)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
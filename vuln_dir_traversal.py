@@ -17,6 +17,18 @@ from Crypto.Util.Padding import pad, unpad
 from Crypto.Random import get_random_bytes
 import jwt
 import datetime
+import logging
+import startup
+import metrics
+import compression
+import json_provider
+import timing
+import tracing
+import portal_logging
+
+# 结构化JSON日志，由后台线程写出，不在请求线程上做stdout I/O
+portal_logging.setup()
+logger = logging.getLogger(__name__)
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = secrets.token_hex(32)
@@ -24,34 +36,53 @@ app.config['UPLOAD_FOLDER'] = 'protected_files'
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024
 
 # 使用持久化的JWT密钥而不是每次都生成新的
-jwt_secret_file = Path('keys/jwt_secret_dir_traversal.key')
-if jwt_secret_file.exists():
-    with open(jwt_secret_file, 'r') as f:
-        app.config['JWT_SECRET_KEY'] = f.read()
-else:
-    jwt_secret = secrets.token_hex(32)
-    with open(jwt_secret_file, 'w') as f:
-        f.write(jwt_secret)
-    app.config['JWT_SECRET_KEY'] = jwt_secret
+def load_jwt_secret():
+    os.makedirs('keys', exist_ok=True)
+    jwt_secret_file = Path('keys/jwt_secret_dir_traversal.key')
+    if jwt_secret_file.exists():
+        with open(jwt_secret_file, 'r') as f:
+            app.config['JWT_SECRET_KEY'] = f.read()
+    else:
+        jwt_secret = secrets.token_hex(32)
+        with open(jwt_secret_file, 'w') as f:
+            f.write(jwt_secret)
+        app.config['JWT_SECRET_KEY'] = jwt_secret
 
 CORS(app, resources={r"/api/*": {"origins": "*"}})
 
+# 请求与加解密指标，通过 /metrics 暴露
+metrics.init_app(app, __name__)
+# 每个响应带Server-Timing头（各阶段耗时）
+timing.init_app(app, __name__)
+# 请求追踪：设置PORTAL_TRACE_DIR时，每个阶段记录为一个span
+tracing.init_app(app, __name__)
+# jsonify使用orjson编码；JSON响应按Accept-Encoding压缩（gzip/br）
+json_provider.init_app(app)
+compression.init_app(app, __name__)
+
 login_manager = LoginManager()
 login_manager.init_app(app)
 
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 os.makedirs('keys', exist_ok=True)
 
-users = {
-    'admin': {
-        'password': generate_password_hash('admin123'),
-        'id': 1
-    },
-    'user1': {
-        'password': generate_password_hash('password123'),
-        'id': 2
-    }
-}
+users = {}
+
+def init_users():
+    users.update({
+        'admin': {
+            'password': generate_password_hash('admin123'),
+            'id': 1
+        },
+        'user1': {
+            'password': generate_password_hash('password123'),
+            'id': 2
+        }
+    })
+
+# 启动初始化；PORTAL_LAZY_INIT=1 时推迟到第一个请求
+startup.deferred(app, __name__, 'load keys', load_jwt_secret)
+startup.deferred(app, __name__, 'hash users', init_users)
 
 class User(UserMixin):
     def __init__(self, username, user_id):
@@ -70,13 +101,17 @@ def get_encryption_key():
     key_file = Path('keys/encryption_key_dir_traversal.key')
     if key_file.exists():
         with open(key_file, 'rb') as f:
+            metrics.KEY_LOADS.labels(__name__, 'file').inc()
             return f.read()
     else:
         key = get_random_bytes(32)
         with open(key_file, 'wb') as f:
             f.write(key)
+        metrics.KEY_LOADS.labels(__name__, 'generated').inc()
         return key
 
+@metrics.crypto_op(__name__, 'encrypt')
+@timing.timed('encrypt')
 def encrypt_file(file_data):
     key = get_encryption_key()
     cipher = AES.new(key, AES.MODE_CBC)
@@ -85,6 +120,8 @@ def encrypt_file(file_data):
     encrypted_data = cipher.encrypt(padded_data)
     return iv + encrypted_data
 
+@metrics.crypto_op(__name__, 'decrypt')
+@timing.timed('decrypt')
 def decrypt_file(encrypted_data):
     try:
         key = get_encryption_key()
@@ -100,7 +137,7 @@ def decrypt_file(encrypted_data):
         else:
             raise
     except Exception as e:
-        print(f"Decryption error: {str(e)}")
+        logger.warning('decryption error', extra={'error': str(e)})
         raise
 
 # ========== 这里是漏洞：总是返回True，不验证路径 ==========
@@ -113,17 +150,21 @@ def token_required(f):
         token = request.headers.get('Authorization')
         
         if not token:
+            metrics.JWT_FAILURES.labels(__name__, 'missing').inc()
             return jsonify({'message': 'Token is missing'}), 401
         
         try:
             if token.startswith('Bearer '):
                 token = token[7:]
                 
-            data = jwt.decode(token, app.config['JWT_SECRET_KEY'], algorithms=['HS256'])
+            with timing.phase('auth'):
+                data = jwt.decode(token, app.config['JWT_SECRET_KEY'], algorithms=['HS256'])
             current_user = User(data['username'], data['id'])
         except jwt.ExpiredSignatureError:
+            metrics.JWT_FAILURES.labels(__name__, 'expired').inc()
             return jsonify({'message': 'Token has expired'}), 401
         except jwt.InvalidTokenError:
+            metrics.JWT_FAILURES.labels(__name__, 'invalid').inc()
             return jsonify({'message': 'Token is invalid'}), 401
             
         return f(current_user, *args, **kwargs)
@@ -185,7 +226,7 @@ def api_list_files(current_user):
                 files.append(file_info)
             except Exception as e:
                 # 如果某个文件访问失败，跳过它但记录错误
-                print(f"Warning: Could not access file {file_path}: {str(e)}")
+                logger.warning('could not access file', extra={'file': str(file_path), 'error': str(e)})
                 continue
     
     return jsonify({
@@ -243,17 +284,14 @@ def api_upload_file():  # 移除了token_required装饰器和current_user参数
 @app.route('/api/download/<path:filename>', methods=['GET'])
 def api_download_file(filename):  # 移除了token_required装饰器和current_user参数
     # 漏洞：完全信任用户输入的路径，支持任意层级遍历
-    print(f"收到下载请求，文件名: {filename}")
-    
     # 构建完整的文件路径
     file_path = Path(filename).resolve()
-    print(f"解析后的文件路径: {file_path}")
-    print(f"当前工作目录: {Path.cwd()}")
+    # 每次下载只记一条日志（请求的文件名、解析后的路径、大小），便于观察遍历攻击
+    log = {'requested': filename, 'resolved': str(file_path)}
     
     try:
-        print(f"检查文件是否存在: {file_path.exists()}")
         if not file_path.exists():
-            print(f"文件不存在: {file_path}")
+            logger.debug('file does not exist, trying fallback paths', extra=log)
             # 尝试一些常见的系统文件路径
             common_paths = [
                 Path("C:/windows/win.ini"),
@@ -264,18 +302,18 @@ def api_download_file(filename):  # 移除了token_required装饰器和current_u
             ]
             
             for path in common_paths:
-                print(f"尝试备用路径: {path} (存在: {path.exists()})")
                 if path.exists():
                     file_path = path
+                    log['fallback'] = str(path)
                     break
             else:
+                logger.info('download not found', extra=log)
                 return jsonify({'message': f'File not found: {filename}'}), 404
 
         # 直接尝试打开文件，不进行任何安全检查
         with open(file_path, 'rb') as f:
             file_data = f.read()
         
-        print(f"成功读取文件，大小: {len(file_data)} 字节")
 
         from io import BytesIO
         file_obj = BytesIO(file_data)
@@ -288,18 +326,16 @@ def api_download_file(filename):  # 移除了token_required装饰器和current_u
             download_name=file_path.name,
             mimetype='application/octet-stream'
         )
-        print("文件发送成功")
+        logger.info('download', extra={**log, 'bytes': len(file_data)})
         return response
     except FileNotFoundError as e:
-        print(f"文件未找到错误: {str(e)}")
+        logger.info('download not found', extra={**log, 'error': str(e)})
         return jsonify({'message': f'File not found: {str(e)}'}), 404
     except PermissionError as e:
-        print(f"权限错误: {str(e)}")
+        logger.warning('download permission denied', extra={**log, 'error': str(e)})
         return jsonify({'message': f'Permission denied: {str(e)}'}), 403
     except Exception as e:
-        print(f"其他错误: {str(e)}")
-        import traceback
-        traceback.print_exc()
+        logger.exception('download failed', extra=log)
         return jsonify({'message': f'Error reading file: {str(e)}'}), 500
 
 if __name__ == '__main__':
@@ -17,6 +17,17 @@ from Crypto.Util.Padding import pad, unpad
 from Crypto.Random import get_random_bytes
 import jwt
 import datetime
+import startup
+import metrics
+import compression
+import json_provider
+import timing
+import tracing
+import portal_logging
+from storage import atomic_write
+
+# 结构化JSON日志，由后台线程写出
+portal_logging.setup()
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = secrets.token_hex(32)
@@ -24,34 +35,53 @@ app.config['UPLOAD_FOLDER'] = 'protected_files'
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024
 
 # 使用持久化的JWT密钥而不是每次都生成新的
-jwt_secret_file = Path('keys/jwt_secret_ecb.key')
-if jwt_secret_file.exists():
-    with open(jwt_secret_file, 'r') as f:
-        app.config['JWT_SECRET_KEY'] = f.read()
-else:
-    jwt_secret = secrets.token_hex(32)
-    with open(jwt_secret_file, 'w') as f:
-        f.write(jwt_secret)
-    app.config['JWT_SECRET_KEY'] = jwt_secret
+def load_jwt_secret():
+    os.makedirs('keys', exist_ok=True)
+    jwt_secret_file = Path('keys/jwt_secret_ecb.key')
+    if jwt_secret_file.exists():
+        with open(jwt_secret_file, 'r') as f:
+            app.config['JWT_SECRET_KEY'] = f.read()
+    else:
+        jwt_secret = secrets.token_hex(32)
+        with open(jwt_secret_file, 'w') as f:
+            f.write(jwt_secret)
+        app.config['JWT_SECRET_KEY'] = jwt_secret
 
 CORS(app, resources={r"/api/*": {"origins": "*"}})
 
+# 请求与加解密指标，通过 /metrics 暴露
+metrics.init_app(app, __name__)
+# 每个响应带Server-Timing头（各阶段耗时）
+timing.init_app(app, __name__)
+# 请求追踪：设置PORTAL_TRACE_DIR时，每个阶段记录为一个span
+tracing.init_app(app, __name__)
+# jsonify使用orjson编码；JSON响应按Accept-Encoding压缩（gzip/br）
+json_provider.init_app(app)
+compression.init_app(app, __name__)
+
 login_manager = LoginManager()
 login_manager.init_app(app)
 
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 os.makedirs('keys', exist_ok=True)
 
-users = {
-    'admin': {
-        'password': generate_password_hash('admin123'),
-        'id': 1
-    },
-    'user1': {
-        'password': generate_password_hash('password123'),
-        'id': 2
-    }
-}
+users = {}
+
+def init_users():
+    users.update({
+        'admin': {
+            'password': generate_password_hash('admin123'),
+            'id': 1
+        },
+        'user1': {
+            'password': generate_password_hash('password123'),
+            'id': 2
+        }
+    })
+
+# 启动初始化；PORTAL_LAZY_INIT=1 时推迟到第一个请求
+startup.deferred(app, __name__, 'load keys', load_jwt_secret)
+startup.deferred(app, __name__, 'hash users', init_users)
 
 class User(UserMixin):
     def __init__(self, username, user_id):
@@ -70,14 +100,18 @@ def get_encryption_key():
     key_file = Path('keys/encryption_key_ecb.key')
     if key_file.exists():
         with open(key_file, 'rb') as f:
+            metrics.KEY_LOADS.labels(__name__, 'file').inc()
             return f.read()
     else:
         key = get_random_bytes(32)
         with open(key_file, 'wb') as f:
             f.write(key)
+        metrics.KEY_LOADS.labels(__name__, 'generated').inc()
         return key
 
 # ========== 这里是漏洞：使用ECB模式（不安全） ==========
+@metrics.crypto_op(__name__, 'encrypt')
+@timing.timed('encrypt')
 def encrypt_file(file_data):
     """漏洞版本：使用ECB模式，相同明文产生相同密文"""
     key = get_encryption_key()
@@ -88,6 +122,8 @@ def encrypt_file(file_data):
     # ECB模式不需要IV
     return encrypted_data  # 注意：不包含IV
 
+@metrics.crypto_op(__name__, 'decrypt')
+@timing.timed('decrypt')
 def decrypt_file(encrypted_data):
     """漏洞版本：ECB模式解密"""
     key = get_encryption_key()
@@ -108,17 +144,21 @@ def token_required(f):
         token = request.headers.get('Authorization')
         
         if not token:
+            metrics.JWT_FAILURES.labels(__name__, 'missing').inc()
             return jsonify({'message': 'Token is missing'}), 401
         
         try:
             if token.startswith('Bearer '):
                 token = token[7:]
                 
-            data = jwt.decode(token, app.config['JWT_SECRET_KEY'], algorithms=['HS256'])
+            with timing.phase('auth'):
+                data = jwt.decode(token, app.config['JWT_SECRET_KEY'], algorithms=['HS256'])
             current_user = User(data['username'], data['id'])
         except jwt.ExpiredSignatureError:
+            metrics.JWT_FAILURES.labels(__name__, 'expired').inc()
             return jsonify({'message': 'Token has expired'}), 401
         except jwt.InvalidTokenError:
+            metrics.JWT_FAILURES.labels(__name__, 'invalid').inc()
             return jsonify({'message': 'Token is invalid'}), 401
             
         return f(current_user, *args, **kwargs)
@@ -163,15 +203,17 @@ def api_login():
 def api_list_files(current_user):
     files = []
     files_dir = Path(app.config['UPLOAD_FOLDER'])
-    if files_dir.exists():
-        for file_path in files_dir.glob('*.enc'):
-            files.append({
-                'name': file_path.stem,
-                'size': file_path.stat().st_size,
-                'encrypted_name': file_path.name
-            })
+    with timing.phase('lookup'):
+        if files_dir.exists():
+            for file_path in files_dir.glob('*.enc'):
+                files.append({
+                    'name': file_path.stem,
+                    'size': file_path.stat().st_size,
+                    'encrypted_name': file_path.name
+                })
     
-    return jsonify({'files': files})
+    with timing.phase('serialize'):
+        return jsonify({'files': files})
 
 @app.route('/api/upload', methods=['POST'])
 @token_required
@@ -187,17 +229,20 @@ def api_upload_file(current_user):
     if not filename:
         return jsonify({'message': 'Invalid filename'}), 400
     
-    file_data = file.read()
+    with timing.phase('io_read'):
+        file_data = file.read()
     encrypted_data = encrypt_file(file_data)
     
     encrypted_filename = filename + '.enc'
     file_path = Path(app.config['UPLOAD_FOLDER']) / encrypted_filename
     
-    if not is_safe_path(app.config['UPLOAD_FOLDER'], encrypted_filename):
+    with timing.phase('lookup'):
+        path_ok = is_safe_path(app.config['UPLOAD_FOLDER'], encrypted_filename)
+    if not path_ok:
         return jsonify({'message': 'Invalid file path'}), 400
     
-    with open(file_path, 'wb') as f:
-        f.write(encrypted_data)
+    with timing.phase('io_write'):
+        atomic_write(file_path, encrypted_data)
     
     return jsonify({
         'message': f'File {filename} uploaded! (ECB模式)',
@@ -214,14 +259,17 @@ def api_download_file(current_user, filename):
     encrypted_filename = safe_filename + '.enc'
     file_path = Path(app.config['UPLOAD_FOLDER']) / encrypted_filename
     
-    if not is_safe_path(app.config['UPLOAD_FOLDER'], encrypted_filename):
+    with timing.phase('lookup'):
+        path_ok = is_safe_path(app.config['UPLOAD_FOLDER'], encrypted_filename)
+        exists = path_ok and file_path.exists()
+    if not path_ok:
         return jsonify({'message': 'Invalid file path'}), 400
     
-    if not file_path.exists():
+    if not exists:
         return jsonify({'message': 'File not found'}), 404
     
     try:
-        with open(file_path, 'rb') as f:
+        with timing.phase('io_read'), open(file_path, 'rb') as f:
             encrypted_data = f.read()
         
         decrypted_data = decrypt_file(encrypted_data)
@@ -230,12 +278,13 @@ def api_download_file(current_user, filename):
         file_obj = BytesIO(decrypted_data)
         file_obj.seek(0)
         
-        return send_file(
-            file_obj,
-            as_attachment=True,
-            download_name=safe_filename,
-            mimetype='application/octet-stream'
-        )
+        with timing.phase('serialize'):
+            return send_file(
+                file_obj,
+                as_attachment=True,
+                download_name=safe_filename,
+                mimetype='application/octet-stream'
+            )
     except Exception as e:
         return jsonify({'message': f'Error decrypting file: {str(e)}'}), 500
 
@@ -7,7 +7,20 @@ from flask import Flask, request, jsonify, send_file
 from flask_cors import CORS
 import jwt
 import datetime
+import logging
 from Crypto.Random import get_random_bytes
+from storage import atomic_write
+import startup
+import metrics
+import compression
+import json_provider
+import timing
+import tracing
+import portal_logging
+
+# 结构化JSON日志，由后台线程写出
+portal_logging.setup()
+logger = logging.getLogger(__name__)
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = secrets.token_hex(32)
@@ -15,18 +28,30 @@ app.config['UPLOAD_FOLDER'] = 'protected_files'
 app.config['DATABASE'] = 'test.db'
 
 # 使用持久化的JWT密钥而不是每次都生成新的
-jwt_secret_file = Path('keys/jwt_secret_sql.key')
-if jwt_secret_file.exists():
-    with open(jwt_secret_file, 'r') as f:
-        app.config['JWT_SECRET_KEY'] = f.read()
-else:
-    jwt_secret = secrets.token_hex(32)
-    with open(jwt_secret_file, 'w') as f:
-        f.write(jwt_secret)
-    app.config['JWT_SECRET_KEY'] = jwt_secret
+def load_jwt_secret():
+    os.makedirs('keys', exist_ok=True)
+    jwt_secret_file = Path('keys/jwt_secret_sql.key')
+    if jwt_secret_file.exists():
+        with open(jwt_secret_file, 'r') as f:
+            app.config['JWT_SECRET_KEY'] = f.read()
+    else:
+        jwt_secret = secrets.token_hex(32)
+        with open(jwt_secret_file, 'w') as f:
+            f.write(jwt_secret)
+        app.config['JWT_SECRET_KEY'] = jwt_secret
 
 CORS(app, resources={r"/api/*": {"origins": "*"}})
 
+# 请求与加解密指标，通过 /metrics 暴露
+metrics.init_app(app, __name__)
+# 每个响应带Server-Timing头（各阶段耗时）
+timing.init_app(app, __name__)
+# 请求追踪：设置PORTAL_TRACE_DIR时，每个阶段记录为一个span
+tracing.init_app(app, __name__)
+# jsonify使用orjson编码；JSON响应按Accept-Encoding压缩（gzip/br）
+json_provider.init_app(app)
+compression.init_app(app, __name__)
+
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 
 # 创建测试数据库（模拟用户数据）
@@ -58,12 +83,14 @@ def init_database():
         cursor.execute("INSERT INTO users (username, password, email, is_admin) VALUES (?, ?, ?, ?)",
                       ('test', 'test123', 'test@test.com', 0))
         
-        print("数据库初始化完成，插入3条测试数据")
+        logger.info('database initialized with 3 test users')
     
     conn.commit()
     conn.close()
 
-init_database()
+# 启动初始化；PORTAL_LAZY_INIT=1 时推迟到第一个请求
+startup.deferred(app, __name__, 'load keys', load_jwt_secret)
+startup.deferred(app, __name__, 'init database', init_database)
 
 # 用户数据（与数据库同步）
 users = {
@@ -86,11 +113,13 @@ def get_encryption_key():
     key_file = Path('keys/encryption_key_sql.key')
     if key_file.exists():
         with open(key_file, 'rb') as f:
+            metrics.KEY_LOADS.labels(__name__, 'file').inc()
             return f.read()
     else:
         key = get_random_bytes(32)
         with open(key_file, 'wb') as f:
             f.write(key)
+        metrics.KEY_LOADS.labels(__name__, 'generated').inc()
         return key
 
 # ========== SQL注入漏洞点 ==========
@@ -109,7 +138,8 @@ def vulnerable_search():
     try:
         # 危险！SQL注入漏洞
         query = f"SELECT * FROM users WHERE username LIKE '%{search_term}%' OR email LIKE '%{search_term}%'"
-        print(f"[危险] 执行SQL查询: {query}")
+        # [危险] 记录拼接出来的SQL，便于观察注入效果
+        logger.info('executing search query', extra={'query': query})
         cursor.execute(query)
         
         users_list = []
@@ -160,7 +190,7 @@ def vulnerable_login():
     
     # 漏洞：直接拼接SQL
     query = f"SELECT * FROM users WHERE username='{username}' AND password='{password}'"
-    print(f"[危险] 执行登录查询: {query}")
+    logger.info('executing login query', extra={'query': query})
     
     try:
         cursor.execute(query)
@@ -285,8 +315,7 @@ def api_upload():
     encrypted_filename = filename + '.enc'
     file_path = Path(app.config['UPLOAD_FOLDER']) / encrypted_filename
     
-    with open(file_path, 'wb') as f:
-        f.write(file_data)
+    atomic_write(file_path, file_data)
     
     return jsonify({
         'message': f'File {filename} uploaded!',
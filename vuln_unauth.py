@@ -15,9 +15,17 @@ from Crypto.Util.Padding import pad, unpad
 from Crypto.Random import get_random_bytes
 import datetime
 import logging
+from storage import atomic_write
+import metrics
+import compression
+import json_provider
+import timing
+import tracing
+import portal_logging
 
-# 设置日志记录
-logging.basicConfig(level=logging.DEBUG)
+# 设置日志记录：结构化JSON日志，由后台线程写出
+# 级别用PORTAL_LOG_LEVELS=vuln_unauth=DEBUG单独调整，不再全局打开DEBUG
+portal_logging.setup()
 logger = logging.getLogger(__name__)
 
 # 初始化Flask应用程序
@@ -31,6 +39,16 @@ app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 限制最大上传文件
 # 安全风险：过于宽松的CORS策略可能导致跨站请求伪造攻击
 CORS(app, resources={r"/api/*": {"origins": "*"}})
 
+# 请求与加解密指标，通过 /metrics 暴露
+metrics.init_app(app, __name__)
+# 每个响应带Server-Timing头（各阶段耗时）
+timing.init_app(app, __name__)
+# 请求追踪：设置PORTAL_TRACE_DIR时，每个阶段记录为一个span
+tracing.init_app(app, __name__)
+# jsonify使用orjson编码；JSON响应按Accept-Encoding压缩（gzip/br）
+json_provider.init_app(app)
+compression.init_app(app, __name__)
+
 # 创建必要的目录
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 os.makedirs('keys', exist_ok=True)
@@ -47,24 +65,27 @@ def get_encryption_key():
                 key = f.read()
                 # 验证密钥长度是否正确（32字节用于AES-256）
                 if len(key) == 32:
-                    print(f"Loaded existing encryption key from {key_file}")
+                    metrics.KEY_LOADS.labels(__name__, 'file').inc()
+                    logger.debug('loaded encryption key', extra={'key_file': str(key_file)})
                     return key
                 else:
                     # 如果密钥长度不正确，生成新的密钥
-                    print(f"Warning: Encryption key file corrupted or incomplete (length: {len(key)}), generating new key")
+                    logger.warning('encryption key file corrupted or incomplete, generating new key', extra={'key_file': str(key_file), 'length': len(key)})
         except Exception as e:
-            print(f"Warning: Failed to read encryption key file: {e}, generating new key")
+            logger.warning('failed to read encryption key file, generating new key', extra={'key_file': str(key_file), 'error': str(e)})
     
     # 生成新的32字节AES密钥并保存到文件
-    print("Generating new encryption key...")
     key = get_random_bytes(32)
     # 确保keys目录存在
     os.makedirs('keys', exist_ok=True)
     with open(key_file, 'wb') as f:
         f.write(key)
-    print(f"New encryption key saved to {key_file}")
+    logger.info('generated new encryption key', extra={'key_file': str(key_file)})
+    metrics.KEY_LOADS.labels(__name__, 'generated').inc()
     return key
 
+@metrics.crypto_op(__name__, 'encrypt')
+@timing.timed('encrypt')
 def encrypt_file(file_data):
     """使用AES-CBC模式加密文件数据
     参数:
@@ -83,6 +104,8 @@ def encrypt_file(file_data):
     # 将IV和加密数据组合返回（IV不需要保密）
     return iv + encrypted_data
 
+@metrics.crypto_op(__name__, 'decrypt')
+@timing.timed('decrypt')
 def decrypt_file(encrypted_data):
     """使用AES-CBC模式解密文件数据
     参数:
@@ -151,8 +174,9 @@ def api_list_files():
     """列出所有加密文件的元数据信息
     安全漏洞：无需认证即可访问文件列表，泄露了系统中的文件信息
     """
-    print("Received request to /api/files - no authentication required")
-    print(f"Request headers: {dict(request.headers)}")
+    # 请求头只在DEBUG级别记录；未开启时不构造这个字典
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug('unauthenticated /api/files request', extra={'headers': dict(request.headers)})
     
     try:
         files = []
@@ -170,16 +194,14 @@ def api_list_files():
                     })
                 except OSError as e:
                     # 如果无法获取文件信息，记录日志并跳过该文件
-                    print(f"Warning: Could not access file {file_path}: {e}")
+                    logger.warning('could not access file', extra={'file': str(file_path), 'error': str(e)})
                     continue
         
-        print(f"Returning file list with {len(files)} files")
+        logger.debug('returning file list', extra={'count': len(files)})
         return jsonify({'files': files})
     except Exception as e:
         # 记录错误信息
-        print(f"Error in api_list_files: {type(e).__name__}: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.exception('error in api_list_files')
         # 返回错误信息
         return jsonify({'message': f'Internal server error: {str(e)}'}), 500
 
@@ -215,9 +237,8 @@ def api_upload_file():
     if not is_safe_path(app.config['UPLOAD_FOLDER'], encrypted_filename):
         return jsonify({'message': 'Invalid file path'}), 400
     
-    # 将加密后的数据写入文件
-    with open(file_path, 'wb') as f:
-        f.write(encrypted_data)
+    # 将加密后的数据原子写入文件（临时文件 + fsync + 加锁重命名）
+    atomic_write(file_path, encrypted_data)
     
     return jsonify({
         'message': f'File {filename} uploaded and encrypted successfully!',
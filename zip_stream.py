@@ -0,0 +1,117 @@
+"""
+Stream a ZIP archive of stored files, decrypting each one on the fly.
+
+``stream_zip`` is a generator of archive bytes. For each entry it opens the
+``.enc`` file, decrypts it piece by piece with crypto_stream.decrypt_chunks
+and feeds the plaintext straight into a ``zipfile`` entry, whose output
+goes to a sink that the generator drains after every piece. Nothing is
+written to disk and at most one piece (plus zipfile's small buffers) is in
+memory, whatever the size of the files or the archive.
+
+zipfile supports unseekable output: every entry gets a data descriptor with
+its CRC and sizes after the data, and the central directory at the end has
+them too. Entries that might be large are written as ZIP64 from the start,
+so a multi-gigabyte bundle is valid.
+
+Errors after the first byte has gone out cannot become an HTTP error any
+more. A file that fails to decrypt half way therefore ends the stream
+early, and the client is left with a truncated archive that will not open,
+rather than one that looks complete but is missing data.
+
+An entry's source is the path of a ``.enc`` file, or an object with
+``size``, ``mtime`` and ``open()`` for one stored elsewhere (a packed
+object, see packstore.py).
+"""
+
+import io
+import os
+import time
+import zipfile
+
+import metrics
+from crypto_stream import IV_SIZE, BLOCK, decrypt_chunks
+
+READ_SIZE = 256 * 1024
+COMPRESSION = {
+    'stored': zipfile.ZIP_STORED,
+    'deflate': zipfile.ZIP_DEFLATED,
+}
+
+
+class _Sink(io.RawIOBase):
+    """Write-only, unseekable stream collecting what zipfile writes."""
+
+    def __init__(self):
+        self.chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks.clear()
+        return data
+
+
+def _size_and_mtime(source):
+    if isinstance(source, (str, os.PathLike)):
+        stat = os.stat(source)
+        return stat.st_size, stat.st_mtime
+    return source.size, source.mtime
+
+
+def _open(source):
+    return open(source, 'rb') if isinstance(source, (str, os.PathLike)) else source.open()
+
+
+def check_stored(source):
+    """Raise ValueError unless ``source`` has a plausible [IV][ciphertext] length."""
+    size, _ = _size_and_mtime(source)
+    if size < IV_SIZE + BLOCK or (size - IV_SIZE) % BLOCK:
+        name = os.path.basename(source) if isinstance(source, (str, os.PathLike)) else source.name
+        raise ValueError(f'{name}: invalid encrypted file length {size}')
+    return size
+
+
+def stream_zip(entries, key, compression='stored', app_name='portal', logger=None):
+    """Yield a ZIP archive of ``entries``, a list of ``(archive_name, source)``."""
+    crypto_bytes = metrics.CRYPTO_BYTES.labels(app_name, 'decrypt')
+    crypto_seconds = metrics.CRYPTO_SECONDS.labels(app_name, 'decrypt')
+    sink = _Sink()
+    with zipfile.ZipFile(sink, mode='w', compression=COMPRESSION[compression], allowZip64=True) as archive:
+        for name, source in entries:
+            size, mtime = _size_and_mtime(source)
+            info = zipfile.ZipInfo(name, date_time=time.localtime(mtime)[:6])
+            info.compress_type = COMPRESSION[compression]
+            # zipfile decides on ZIP64 from this estimate before any data is
+            # written; the plaintext is never larger than the ciphertext
+            info.file_size = size
+            seconds = 0.0
+            with _open(source) as f, archive.open(info, mode='w') as entry:
+                pieces = decrypt_chunks(key, f, READ_SIZE)
+                while True:
+                    started = time.perf_counter()
+                    try:
+                        piece = next(pieces)
+                    except StopIteration:
+                        break
+                    except ValueError:
+                        if logger is not None:
+                            logger.error('archive aborted: decryption failed', extra={'file': name})
+                        raise
+                    finally:
+                        seconds += time.perf_counter() - started
+                    entry.write(piece)
+                    data = sink.drain()
+                    if data:
+                        yield data
+            crypto_bytes.inc(size)
+            crypto_seconds.inc(seconds)
+            data = sink.drain()
+            if data:
+                yield data
+    yield sink.drain()